@@ -0,0 +1,77 @@
+# Standard libraries
+import base64
+import datetime
+import functools
+# Third-party libraries
+from django.conf import settings
+from django.core.exceptions import BadRequest
+from django.db.models import Q
+# Local libraries
+from django_bpaml_strava.models import Activity
+
+# Activities on each page of an athlete's history. Can be overridden in settings.
+ACTIVITY_PAGE_SIZE = getattr(settings, 'BPAML_ACTIVITY_PAGE_SIZE', 50)
+# Most activities the JSON API returns in one response
+MAX_API_PAGE_SIZE = 200
+# Columns of up to 4000 characters which aren't shown in activity lists
+LARGE_COLUMNS = ('polyline', 'description')
+
+
+def encode_cursor(start_time: datetime.datetime, pk: int) -> str:
+    """Opaque cursor for the position after this activity in (start_time, id) order"""
+    return base64.urlsafe_b64encode(f'{start_time.isoformat()}|{pk}'.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[datetime.datetime, int]:
+    """Reverse of encode_cursor. Raises BadRequest, which Django turns into a 400 response, if it is invalid"""
+    try:
+        start_time, pk = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split('|')
+        return datetime.datetime.fromisoformat(start_time), int(pk)
+    except ValueError:
+        raise BadRequest(f"Invalid cursor {cursor!r}")
+
+
+def activities_after(user_id, cursor: str = None):
+    """
+    The athlete's activities in (start_time, id) order starting after the cursor.
+    Uses the (athlete, start_time) index, which includes the id, so each page costs the same however long
+    the history is, unlike OFFSET which reads and discards every earlier row.
+    """
+    activities = Activity.objects.filter(athlete_id=user_id).order_by('start_time', 'id')
+    if cursor:
+        start_time, pk = decode_cursor(cursor)
+        # The start_time__gte range lets the database seek in the index before checking the tie break on id
+        activities = activities.filter(Q(start_time__gt=start_time) | Q(id__gt=pk), start_time__gte=start_time)
+    return activities
+
+
+class ActivityPage:
+    """
+    One page of an athlete's saved activities without the large columns.
+    The query only runs when the activities are first used, so not at all if the page is already cached.
+    """
+
+    def __init__(self, user_id, cursor: str = None, size: int = ACTIVITY_PAGE_SIZE):
+        # Check the cursor now so an invalid one is a 400 response rather than an empty page
+        if cursor:
+            decode_cursor(cursor)
+        self.user_id = user_id
+        self.cursor = cursor
+        self.size = size
+
+    @functools.cached_property
+    def _rows(self) -> list[Activity]:
+        # Fetch one extra to find out if there is another page
+        return list(activities_after(self.user_id, self.cursor).defer(*LARGE_COLUMNS)[:self.size + 1])
+
+    @property
+    def activities(self) -> list[Activity]:
+        return self._rows[:self.size]
+
+    @property
+    def next_cursor(self) -> str | None:
+        """Cursor for the next page, or None if this is the last page"""
+        if len(self._rows) <= self.size:
+            return None
+        last = self._rows[self.size - 1]
+        return encode_cursor(last.start_time, last.pk)
@@ -1,6 +1,259 @@
-from django.contrib import admin
+"""
+Admin classes which stay quick as the club's history grows. Changelists join the athlete rather than query it
+for each row, leave out the large polyline and description columns, order and filter on indexed columns and
+count their rows at most once every BPAML_ADMIN_COUNT_TIMEOUT seconds. Bulk actions run as set-based queries.
+"""
+# Standard libraries
+import collections
+import datetime
+import hashlib
+# Third-party libraries
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Count, Sum
+from django.http import QueryDict
+from django.template.response import TemplateResponse
+from django.utils.functional import cached_property
+# Local libraries
+from django_bpaml_strava.course_matching import rematch_locations
+from django_bpaml_strava.database import serialized_writer
+from django_bpaml_strava.models import Activity, BackfillWindow, ParkrunCourse, SeasonStanding, StravaEvent, User
+from django_bpaml_strava.page_cache import bump_page_versions
+from django_bpaml_strava.polyline import route_hash
+from django_bpaml_strava.standings import update_season_standing, update_season_standings
 
-from django_bpaml_strava.models import Activity, User
+# Seconds a changelist's row count is reused. Can be overridden in settings.
+ADMIN_COUNT_TIMEOUT = getattr(settings, 'BPAML_ADMIN_COUNT_TIMEOUT', 5 * 60)
+# Unfiltered PostgreSQL tables with more rows than this are counted from the planner's estimate
+ESTIMATE_COUNT_ABOVE = 10000
 
-admin.site.register(Activity)
-admin.site.register(User)
+
+class CachedCountPaginator(Paginator):
+    """
+    Counts rows with one COUNT(*) per distinct filter every ADMIN_COUNT_TIMEOUT seconds rather than on every page.
+    An unfiltered table on PostgreSQL uses the planner's row estimate instead, which is read without scanning.
+    Counts can be a few minutes out of date, so the last page may be short or empty.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list.order_by()
+        estimate = self._estimated_count(queryset)
+        if estimate is not None:
+            return estimate
+        sql, params = queryset.query.sql_with_params()
+        key = 'admin-count:' + hashlib.md5(repr((sql, params)).encode()).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, timeout=ADMIN_COUNT_TIMEOUT)
+        return count
+
+    @staticmethod
+    def _estimated_count(queryset):
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql' or queryset.query.where:
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        return int(row[0]) if row and row[0] > ESTIMATE_COUNT_ABOVE else None
+
+
+class DeferringChangeList(ChangeList):
+    """Changelist which doesn't load the model admin's list_defer fields, which the list never shows"""
+
+    def get_queryset(self, request, exclude_parameters=None):
+        return super().get_queryset(request, exclude_parameters).defer(*self.model_admin.list_defer)
+
+
+class ScalableAdminMixin:
+    """Settings for the admins of tables which grow with the club's history, mixed into third-party admins too"""
+    paginator = CachedCountPaginator
+    # Otherwise a filtered changelist counts the whole table too, to show "N of M selected"
+    show_full_result_count = False
+    list_defer = ()
+
+    def get_changelist(self, request, **kwargs):
+        return DeferringChangeList
+
+
+class ScalableModelAdmin(ScalableAdminMixin, admin.ModelAdmin):
+    """Base for the admins of tables which grow with the club's history"""
+
+
+class AthleteFilter(admin.SimpleListFilter):
+    """
+    Filter on the username typed into a box. A RelatedFieldListFilter would list every athlete in the sidebar,
+    reading the whole user table on every changelist load.
+    """
+    title = 'athlete'
+    parameter_name = 'athlete'
+    template = 'admin/django_bpaml_strava/input_filter.html'
+
+    def lookups(self, request, model_admin):
+        return ()
+
+    def has_output(self):
+        return True
+
+    def queryset(self, request, queryset):
+        if self.value():
+            # username is unique so indexed
+            return queryset.filter(athlete__username=self.value())
+        return queryset
+
+    def choices(self, changelist):
+        query_string = changelist.get_query_string(remove=[self.parameter_name])
+        yield {
+            'parameter_name': self.parameter_name,
+            'value': self.value() or '',
+            'placeholder': 'username',
+            # The rest of the current query, sent again with the typed username
+            'other_params': [(name, value) for name, values in QueryDict(query_string[1:]).lists() for value in values],
+            'query_string': query_string,
+        }
+
+
+@admin.register(Activity)
+class ActivityAdmin(ScalableModelAdmin):
+    """Deleting activities doesn't send signals to update the season standings and cached pages so update them here"""
+    list_display = ('title', 'athlete', 'date', 'location', 'strava_duration', 'parkrun_duration', 'distance')
+    list_select_related = ('athlete',)
+    list_defer = ('polyline', 'description')
+    # date and (athlete, date) are indexed
+    date_hierarchy = 'date'
+    list_filter = (AthleteFilter,)
+    ordering = ('-date',)
+    autocomplete_fields = ('athlete',)
+    readonly_fields = ('route_hash',)
+    actions = ('rematch_courses', 'recompute_durations')
+
+    def save_model(self, request, obj, form, change):
+        # The thumbnail URL is built from the hash, so it has to follow an edited polyline
+        obj.route_hash = route_hash(obj.polyline)
+        super().save_model(request, obj, form, change)
+        # post_save updated the new season's standing, so update the one the activity moved out of
+        if change and 'date' in form.changed_data and form.initial['date'].year != obj.date.year:
+            update_season_standing(obj.athlete_id, form.initial['date'].year)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        update_season_standing(obj.athlete_id, obj.date.year)
+        bump_page_versions([obj.athlete_id])
+
+    def delete_queryset(self, request, queryset):
+        athlete_ids = set(queryset.values_list('athlete_id', flat=True))
+        super().delete_queryset(request, queryset)
+        update_season_standings(athlete_ids)
+        bump_page_versions(athlete_ids)
+
+    @admin.action(description='Re-run parkrun course matching', permissions=['change'])
+    def rematch_courses(self, request, queryset):
+        matched = rematch_locations(queryset, rematch_all=True)
+        self.message_user(request, f'Matched {matched} activities to parkrun courses and cleared the location of '
+                                   f'those matching none. Activities with an official result keep its event as '
+                                   f'location', messages.SUCCESS)
+
+    @admin.action(description="Recompute the athletes' season durations", permissions=['change'])
+    def recompute_durations(self, request, queryset):
+        _recompute_durations(self, request, queryset)
+
+
+def _recompute_durations(model_admin, request, queryset):
+    """Recalculate the best and average durations of every season of the queryset's athletes"""
+    athlete_ids = queryset.order_by().values_list('athlete_id', flat=True).distinct()
+    with serialized_writer():
+        # Used as a subquery, so the selection is never loaded
+        update_season_standings(athlete_ids)
+        bump_page_versions(athlete_ids)
+    model_admin.message_user(request, 'Recomputed season durations', messages.SUCCESS)
+
+
+@admin.register(SeasonStanding)
+class SeasonStandingAdmin(ScalableModelAdmin):
+    list_display = ('athlete', 'season', 'run_count', 'best_duration', 'average_duration', 'last_date', 'points')
+    list_select_related = ('athlete',)
+    # season leads the (season, best_duration) index
+    list_filter = ('season',)
+    ordering = ('-season', 'best_duration')
+    autocomplete_fields = ('athlete',)
+    actions = ('recompute_durations', 'delete_seasons')
+
+    @admin.action(description="Recompute the athletes' season durations", permissions=['change'])
+    def recompute_durations(self, request, queryset):
+        _recompute_durations(self, request, queryset)
+
+    def has_delete_activities_permission(self, request):
+        """delete_seasons deletes activities, so needs permission to delete those rather than standings"""
+        return request.user.has_perm('django_bpaml_strava.delete_activity')
+
+    @admin.action(description="Delete the selected seasons' activities", permissions=['delete_activities'])
+    def delete_seasons(self, request, queryset):
+        """
+        Delete every activity in the selected athletes' seasons with one DELETE per season using the
+        (athlete, date) index, after a confirmation page showing how many activities will go.
+        """
+        if not request.POST.get('post'):
+            summary = (queryset.order_by('-season').values('season')
+                       .annotate(athletes=Count('athlete'), activities=Sum('run_count')))
+            return TemplateResponse(request, 'admin/django_bpaml_strava/seasonstanding/delete_seasons.html', {
+                **self.admin_site.each_context(request),
+                'title': 'Delete seasons',
+                'opts': self.model._meta,
+                'summary': summary,
+                # Posted again with the confirmation. With select_across the action gets every filtered row
+                'selected': request.POST.getlist(admin.helpers.ACTION_CHECKBOX_NAME),
+                'select_across': request.POST.get('select_across', '0'),
+                'action_checkbox_name': admin.helpers.ACTION_CHECKBOX_NAME,
+            })
+        athlete_ids_by_season = collections.defaultdict(set)
+        for athlete_id, season in queryset.values_list('athlete_id', 'season'):
+            athlete_ids_by_season[season].add(athlete_id)
+        athlete_ids = set().union(*athlete_ids_by_season.values())
+        deleted = 0
+        with serialized_writer():
+            for season, season_athlete_ids in athlete_ids_by_season.items():
+                # Nothing cascades from activities so this is a single DELETE rather than a fetch and delete by pk
+                season_deleted, _ = Activity.objects.filter(athlete_id__in=season_athlete_ids,
+                                                            date__gte=datetime.date(season, 1, 1),
+                                                            date__lt=datetime.date(season + 1, 1, 1)).delete()
+                deleted += season_deleted
+            update_season_standings(athlete_ids)
+            bump_page_versions(athlete_ids)
+        self.message_user(request, f'Deleted {deleted} activities from {len(athlete_ids_by_season)} seasons',
+                          messages.SUCCESS)
+
+
+@admin.register(User)
+class UserAdmin(ScalableAdminMixin, BaseUserAdmin):
+    """Django's user admin with the parkrun id. Its search fields also serve the athlete autocomplete"""
+    fieldsets = BaseUserAdmin.fieldsets + (('parkrun', {'fields': ('parkrun_id',)}),)
+    add_fieldsets = BaseUserAdmin.add_fieldsets + (('parkrun', {'fields': ('parkrun_id',)}),)
+    list_display = ('username', 'email', 'first_name', 'last_name', 'parkrun_id', 'is_staff')
+    search_fields = ('username', 'first_name', 'last_name', 'email', '=parkrun_id')
+    # username is unique so indexed, unlike the names
+    ordering = ('username',)
+
+
+@admin.register(StravaEvent)
+class StravaEventAdmin(ScalableModelAdmin):
+    list_display = ('object_type', 'object_id', 'aspect_type', 'owner_id', 'event_time', 'processed_at', 'attempts')
+    list_filter = ('object_type', 'aspect_type')
+    ordering = ('-id',)
+
+
+@admin.register(BackfillWindow)
+class BackfillWindowAdmin(ScalableModelAdmin):
+    list_display = ('athlete', 'after', 'before', 'fetched', 'saved', 'completed_at')
+    list_select_related = ('athlete',)
+    autocomplete_fields = ('athlete',)
+    ordering = ('-id',)
+
+
+admin.site.register(ParkrunCourse)
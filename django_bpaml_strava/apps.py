@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class DjangoBpamlStravaConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'django_bpaml_strava'
+
+    def ready(self):
+        # Connect signal receivers
+        from django_bpaml_strava import signals  # noqa: F401
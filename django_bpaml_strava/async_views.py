@@ -0,0 +1,101 @@
+"""
+Async versions of the views which call Strava, for use when deployed with asgi.py.
+Strava requests use a pooled httpx client and run concurrently with the database queries they don't depend on.
+Enable them with BPAML_ASYNC_VIEWS = True in settings.
+"""
+import asyncio
+import logging
+from allauth.socialaccount.models import SocialAccount
+from asgiref.sync import sync_to_async
+from django.contrib.auth.decorators import login_required
+from django.shortcuts import aget_object_or_404, redirect, render
+
+from django_bpaml_strava.models import Activity
+from django_bpaml_strava.course_matching import assign_locations
+from django_bpaml_strava.ingest import activity_from_strava, bulk_save_activities, decode_activities
+from django_bpaml_strava.listing_cache import acached_activity, afetch_listing, ainvalidate_listing
+from django_bpaml_strava.parkrun import new_parkrun_activities
+from django_bpaml_strava.query_budget import query_budget
+from django_bpaml_strava.strava_activities import afetch_activity_from_strava
+from django_bpaml_strava.strava_client import StravaError
+from django_bpaml_strava.views import athlete_context, index_page, strava_social_accounts
+
+logger = logging.getLogger(__name__)
+
+
+async def aget_strava_account(strava_id):
+    return await aget_object_or_404(SocialAccount.objects.select_related('user'), provider='strava', uid=strava_id)
+
+
+@query_budget(queries=8)
+@login_required
+async def afetch_and_view_activities(request, strava_id):
+    """Async version of views.fetch_and_view_activities"""
+    if request.GET.get('refresh'):
+        await ainvalidate_listing(strava_id)
+    try:
+        list_strava_activities, social_account = await asyncio.gather(
+            afetch_listing(strava_id),
+            strava_social_accounts(strava_id).afirst(),
+        )
+    except StravaError:
+        return await sync_to_async(index_page)(request)
+    # omit the ones already saved, using the (athlete, activity_id) unique index
+    set_activity_id = set([activity_id async for activity_id in Activity.objects
+                          .filter(athlete=social_account.user,
+                                  activity_id__in=[d['id'] for d in list_strava_activities])
+                          .values_list('activity_id', flat=True)])
+    list_new_strava_activities = [d for d in list_strava_activities if d['id'] not in set_activity_id]
+    # display the results. Rendering may touch the session user so runs in a thread
+    athlete = await sync_to_async(athlete_context)(strava_id, social_account, request.GET.get('after'))
+    context = {**athlete, 'list_strava_activities': list_new_strava_activities}
+    return await sync_to_async(render)(request, 'django_bpaml_strava/athlete.html', context)
+
+
+async def aactivity_saved(strava_id, activity_id):
+    """The athlete's social account and whether the activity has already been saved"""
+    social_account = await aget_strava_account(strava_id)
+    saved = await Activity.objects.filter(athlete=social_account.user, activity_id=activity_id).aexists()
+    return social_account, saved
+
+
+@query_budget(queries=12)
+@login_required
+async def asave_activity(request, strava_id, activity_id):
+    """Async version of views.save_activity. Strava is only asked for activities which haven't been saved"""
+    social_account, saved = await aactivity_saved(strava_id, activity_id)
+    if saved:
+        logger.info("Activity %s already saved", activity_id)
+        return redirect("view-activities", strava_id=strava_id)
+    try:
+        # The summary in the listing the user chose from has everything we save
+        dct_activity = (await acached_activity(strava_id, activity_id)
+                        or await afetch_activity_from_strava(strava_id, activity_id))
+    except StravaError:
+        return redirect("view-activities", strava_id=strava_id)
+    activity = activity_from_strava(social_account.user, dct_activity)
+    # Matching may need to load the course index from the database
+    await sync_to_async(assign_locations)([activity])
+    await activity.asave()
+    logger.debug("Saved activity %s %s", activity.activity_id, activity.title)
+    return redirect("view-activities", strava_id=strava_id)
+
+
+@query_budget(queries=12)
+@login_required
+async def afetch_and_save_activities(request, strava_id):
+    """Async version of views.fetch_and_save_activities"""
+    try:
+        strava_activities, social_account = await asyncio.gather(
+            afetch_listing(strava_id),
+            aget_strava_account(strava_id),
+        )
+    except StravaError:
+        return await sync_to_async(index_page)(request)
+
+    def save_parkruns(user):
+        bulk_save_activities(new_parkrun_activities(user, decode_activities(user, strava_activities)))
+
+    # Saving in bulk needs a transaction which is only available to sync code
+    await sync_to_async(save_parkruns)(social_account.user)
+    return redirect('view-activities', strava_id=strava_id)
@@ -0,0 +1,112 @@
+"""
+Backfill an athlete's Strava history over any date range, not just the first quarter of this year.
+The range is split into time windows which are fetched in parallel at bulk priority, so interactive requests
+keep their share of the rate limit. Each window's parkruns are saved through bulk ingest together with a
+BackfillWindow checkpoint, so an interrupted backfill resumes with the windows it hadn't finished.
+"""
+# Standard libraries
+import concurrent.futures
+import datetime
+import logging
+import time
+from typing import Callable
+# Third-party libraries
+from allauth.socialaccount.models import SocialAccount
+from django.conf import settings
+from django.db import connection
+# Local libraries
+from django_bpaml_strava.database import serialized_writer
+from django_bpaml_strava.ingest import bulk_save_activities, decode_activities
+from django_bpaml_strava.models import BackfillWindow
+from django_bpaml_strava.parkrun import new_parkrun_activities
+from django_bpaml_strava.rate_limit import BULK, strava_priority
+from django_bpaml_strava.strava_activities import BASE_TZ, fetch_activities_from_strava
+
+logger = logging.getLogger(__name__)
+
+# Days in each window. Can be overridden in settings.
+BACKFILL_WINDOW_DAYS = getattr(settings, 'BPAML_BACKFILL_WINDOW_DAYS', 90)
+# Windows fetched at the same time for one athlete
+BACKFILL_WORKERS = getattr(settings, 'BPAML_BACKFILL_WORKERS', 4)
+
+
+def backfill_windows(start: datetime.date, end: datetime.date,
+                     days: int = BACKFILL_WINDOW_DAYS) -> list[tuple[datetime.datetime, datetime.datetime]]:
+    """
+    (after, before) windows covering start to end inclusive. They start and end at midnight Brisbane time
+    so every activity on a date is in the same window and the parkrun rules see them together.
+    """
+    windows = []
+    day = start
+    while day <= end:
+        next_day = min(day + datetime.timedelta(days=days), end + datetime.timedelta(days=1))
+        windows.append((datetime.datetime.combine(day, datetime.time(), BASE_TZ),
+                        datetime.datetime.combine(next_day, datetime.time(), BASE_TZ)))
+        day = next_day
+    return windows
+
+
+def pending_windows(user, windows) -> list[tuple[datetime.datetime, datetime.datetime]]:
+    """The windows without a checkpoint, found with one query"""
+    done = set(BackfillWindow.objects
+               .filter(athlete=user, after__gte=windows[0][0], before__lte=windows[-1][1])
+               .values_list('after', 'before')) if windows else set()
+    return [window for window in windows if window not in done]
+
+
+def fetch_window(strava_id, after: datetime.datetime, before: datetime.datetime) -> list[dict]:
+    """Fetch one window's activities in a worker thread"""
+    try:
+        with strava_priority(BULK):
+            return list(fetch_activities_from_strava(strava_id, after=after, before=before))
+    finally:
+        # Each worker thread has its own database connection
+        connection.close()
+
+
+def backfill_athlete(social_account: SocialAccount, start: datetime.date, end: datetime.date,
+                     window_days: int = BACKFILL_WINDOW_DAYS, workers: int = BACKFILL_WORKERS,
+                     progress: Callable[[dict], None] = None) -> dict:
+    """
+    Fetch and save the athlete's parkruns from start to end, skipping windows already done.
+    Windows are saved as they arrive, so if one fails, raising StravaError or StravaRateLimited,
+    every window saved before it stays done. progress is called with the counts of each saved window.
+    """
+    t_start = time.perf_counter()
+    user = social_account.user
+    windows = backfill_windows(start, end, window_days)
+    todo = pending_windows(user, windows)
+    fetched = saved = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch_window, social_account.uid, after, before): (after, before)
+                   for after, before in todo}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                after, before = futures[future]
+                dct_activities = future.result()
+                # The checkpoint is saved in the same transaction as the window's activities
+                with serialized_writer():
+                    window_saved = bulk_save_activities(
+                        new_parkrun_activities(user, decode_activities(user, dct_activities)))
+                    BackfillWindow.objects.create(athlete=user, after=after, before=before,
+                                                  fetched=len(dct_activities), saved=window_saved)
+                fetched += len(dct_activities)
+                saved += window_saved
+                if progress is not None:
+                    progress({'strava_id': social_account.uid, 'after': after, 'before': before,
+                              'fetched': len(dct_activities), 'saved': window_saved})
+        except BaseException:
+            # Don't start windows which haven't been fetched yet. They will be done when the backfill resumes
+            for future in futures:
+                future.cancel()
+            raise
+    result = {
+        'strava_id': social_account.uid,
+        'windows': len(windows),
+        'skipped': len(windows) - len(todo),
+        'fetched': fetched,
+        'saved': saved,
+        'seconds': time.perf_counter() - t_start,
+    }
+    logger.info("Backfilled athlete %s: %s", social_account.uid, result)
+    return result
@@ -0,0 +1,192 @@
+"""
+Repeatable benchmarks of the main views against seeded data and the fake Strava server in fake_strava.py.
+Each benchmark records wall time, SQL query count and peak Python memory, and the results are written as JSON
+so they can be compared between releases. Run with the benchmark management command.
+"""
+# Standard libraries
+import contextlib
+import dataclasses
+import datetime
+import platform
+import statistics
+import time
+import tracemalloc
+from typing import Callable
+from unittest import mock
+# Third-party libraries
+import django
+from allauth.socialaccount.models import SocialAccount, SocialApp, SocialToken
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+# Local libraries
+from django_bpaml_strava import strava_activities, strava_token
+from django_bpaml_strava.fake_strava import FakeStravaServer, LISTING_ID_BASE, access_token, refresh_token
+from django_bpaml_strava.fake_strava import strava_activity
+from django_bpaml_strava.ingest import decode_activities
+from django_bpaml_strava.listing_cache import invalidate_listing
+from django_bpaml_strava.models import Activity, User
+from django_bpaml_strava.query_budget import QueryRecorder
+from django_bpaml_strava.standings import rebuild_season_standings, update_season_standings
+
+# Seeded athletes have strava ids from here
+BENCHMARK_UID_BASE = 900_000_000
+
+
+def benchmark_strava_id(index) -> str:
+    return str(BENCHMARK_UID_BASE + index)
+
+
+def saved_activities(user, count) -> list[Activity]:
+    """count weekly Saturday morning parkruns going back from last year, ready to bulk_create"""
+    first_saturday = datetime.datetime(datetime.date.today().year - 1, 12, 31, 7, 0, tzinfo=datetime.timezone.utc)
+    first_saturday -= datetime.timedelta(days=(first_saturday.weekday() - 5) % 7, hours=10)
+    return list(decode_activities(user, (
+        strava_activity(i + 1, first_saturday - datetime.timedelta(weeks=i), elapsed_seconds=1200 + i % 900)
+        for i in range(count)
+    )))
+
+
+def seed_athletes(athletes, activities) -> list[SocialAccount]:
+    """Create athletes who each have activities saved parkruns and a token the fake Strava server accepts"""
+    app, _ = SocialApp.objects.get_or_create(provider='strava', defaults={'name': 'Strava', 'client_id': 'benchmark',
+                                                                          'secret': 'benchmark'})
+    users = User.objects.bulk_create([
+        User(username=f'benchmark-{i}', first_name='Athlete', last_name=f'{i:05d}') for i in range(athletes)
+    ])
+    social_accounts = SocialAccount.objects.bulk_create([
+        SocialAccount(user=user, provider='strava', uid=benchmark_strava_id(i)) for i, user in enumerate(users)
+    ])
+    # Already expired so the first Strava call of each athlete refreshes it
+    expired = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1)
+    SocialToken.objects.bulk_create([
+        SocialToken(account=sa, app=app, token=access_token(sa.uid), token_secret=refresh_token(sa.uid),
+                    expires_at=expired)
+        for sa in social_accounts
+    ])
+    for user in users:
+        Activity.objects.bulk_create(saved_activities(user, activities), batch_size=500)
+    rebuild_season_standings()
+    return social_accounts
+
+
+@contextlib.contextmanager
+def use_fake_strava(server: FakeStravaServer):
+    """Send Strava calls made inside this context to the fake server"""
+    with mock.patch.object(strava_activities, 'STRAVA_API_URL', server.url), \
+            mock.patch.object(strava_token, 'STRAVA_TOKEN_URL', f'{server.url}/oauth/token'):
+        yield
+
+
+@dataclasses.dataclass
+class Benchmark:
+    name: str
+    url: str
+    # Called before every run, outside the measurement, eg to clear caches or restore deleted rows
+    setup: Callable[[], None] = lambda: None
+
+
+@dataclasses.dataclass
+class Measurement:
+    status_code: int
+    seconds: float
+    queries: int
+
+
+def measure(client: Client, benchmark: Benchmark) -> Measurement:
+    benchmark.setup()
+    recorder = QueryRecorder()
+    with connection.execute_wrapper(recorder):
+        t_start = time.perf_counter()
+        response = client.get(benchmark.url)
+        seconds = time.perf_counter() - t_start
+    return Measurement(response.status_code, seconds, recorder.count)
+
+
+def peak_memory(client: Client, benchmark: Benchmark) -> int:
+    """Peak bytes allocated by Python during one run, measured separately because tracing slows everything"""
+    benchmark.setup()
+    tracemalloc.start()
+    try:
+        client.get(benchmark.url)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def view_benchmarks(social_account: SocialAccount, activities) -> list[Benchmark]:
+    """The benchmarks, all acting as one seeded athlete who is logged in"""
+    strava_id = social_account.uid
+    user = social_account.user
+
+    def clear_cache():
+        cache.clear()
+
+    def forget_listing():
+        invalidate_listing(strava_id)
+
+    def unsave_listed():
+        invalidate_listing(strava_id)
+        Activity.objects.filter(athlete=user, activity_id__gte=LISTING_ID_BASE).delete()
+        update_season_standings([user.pk])
+
+    def restore_saved():
+        if not Activity.objects.filter(athlete=user).exists():
+            Activity.objects.bulk_create(saved_activities(user, activities), batch_size=500)
+            update_season_standings([user.pk])
+
+    return [
+        Benchmark('index_page', reverse('index'), clear_cache),
+        Benchmark('index_page_cached', reverse('index')),
+        Benchmark('view_activities', reverse('view-activities', kwargs={'strava_id': strava_id}), clear_cache),
+        Benchmark('view_activities_cached', reverse('view-activities', kwargs={'strava_id': strava_id})),
+        Benchmark('fetch_and_view_activities',
+                  reverse('view-unsaved-activities-available-on-strava', kwargs={'strava_id': strava_id}),
+                  forget_listing),
+        Benchmark('fetch_and_save_activities', reverse('save-activities', kwargs={'strava_id': strava_id}),
+                  unsave_listed),
+        Benchmark('delete_activities', reverse('delete-activities', kwargs={'strava_id': strava_id}), restore_saved),
+    ]
+
+
+def run_benchmarks(athletes=100, activities=100, repeat=5, latency=0.0, listing_size=100, only=None) -> dict:
+    """
+    Seed the current (empty, test) database and run each benchmark once to warm up then repeat times.
+    Returns the results ready to dump as JSON.
+    """
+    t_start = time.perf_counter()
+    social_accounts = seed_athletes(athletes, activities)
+    seed_seconds = time.perf_counter() - t_start
+    client = Client()
+    client.force_login(social_accounts[0].user)
+    results = {}
+    with FakeStravaServer(latency=latency, listing_size=listing_size) as server, use_fake_strava(server):
+        for benchmark in view_benchmarks(social_accounts[0], activities):
+            if only and benchmark.name not in only:
+                continue
+            measure(client, benchmark)
+            runs = [measure(client, benchmark) for _ in range(repeat)]
+            seconds = [run.seconds for run in runs]
+            results[benchmark.name] = {
+                'status_code': runs[-1].status_code,
+                'queries': max(run.queries for run in runs),
+                'seconds_min': round(min(seconds), 6),
+                'seconds_median': round(statistics.median(seconds), 6),
+                'seconds_max': round(max(seconds), 6),
+                'peak_memory_bytes': peak_memory(client, benchmark),
+            }
+        strava_requests = server.request_count
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        },
+        'parameters': {'athletes': athletes, 'activities': activities, 'repeat': repeat, 'latency': latency,
+                       'listing_size': listing_size},
+        'seed_seconds': round(seed_seconds, 3),
+        'strava_requests': strava_requests,
+        'benchmarks': results,
+    }
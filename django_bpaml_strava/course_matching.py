@@ -0,0 +1,155 @@
+# Standard libraries
+import collections
+import logging
+import threading
+from typing import Sequence
+# Third-party libraries
+import numpy as np
+from django.conf import settings
+# Local libraries
+from django_bpaml_strava.models import Activity, ParkrunCourse
+from django_bpaml_strava.page_cache import bump_page_versions
+from django_bpaml_strava.polyline import METRES_PER_DEGREE, bounding_boxes, decode_polylines, hausdorff_distances
+from django_bpaml_strava.polyline import resample, to_metres
+from django_bpaml_strava.standings import update_season_standings
+
+logger = logging.getLogger(__name__)
+
+# Routes are resampled to this many points before comparing
+MATCH_POINTS = 48
+# A route matches a course when every point of each is within this many metres of the other
+MATCH_METRES = getattr(settings, 'BPAML_COURSE_MATCH_METRES', 150)
+# Number of route boxes checked against the course boxes at a time
+BBOX_CHUNK_SIZE = 4096
+
+_course_index = None
+_course_index_lock = threading.Lock()
+
+
+class CourseIndex:
+    """Known parkrun courses resampled for comparison, with bounding boxes to quickly rule out distant routes"""
+
+    def __init__(self, courses: Sequence[tuple[str, str]]):
+        """courses are (name, encoded polyline) pairs"""
+        names = [name for name, _ in courses]
+        decoded = decode_polylines([polyline for _, polyline in courses])
+        keep = [i for i, points in enumerate(decoded) if len(points) >= 2]
+        self.names = [names[i] for i in keep]
+        self.tracks = resample([decoded[i] for i in keep], MATCH_POINTS)
+        # Grow each box by the match distance so routes which only just match are still found.
+        # Doubled because a degree of longitude is shorter than a degree of latitude away from the equator
+        margin = 2 * MATCH_METRES / METRES_PER_DEGREE
+        self.bboxes = bounding_boxes([decoded[i] for i in keep]) + np.array([-margin, -margin, margin, margin])
+
+    def __len__(self):
+        return len(self.names)
+
+    def _overlaps(self, bboxes: np.ndarray) -> np.ndarray:
+        """(len(bboxes), len(courses)) boolean array of which route boxes overlap which course boxes"""
+        overlaps = np.empty((len(bboxes), len(self.names)), dtype=bool)
+        for start in range(0, len(bboxes), BBOX_CHUNK_SIZE):
+            b = bboxes[start:start + BBOX_CHUNK_SIZE, None, :]
+            c = self.bboxes[None, :, :]
+            overlaps[start:start + BBOX_CHUNK_SIZE] = ((b[..., 0] <= c[..., 2]) & (c[..., 0] <= b[..., 2])
+                                                       & (b[..., 1] <= c[..., 3]) & (c[..., 1] <= b[..., 3]))
+        return overlaps
+
+    def match(self, polylines: Sequence[str]) -> list[str | None]:
+        """Name of the closest matching course for each encoded polyline, or None"""
+        result = [None] * len(polylines)
+        if not self.names or not polylines:
+            return result
+        routes = decode_polylines(polylines)
+        valid = np.array([i for i, points in enumerate(routes) if len(points) >= 2], dtype=np.int64)
+        if not len(valid):
+            return result
+        valid_routes = [routes[i] for i in valid]
+        overlaps = self._overlaps(bounding_boxes(valid_routes))
+        # Only resample routes which are near at least one course
+        near = overlaps.any(axis=1)
+        valid, overlaps = valid[near], overlaps[near]
+        resampled = resample([r for r, n in zip(valid_routes, near) if n], MATCH_POINTS)
+        best = np.full(len(valid), np.inf)
+        best_course = np.full(len(valid), -1)
+        for course in np.flatnonzero(overlaps.any(axis=0)):
+            # Compare every route near this course in one broadcast
+            candidates = np.flatnonzero(overlaps[:, course])
+            track = self.tracks[course]
+            origin = track.mean(axis=0)
+            distances = hausdorff_distances(to_metres(resampled[candidates], origin), to_metres(track, origin))
+            better = (distances <= MATCH_METRES) & (distances < best[candidates])
+            best[candidates[better]] = distances[better]
+            best_course[candidates[better]] = course
+        for i, course in zip(valid, best_course):
+            if course >= 0:
+                result[i] = self.names[course]
+        return result
+
+
+def get_course_index() -> CourseIndex:
+    """The index of every ParkrunCourse, built once per process until a course changes"""
+    global _course_index
+    if _course_index is None:
+        with _course_index_lock:
+            if _course_index is None:
+                _course_index = CourseIndex(list(ParkrunCourse.objects.values_list('name', 'polyline')))
+    return _course_index
+
+
+def clear_course_index():
+    """Rebuild the index next time it is needed, eg after a course is added"""
+    global _course_index
+    _course_index = None
+
+
+def assign_locations(activities: Sequence[Activity]) -> int:
+    """Set location on activities whose route matches a known course. Returns the number matched"""
+    course_index = get_course_index()
+    if not len(course_index):
+        return 0
+    matched = 0
+    for activity, name in zip(activities, course_index.match([a.polyline for a in activities])):
+        if name is not None:
+            activity.location = name
+            matched += 1
+    return matched
+
+
+def rematch_locations(queryset=None, rematch_all=False, batch_size=5000) -> int:
+    """
+    Match saved activities to courses and save their location with one UPDATE per course per batch.
+    Only activities without a location are matched unless rematch_all, when the location of an activity
+    matching no course is cleared. Activities with an official result are never matched as their location
+    is the event name from the result. Returns the number matched.
+    """
+    if queryset is None:
+        queryset = Activity.objects.all()
+    queryset = queryset.filter(parkrun_duration__isnull=True)
+    if not rematch_all:
+        queryset = queryset.filter(location='')
+    course_index = get_course_index()
+    matched = cleared = 0
+    last_pk = 0
+    athlete_ids = set()
+    while batch := list(queryset.filter(pk__gt=last_pk).order_by('pk')
+                        .values_list('pk', 'athlete_id', 'polyline', 'location')[:batch_size]):
+        last_pk = batch[-1][0]
+        pks_by_location = collections.defaultdict(list)
+        for (pk, athlete_id, _, location), name in zip(batch, course_index.match([row[2] for row in batch])):
+            if name is not None:
+                matched += 1
+            elif location:
+                # Only reached when rematch_all. location isn't nullable so no location is ''
+                name = ''
+                cleared += 1
+            if name is not None and name != location:
+                pks_by_location[name].append(pk)
+                athlete_ids.add(athlete_id)
+        for location, pks in pks_by_location.items():
+            Activity.objects.filter(pk__in=pks).update(location=location)
+    # Whether an activity counts as a parkrun in the standings depends on its location
+    update_season_standings(athlete_ids)
+    bump_page_versions(athlete_ids)
+    logger.info("Matched %s activities to %s parkrun courses and cleared %s locations",
+                matched, len(course_index), cleared)
+    return matched
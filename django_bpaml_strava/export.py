@@ -0,0 +1,96 @@
+"""
+Export every saved activity as CSV or NDJSON (one JSON object per line).
+Rows are read with a server side chunked iterator and written one at a time, so memory use doesn't grow
+with the number of activities whether streamed to an HTTP response or to a file.
+"""
+# Standard libraries
+import csv
+import datetime
+import itertools
+import json
+from typing import Iterable, Iterator
+# Third-party libraries
+from allauth.socialaccount.models import SocialAccount
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, OuterRef, Subquery
+# Local libraries
+from django_bpaml_strava.models import Activity
+
+# Rows fetched from the database at a time
+EXPORT_CHUNK_SIZE = 2000
+# Lines joined into each chunk of a streamed response, far fewer chunks than one per line
+LINES_PER_CHUNK = 500
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+EXPORT_FIELDS = ('strava_id', 'first_name', 'last_name', 'activity_id', 'date', 'start_time', 'start_time_local',
+                 'timezone', 'title', 'location', 'distance', 'strava_duration', 'parkrun_duration')
+
+
+def export_queryset(season: int = None, strava_id: str = None, location: str = None, user_id: int = None):
+    """
+    Activities in id order as dicts of EXPORT_FIELDS, optionally for one season, athlete (by Strava id
+    or user id) or location
+    """
+    strava_uid = (SocialAccount.objects.filter(provider='strava', user_id=OuterRef('athlete_id'))
+                  .values('uid')[:1])
+    activities = Activity.objects.all()
+    if season is not None:
+        # A date range rather than date__year so the date indexes can be used
+        activities = activities.filter(date__gte=datetime.date(season, 1, 1), date__lt=datetime.date(season + 1, 1, 1))
+    if strava_id is not None:
+        activities = activities.filter(athlete__socialaccount__provider='strava', athlete__socialaccount__uid=strava_id)
+    if user_id is not None:
+        activities = activities.filter(athlete_id=user_id)
+    if location is not None:
+        activities = activities.filter(location=location)
+    return (activities
+            .annotate(strava_id=Subquery(strava_uid), first_name=F('athlete__first_name'),
+                      last_name=F('athlete__last_name'))
+            .order_by('id')
+            .values(*EXPORT_FIELDS))
+
+
+def export_rows(season: int = None, strava_id: str = None, location: str = None,
+                user_id: int = None) -> Iterator[dict]:
+    """Stream the exported activities, with durations in seconds like the JSON API"""
+    for row in export_queryset(season, strava_id, location, user_id).iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        for key in ('strava_duration', 'parkrun_duration'):
+            row[key] = row[key] and row[key].total_seconds()
+        yield row
+
+
+class _Line:
+    """File-like object whose write returns the line so csv.writer can be used as a generator"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows: Iterable[dict]) -> Iterator[str]:
+    writer = csv.DictWriter(_Line(), fieldnames=EXPORT_FIELDS)
+    yield writer.writeheader()
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def ndjson_lines(rows: Iterable[dict]) -> Iterator[str]:
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+
+def export_lines(export_format: str, rows: Iterable[dict]) -> Iterator[str]:
+    """Lines of the export in export_format, one of EXPORT_FORMATS"""
+    if export_format == 'csv':
+        return csv_lines(rows)
+    if export_format == 'ndjson':
+        return ndjson_lines(rows)
+    raise ValueError(f"Unknown export format {export_format}")
+
+
+def export_chunks(export_format: str, rows: Iterable[dict]) -> Iterator[str]:
+    """The export in strings of LINES_PER_CHUNK lines, for a StreamingHttpResponse"""
+    lines = export_lines(export_format, rows)
+    while chunk := ''.join(itertools.islice(lines, LINES_PER_CHUNK)):
+        yield chunk
@@ -0,0 +1,194 @@
+"""
+A local stand-in for the parts of the Strava API we use, for benchmarks and offline development.
+It serves paginated activity listings, single activities, activity streams and token refreshes with Strava's
+rate limit headers, after an optional delay to mimic the network.
+Athletes are identified by access tokens 'token-<strava_id>'.
+"""
+# Standard libraries
+import datetime
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+# Local libraries
+from django_bpaml_strava.strava_activities import first_quarter_window
+
+# Google's example polyline, a short valid route so activities exercise course matching
+FAKE_POLYLINE = '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+FAKE_TIMEZONE = '(GMT+10:00) Australia/Brisbane'
+# Listing activity ids start here so they never clash with seeded saved activities
+LISTING_ID_BASE = 10 ** 9
+
+
+def access_token(strava_id) -> str:
+    return f'token-{strava_id}'
+
+
+def refresh_token(strava_id) -> str:
+    return f'refresh-{strava_id}'
+
+
+def strava_activity(activity_id, start_time: datetime.datetime, distance=5000.0, elapsed_seconds=1500,
+                    name=None) -> dict:
+    """An activity summary in the format Strava returns. start_time must be aware"""
+    local_offset = datetime.timedelta(hours=10)
+    return {
+        'id': activity_id,
+        'name': name or f'Run {activity_id}',
+        'distance': distance,
+        'elapsed_time': elapsed_seconds,
+        'moving_time': elapsed_seconds - 10,
+        'timezone': FAKE_TIMEZONE,
+        'start_date': start_time.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'start_date_local': (start_time.astimezone(datetime.timezone.utc) + local_offset).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'map': {'summary_polyline': FAKE_POLYLINE},
+    }
+
+
+def listing_activities(strava_id, count, year=None) -> list[dict]:
+    """
+    The same count activities for the athlete every time, spread over the first quarter of the year
+    so the default listing returns them all. About one in five is a Saturday morning parkrun.
+    """
+    rng = random.Random(f'{strava_id}-{year}')
+    start, end = first_quarter_window(year)
+    span = (end - start).total_seconds()
+    activities = []
+    for i in range(count):
+        activity_id = LISTING_ID_BASE + i
+        day = start + datetime.timedelta(seconds=span * i / max(count, 1))
+        if rng.random() < 0.2:
+            # Move to the Saturday 7am parkrun of that week
+            saturday = day + datetime.timedelta(days=(5 - day.weekday()) % 7)
+            if saturday < end:
+                activities.append(strava_activity(activity_id, saturday.replace(hour=7, minute=0, second=0),
+                                                  distance=rng.uniform(4900, 5100), name=f'parkrun {i}',
+                                                  elapsed_seconds=rng.randint(1100, 2400)))
+                continue
+        activities.append(strava_activity(activity_id, day, distance=rng.uniform(2000, 20000),
+                                          elapsed_seconds=rng.randint(600, 7200)))
+    return activities
+
+
+def strava_streams(activity: dict) -> dict:
+    """
+    Streams of an activity as Strava returns them with key_by_type=true: one point a second at an even pace
+    heading north, after standing still for the first ten seconds
+    """
+    seconds = activity['elapsed_time']
+    times = list(range(seconds + 1))
+    distances = [max(0, t - 10) * activity['distance'] / (seconds - 10) for t in times]
+    return {
+        'time': {'data': times, 'series_type': 'distance', 'original_size': len(times), 'resolution': 'high'},
+        'distance': {'data': distances, 'series_type': 'distance', 'original_size': len(times), 'resolution': 'high'},
+        'latlng': {'data': [[-27.47 + d / 111_320, 153.02] for d in distances], 'series_type': 'distance',
+                   'original_size': len(times), 'resolution': 'high'},
+        'heartrate': {'data': [min(180, 90 + t // 10) for t in times], 'series_type': 'distance',
+                      'original_size': len(times), 'resolution': 'high'},
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: 'FakeStravaServer'
+
+    def log_message(self, format, *args):
+        # Keep benchmark output clean
+        pass
+
+    def _send(self, status, data):
+        body = json.dumps(data).encode()
+        usage = self.server.count_request()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-RateLimit-Limit', ','.join(str(limit) for limit in self.server.rate_limits))
+        self.send_header('X-RateLimit-Usage', f'{usage},{usage}')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _strava_id(self):
+        authorization = self.headers.get('Authorization', '')
+        if authorization.startswith('Bearer token-'):
+            return authorization.removeprefix('Bearer token-')
+        return None
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        strava_id = self._strava_id()
+        if strava_id is None:
+            return self._send(401, {'message': 'Authorization Error'})
+        activities = self.server.activities(strava_id)
+        if url.path.endswith('/athlete/activities'):
+            after = datetime.datetime.fromtimestamp(int(query.get('after', 0)), datetime.timezone.utc)
+            before = datetime.datetime.fromtimestamp(int(query.get('before', 2 ** 32)), datetime.timezone.utc)
+            selected = [a for a in activities.values()
+                        if after < datetime.datetime.fromisoformat(a['start_date']) < before]
+            page, per_page = int(query.get('page', 1)), int(query.get('per_page', 30))
+            return self._send(200, selected[(page - 1) * per_page:page * per_page])
+        if url.path.endswith('/streams'):
+            activity = activities.get(int(url.path.rsplit('/', 2)[1]))
+            if activity is not None:
+                return self._send(200, strava_streams(activity))
+        elif '/activities/' in url.path:
+            activity = activities.get(int(url.path.rsplit('/', 1)[1]))
+            if activity is not None:
+                return self._send(200, activity)
+        return self._send(404, {'message': 'Record Not Found'})
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        length = int(self.headers.get('Content-Length', 0))
+        form = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+        if self.path.endswith('/oauth/token') and form.get('refresh_token', '').startswith('refresh-'):
+            strava_id = form['refresh_token'].removeprefix('refresh-')
+            expires_at = int(time.time()) + 6 * 60 * 60
+            return self._send(200, {'access_token': access_token(strava_id), 'refresh_token': refresh_token(strava_id),
+                                    'expires_at': expires_at, 'expires_in': 6 * 60 * 60})
+        return self._send(400, {'message': 'Bad Request'})
+
+
+class FakeStravaServer(ThreadingHTTPServer):
+    """
+    Fake Strava API on localhost, serving listing_size activities for any athlete.
+    Use as a context manager, which runs it in a background thread, and point BPAML_STRAVA_API_URL at url.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, listing_size=100, rate_limits=(100_000, 1_000_000)):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.latency = latency
+        self.listing_size = listing_size
+        self.rate_limits = rate_limits
+        self.request_count = 0
+        self._lock = threading.Lock()
+        self._activities = {}
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/api/v3'
+
+    def activities(self, strava_id) -> dict[int, dict]:
+        with self._lock:
+            if strava_id not in self._activities:
+                self._activities[strava_id] = {a['id']: a for a in listing_activities(strava_id, self.listing_size)}
+            return self._activities[strava_id]
+
+    def count_request(self) -> int:
+        with self._lock:
+            self.request_count += 1
+            return self.request_count
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-strava', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
@@ -0,0 +1,114 @@
+# Standard libraries
+import datetime
+import functools
+import itertools
+import logging
+import time
+import zoneinfo
+from typing import Iterable, Iterator
+# Third-party libraries
+from django.conf import settings
+# Local libraries
+from django_bpaml_strava.course_matching import assign_locations
+from django_bpaml_strava.database import serialized_writer
+from django_bpaml_strava.models import Activity, User
+from django_bpaml_strava.page_cache import bump_page_versions
+from django_bpaml_strava.polyline import route_hash
+from django_bpaml_strava.standings import update_season_standings
+
+logger = logging.getLogger(__name__)
+
+# Number of activities written by each INSERT statement. Can be overridden in settings.
+INGEST_BATCH_SIZE = getattr(settings, 'BPAML_INGEST_BATCH_SIZE', 500)
+
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(name: str) -> zoneinfo.ZoneInfo:
+    """Cached ZoneInfo lookup as only a handful of timezones appear in a club's activities"""
+    return zoneinfo.ZoneInfo(name)
+
+
+def parse_strava_timezone(strava_timezone: str) -> str:
+    """Strava timezone looks like '(GMT+10:00) Australia/Brisbane'. Return just the IANA name"""
+    return strava_timezone.split(' ')[1]
+
+
+def parse_strava_datetime(value: str) -> datetime.datetime:
+    """
+    Strava timestamps look like '2025-01-04T20:01:02Z'. Returns a naive datetime.
+    fromisoformat is implemented in C and is much faster than strptime.
+    """
+    return datetime.datetime.fromisoformat(value.removesuffix('Z'))
+
+
+def activity_from_strava(user: User, dct_activity) -> Activity:
+    """
+    Given the json data for a single activity from Strava (already converted to a dict)
+    return an unsaved Activity linked to the correct User.
+    """
+    timezone = parse_strava_timezone(dct_activity['timezone'])
+    tz = get_timezone(timezone)
+    start_time = parse_strava_datetime(dct_activity["start_date"]).replace(tzinfo=datetime.timezone.utc).astimezone(tz)
+    start_time_local = parse_strava_datetime(dct_activity["start_date_local"])
+    polyline = dct_activity["map"]["summary_polyline"]
+    return Activity(
+        athlete=user,
+        activity_id=dct_activity["id"],
+        date=start_time.date(),
+        start_time=start_time,
+        start_time_local=start_time_local,
+        timezone=timezone,
+        distance=dct_activity["distance"],
+        title=dct_activity["name"],
+        strava_duration=datetime.timedelta(seconds=dct_activity["elapsed_time"]),
+        polyline=polyline,
+        route_hash=route_hash(polyline),
+    )
+
+
+def decode_activities(user: User, activities: Iterable[dict]) -> Iterator[Activity]:
+    """Lazily convert a list or stream of Strava activity dicts into unsaved Activity objects"""
+    for dct_activity in activities:
+        yield activity_from_strava(user, dct_activity)
+
+
+def bulk_save_activities(activities: Iterable[Activity], batch_size: int = INGEST_BATCH_SIZE) -> int:
+    """
+    Save unsaved Activity objects using one INSERT per batch_size activities, all inside one transaction.
+    activities may be a generator, in which case it is consumed one batch at a time.
+    Activities whose route matches a known parkrun course get its name as location.
+    Activities already saved for the same athlete are skipped by the database.
+    The season standings of the athletes are updated in the same transaction.
+    Returns the number of activities inserted, not counting those skipped.
+    """
+    count = inserted = batches = 0
+    t_start = time.perf_counter()
+    iterator = iter(activities)
+    athlete_ids = set()
+    seasons = set()
+    # One bulk writer at a time so concurrent syncs queue rather than fail with "database is locked"
+    with serialized_writer():
+        while batch := list(itertools.islice(iterator, batch_size)):
+            assign_locations(batch)
+            # bulk_create doesn't say how many rows ignore_conflicts skipped, so count the athletes' rows
+            # before and after using the athlete indexes. Nothing else writes in between
+            batch_athlete_ids = {a.athlete_id for a in batch}
+            before = Activity.objects.filter(athlete_id__in=batch_athlete_ids).count()
+            Activity.objects.bulk_create(batch, batch_size=batch_size, ignore_conflicts=True)
+            inserted += Activity.objects.filter(athlete_id__in=batch_athlete_ids).count() - before
+            athlete_ids.update(batch_athlete_ids)
+            seasons.update(a.date.year for a in batch)
+            count += len(batch)
+            batches += 1
+        # bulk_create doesn't send post_save so update the standings of the seasons saved into and cached pages here
+        update_season_standings(athlete_ids, seasons)
+        bump_page_versions(athlete_ids)
+    # One summary for the whole ingest rather than a line per activity
+    logger.info("Submitted %s activities for %s athletes in %s batches, inserted %s, in %.3fs",
+                count, len(athlete_ids), batches, inserted, time.perf_counter() - t_start)
+    return inserted
+
+
+def ingest_activities(user: User, activities: Iterable[dict], batch_size: int = INGEST_BATCH_SIZE) -> int:
+    """Decode Strava activity dicts for user and save them in bulk. Returns the number inserted"""
+    return bulk_save_activities(decode_activities(user, activities), batch_size=batch_size)
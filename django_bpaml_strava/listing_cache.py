@@ -0,0 +1,72 @@
+# Standard libraries
+import logging
+# Third-party libraries
+from django.conf import settings
+from django.core.cache import cache
+# Local libraries
+from django_bpaml_strava.strava_activities import afetch_activities_from_strava, fetch_activities_from_strava
+
+logger = logging.getLogger(__name__)
+
+# Seconds an athlete's Strava activity listing is kept. Can be overridden in settings.
+LISTING_TTL = getattr(settings, 'BPAML_STRAVA_LISTING_TTL', 10 * 60)
+
+
+def _listing_key(strava_id):
+    return f'strava-listing:{strava_id}'
+
+
+def fetch_listing(strava_id) -> list[dict]:
+    """The athlete's Strava activities for the default window, from the cache if fetched within LISTING_TTL"""
+    key = _listing_key(strava_id)
+    listing = cache.get(key)
+    if listing is None:
+        listing = list(fetch_activities_from_strava(strava_id))
+        cache.set(key, listing, LISTING_TTL)
+    else:
+        logger.debug("Using cached listing of %s activities for athlete %s", len(listing), strava_id)
+    return listing
+
+
+async def afetch_listing(strava_id) -> list[dict]:
+    """Async version of fetch_listing"""
+    key = _listing_key(strava_id)
+    listing = await cache.aget(key)
+    if listing is None:
+        listing = [dct_activity async for dct_activity in afetch_activities_from_strava(strava_id)]
+        await cache.aset(key, listing, LISTING_TTL)
+    else:
+        logger.debug("Using cached listing of %s activities for athlete %s", len(listing), strava_id)
+    return listing
+
+
+def get_cached_listing(strava_id) -> list[dict] | None:
+    """The athlete's cached listing without going to Strava, or None if it isn't cached"""
+    return cache.get(_listing_key(strava_id))
+
+
+def _find_activity(listing, activity_id):
+    if listing is not None:
+        for dct_activity in listing:
+            if dct_activity['id'] == activity_id:
+                return dct_activity
+    return None
+
+
+def cached_activity(strava_id, activity_id) -> dict | None:
+    """The summary of one activity from the athlete's cached listing, or None if it isn't cached"""
+    return _find_activity(get_cached_listing(strava_id), activity_id)
+
+
+async def acached_activity(strava_id, activity_id) -> dict | None:
+    """Async version of cached_activity"""
+    return _find_activity(await cache.aget(_listing_key(strava_id)), activity_id)
+
+
+def invalidate_listing(strava_id):
+    """Forget the athlete's cached listing so the next fetch goes to Strava"""
+    cache.delete(_listing_key(strava_id))
+
+
+async def ainvalidate_listing(strava_id):
+    await cache.adelete(_listing_key(strava_id))
@@ -0,0 +1,96 @@
+"""
+Logging which doesn't slow down requests. Used by settings.LOGGING.
+BackgroundHandler queues records and a listener thread formats and writes them, so a slow console or file
+never holds up a request. Records are only formatted in the listener, so per activity messages logged
+lazily with %s arguments at DEBUG cost almost nothing when DEBUG is off, and RateLimitFilter lets through
+only a sample of repeated chatter when it is on.
+"""
+# Standard libraries
+import atexit
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Hands records to a listener thread which passes them to target, a StreamHandler to stderr by default.
+    The formatter set on this handler is used by the target.
+    """
+
+    def __init__(self, target: logging.Handler = None):
+        super().__init__(queue.SimpleQueue())
+        self.target = target or logging.StreamHandler()
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+        self._stopped = False
+        # Write out anything still queued when the process exits
+        atexit.register(self.stop)
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # QueueHandler formats the message here, in the logging thread, so it can be pickled.
+        # The queue never leaves this process so leave formatting to the listener.
+        return record
+
+    def stop(self):
+        """Wait for the listener to write every queued record then stop it"""
+        if not self._stopped:
+            self._stopped = True
+            self.listener.stop()
+
+    def close(self):
+        self.stop()
+        super().close()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most rate records with the same logger and message template in each period of per seconds.
+    The first record of the next period says how many were dropped. Records above max_level, eg warnings, always pass.
+    Counters are swept once a period so messages which stop repeating don't build up.
+    """
+
+    def __init__(self, rate=10, per=60.0, max_level='INFO'):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self.max_level = logging.getLevelName(max_level) if isinstance(max_level, str) else max_level
+        self._lock = threading.Lock()
+        # (logger, template) -> [period start, records in the period, records dropped]
+        self._counts: dict[tuple[str, str], list] = {}
+        self._swept_at = time.monotonic()
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            if now - self._swept_at >= self.per:
+                self._sweep(now)
+            counts = self._counts.get(key)
+            if counts is None or now - counts[0] >= self.per:
+                dropped = counts[2] if counts is not None else 0
+                self._counts[key] = [now, 1, 0]
+                if dropped:
+                    record.msg = f"{record.msg} [{dropped} similar messages dropped]"
+                return True
+            counts[1] += 1
+            if counts[1] <= self.rate:
+                return True
+            counts[2] += 1
+            return False
+
+    def _sweep(self, now):
+        """
+        Forget counters whose period is over. Those which dropped records are kept for another period
+        so the next record can still say how many were dropped.
+        """
+        self._swept_at = now
+        self._counts = {key: counts for key, counts in self._counts.items()
+                        if now - counts[0] < (2 * self.per if counts[2] else self.per)}
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from django_bpaml_strava.models import Activity, ParkrunCourse
+
+
+class Command(BaseCommand):
+    help = 'Add or update a known parkrun course using the route of a saved activity or an encoded polyline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', help='course name saved as the location of matching activities, eg "New Farm"')
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--activity', type=int, help='strava id of a saved activity which ran the whole course')
+        source.add_argument('--polyline', help='encoded polyline of the course')
+
+    def handle(self, *args, **options):
+        polyline = options['polyline']
+        if options['activity'] is not None:
+            activity = Activity.objects.filter(activity_id=options['activity']).only('polyline').first()
+            if activity is None:
+                raise CommandError(f'Activity {options["activity"]} has not been saved')
+            polyline = activity.polyline
+        if not polyline:
+            raise CommandError('Course route is empty')
+        course, created = ParkrunCourse.objects.update_or_create(name=options['name'], defaults={'polyline': polyline})
+        if created:
+            self.stdout.write(self.style.SUCCESS(f'Created parkrun course: {course.name}'))
+        else:
+            self.stdout.write(self.style.WARNING(f'Updated parkrun course: {course.name}'))
@@ -0,0 +1,54 @@
+import datetime
+from allauth.socialaccount.models import SocialAccount
+from django.core.management.base import BaseCommand
+
+from django_bpaml_strava.backfill import BACKFILL_WINDOW_DAYS, BACKFILL_WORKERS, backfill_athlete
+from django_bpaml_strava.models import BackfillWindow
+from django_bpaml_strava.rate_limit import StravaRateLimited
+from django_bpaml_strava.strava_client import StravaError
+
+
+class Command(BaseCommand):
+    help = ('Fetch and save the parkruns in a date range of each athlete\'s Strava history, several windows '
+            'at a time. An interrupted backfill carries on from the windows it had not finished when run again')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=datetime.date.fromisoformat, default=datetime.date(2009, 1, 1),
+                            help='first date (YYYY-MM-DD), default 2009-01-01 when Strava started')
+        parser.add_argument('--end', type=datetime.date.fromisoformat, default=datetime.date.today(),
+                            help='last date (YYYY-MM-DD), default today')
+        parser.add_argument('--athlete', action='append', dest='strava_ids', metavar='STRAVA_ID',
+                            help='only backfill this athlete (may be repeated)')
+        parser.add_argument('--window-days', type=int, default=BACKFILL_WINDOW_DAYS, help='days in each window')
+        parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS,
+                            help='windows fetched concurrently for each athlete')
+        parser.add_argument('--restart', action='store_true',
+                            help='forget finished windows in the range and fetch them again')
+
+    def handle(self, *args, **options):
+        social_accounts = SocialAccount.objects.filter(provider='strava').select_related('user')
+        if options['strava_ids']:
+            social_accounts = social_accounts.filter(uid__in=options['strava_ids'])
+        if options['restart']:
+            BackfillWindow.objects.filter(athlete__socialaccount__in=social_accounts,
+                                          before__date__gte=options['start'], after__date__lte=options['end']).delete()
+
+        def progress(window):
+            self.stdout.write(f'Athlete {window["strava_id"]}: {window["after"]:%d-%b-%Y} to '
+                              f'{window["before"]:%d-%b-%Y} fetched {window["fetched"]}, saved {window["saved"]}')
+
+        for social_account in social_accounts:
+            try:
+                result = backfill_athlete(social_account, options['start'], options['end'],
+                                          window_days=options['window_days'], workers=options['workers'],
+                                          progress=progress)
+            except StravaRateLimited as e:
+                self.stdout.write(self.style.ERROR(f'{e}. Run again later to resume'))
+                return
+            except StravaError as e:
+                self.stdout.write(self.style.ERROR(f'Athlete {social_account.uid}: {e}'))
+                continue
+            self.stdout.write(self.style.SUCCESS(
+                f'Athlete {result["strava_id"]}: {result["windows"] - result["skipped"]} of {result["windows"]} '
+                f'windows fetched {result["fetched"]}, saved {result["saved"]} in {result["seconds"]:.1f}s'
+            ))
@@ -0,0 +1,60 @@
+import json
+import logging
+import warnings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from django_bpaml_strava.benchmark import run_benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the main views against seeded athletes and a local fake Strava server, '
+            'recording wall time, query count and peak memory as JSON. '
+            'Uses a throwaway test database and cache so real data is not touched')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--athletes', type=int, default=100, help='number of athletes to seed')
+        parser.add_argument('--activities', type=int, default=100, help='saved activities per athlete')
+        parser.add_argument('--listing', type=int, default=100, dest='listing_size',
+                            help='activities in each athlete\'s fake Strava listing')
+        parser.add_argument('--repeat', type=int, default=5, help='measured runs of each benchmark')
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='seconds the fake Strava server waits before each response')
+        parser.add_argument('--only', action='append', metavar='NAME', help='only run this benchmark (may be repeated)')
+        parser.add_argument('--output', help='write the JSON results to this file')
+        parser.add_argument('--compare', metavar='FILE', help='compare with the JSON results of an earlier run')
+
+    def handle(self, *args, **options):
+        # The views log every Strava call and activity, which would swamp the results
+        logging.disable(logging.INFO)
+        # Strava's start_date_local is saved as a naive datetime, which warns for every seeded activity
+        warnings.filterwarnings('ignore', r'DateTimeField .* received a naive datetime', RuntimeWarning)
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                                   BPAML_QUERY_BUDGET_STRICT=False):
+                results = run_benchmarks(athletes=options['athletes'], activities=options['activities'],
+                                         repeat=options['repeat'], latency=options['latency'],
+                                         listing_size=options['listing_size'], only=options['only'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            logging.disable(logging.NOTSET)
+        previous = {}
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)['benchmarks']
+        for name, result in results['benchmarks'].items():
+            line = (f'{name:28} {result["status_code"]} {result["seconds_median"] * 1000:9.1f}ms '
+                    f'{result["queries"]:4} queries {result["peak_memory_bytes"] / 1024:9.0f}KiB')
+            if name in previous:
+                before = previous[name]
+                line += (f'  ({result["seconds_median"] / before["seconds_median"]:.2f}x time, '
+                         f'{result["queries"] - before["queries"]:+d} queries)')
+            self.stdout.write(line)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS(f'Wrote results to {options["output"]}'))
@@ -0,0 +1,43 @@
+import time
+from allauth.socialaccount.models import SocialAccount
+from django.core.management.base import BaseCommand
+
+from django_bpaml_strava.models import Activity
+from django_bpaml_strava.parkrun import get_parkrun_rules, reclassify_cached_listings, reclassify_saved_activities
+from django_bpaml_strava.page_cache import bump_page_versions
+from django_bpaml_strava.standings import update_season_standings
+
+
+class Command(BaseCommand):
+    help = ('Re-apply the parkrun rules to saved activities and to cached Strava listings without calling Strava. '
+            'Reports saved activities which are no longer parkruns and saves new parkruns found in cached listings')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--athlete', action='append', dest='strava_ids', metavar='STRAVA_ID',
+                            help='only classify this athlete (may be repeated)')
+        parser.add_argument('--delete', action='store_true',
+                            help='delete saved activities which are no longer parkruns')
+        parser.add_argument('--no-cached', action='store_false', dest='cached',
+                            help='do not save new parkruns from cached Strava listings')
+
+    def handle(self, *args, **options):
+        t_start = time.perf_counter()
+        rules = get_parkrun_rules()
+        activities = Activity.objects.all()
+        social_accounts = SocialAccount.objects.filter(provider='strava').select_related('user')
+        if options['strava_ids']:
+            activities = activities.filter(athlete__socialaccount__provider='strava',
+                                           athlete__socialaccount__uid__in=options['strava_ids'])
+            social_accounts = social_accounts.filter(uid__in=options['strava_ids'])
+        kept, rejected = reclassify_saved_activities(activities, rules)
+        self.stdout.write(f'{len(kept)} saved activities are parkruns, {len(rejected)} are not')
+        if rejected and options['delete']:
+            athlete_ids = set(Activity.objects.filter(pk__in=rejected).values_list('athlete_id', flat=True))
+            deleted, _ = Activity.objects.filter(pk__in=rejected).delete()
+            update_season_standings(athlete_ids)
+            bump_page_versions(athlete_ids)
+            self.stdout.write(self.style.WARNING(f'Deleted {deleted} activities which are not parkruns'))
+        if options['cached']:
+            for strava_id, saved in reclassify_cached_listings(social_accounts, rules).items():
+                self.stdout.write(self.style.SUCCESS(f'Athlete {strava_id}: saved {saved} from cached listing'))
+        self.stdout.write(f'Classified in {time.perf_counter() - t_start:.2f}s')
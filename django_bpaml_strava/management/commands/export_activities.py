@@ -0,0 +1,31 @@
+import sys
+from django.core.management.base import BaseCommand
+
+from django_bpaml_strava.export import EXPORT_FORMATS, export_lines, export_rows
+
+
+class Command(BaseCommand):
+    help = 'Export saved activities as CSV or NDJSON, streaming rows so any number can be exported'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='csv', dest='export_format')
+        parser.add_argument('--season', type=int, help='only activities in this year')
+        parser.add_argument('--athlete', dest='strava_id', metavar='STRAVA_ID', help='only this athlete')
+        parser.add_argument('--location', help='only activities at this parkrun')
+        parser.add_argument('--output', help='file to write, default standard output')
+
+    def handle(self, *args, **options):
+        rows = export_rows(season=options['season'], strava_id=options['strava_id'], location=options['location'])
+        output = open(options['output'], 'w', newline='') if options['output'] else sys.stdout
+        count = 0
+        try:
+            for line in export_lines(options['export_format'], rows):
+                output.write(line)
+                count += 1
+        finally:
+            if options['output']:
+                output.close()
+        if options['output']:
+            # The header is the first line of CSV
+            rows_written = count - 1 if options['export_format'] == 'csv' else count
+            self.stdout.write(self.style.SUCCESS(f'Exported {rows_written} activities to {options["output"]}'))
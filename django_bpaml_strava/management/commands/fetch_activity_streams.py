@@ -0,0 +1,54 @@
+import time
+from allauth.socialaccount.models import SocialAccount
+from django.core.management.base import BaseCommand
+
+from django_bpaml_strava.models import Activity
+from django_bpaml_strava.rate_limit import StravaRateLimited
+from django_bpaml_strava.streams import delete_orphan_streams, fetch_athlete_streams, recalculate_activity_values
+from django_bpaml_strava.strava_client import StravaError
+
+
+class Command(BaseCommand):
+    help = ('Fetch the Strava streams of saved activities which don\'t have them yet and work out their splits, '
+            'fastest 5 km and parkrun distance duration. Run again later to carry on after hitting the rate limit')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--athlete', action='append', dest='strava_ids', metavar='STRAVA_ID',
+                            help='only fetch streams of this athlete (may be repeated)')
+        parser.add_argument('--limit', type=int, help='most activities fetched for each athlete')
+        parser.add_argument('--refetch', action='store_true',
+                            help='fetch the streams of every saved activity, including those which have them')
+        parser.add_argument('--recalculate', action='store_true',
+                            help='work out the values again from saved streams without calling Strava')
+
+    def handle(self, *args, **options):
+        t_start = time.perf_counter()
+        deleted = delete_orphan_streams()
+        if deleted:
+            self.stdout.write(f'Deleted the streams of {deleted} deleted activities')
+        social_accounts = SocialAccount.objects.filter(provider='strava').select_related('user')
+        if options['strava_ids']:
+            social_accounts = social_accounts.filter(uid__in=options['strava_ids'])
+        if options['recalculate']:
+            activities = Activity.objects.filter(athlete__socialaccount__in=social_accounts)
+            updated = recalculate_activity_values(activities if options['strava_ids'] else None)
+            self.stdout.write(self.style.SUCCESS(
+                f'Recalculated {updated} activities in {time.perf_counter() - t_start:.2f}s'))
+            return
+        for social_account in social_accounts:
+            activities = None
+            if options['refetch']:
+                activities = (Activity.objects.filter(athlete=social_account.user, activity_id__isnull=False)
+                              .order_by('-date').only('athlete_id', 'activity_id'))
+            try:
+                result = fetch_athlete_streams(social_account, activities, limit=options['limit'])
+            except StravaRateLimited as e:
+                self.stdout.write(self.style.ERROR(f'{e}. Run again later to carry on'))
+                return
+            except StravaError as e:
+                self.stdout.write(self.style.ERROR(f'Athlete {social_account.uid}: {e}'))
+                continue
+            self.stdout.write(self.style.SUCCESS(
+                f'Athlete {result["strava_id"]}: fetched {result["fetched"]} streams, {result["missing"]} activities '
+                f'no longer on Strava, in {result["seconds"]:.1f}s'
+            ))
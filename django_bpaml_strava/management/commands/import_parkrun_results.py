@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from django_bpaml_strava.parkrun_results import import_results, read_results
+
+
+class Command(BaseCommand):
+    help = ('Import official parkrun results from CSV files of parkrun_id, date, event, time. '
+            'Saved activities of athletes with that parkrun id on that date get the official time and event')
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', metavar='FILE', help='results CSV file')
+        parser.add_argument('--dry-run', action='store_true', help='report matches without saving them')
+
+    def handle(self, *args, **options):
+        results = []
+        for path in options['files']:
+            with open(path, newline='') as f:
+                file_results, errors = read_results(f)
+            results.extend(file_results)
+            for error in errors:
+                self.stdout.write(self.style.WARNING(f'{path} {error}'))
+        summary = import_results(results, dry_run=options['dry_run'])
+        action = 'Would update' if options['dry_run'] else 'Updated'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} {summary["matched"]} activities from {summary["results"]} results '
+            f'({summary["unmatched"]} unmatched) in {summary["seconds"]:.2f}s'
+        ))
@@ -0,0 +1,19 @@
+import time
+from django.core.management.base import BaseCommand
+
+from django_bpaml_strava.course_matching import rematch_locations
+
+
+class Command(BaseCommand):
+    help = 'Set the location of saved activities whose route matches a known parkrun course'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', dest='rematch_all',
+                            help='also rematch activities which already have a location, clearing it if they '
+                                 'match no course, except those with an official result')
+        parser.add_argument('--batch-size', type=int, default=5000, help='activities matched per query')
+
+    def handle(self, *args, **options):
+        t_start = time.perf_counter()
+        matched = rematch_locations(rematch_all=options['rematch_all'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Matched {matched} activities in {time.perf_counter() - t_start:.2f}s'))
@@ -0,0 +1,29 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from django_bpaml_strava.webhook import SETTLE_SECONDS, process_strava_events
+
+
+class Command(BaseCommand):
+    help = ('Apply the events queued by the Strava webhook, fetching just the changed activities. '
+            'Run from cron, or with --interval to keep running. Only run one at a time')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--settle', type=int, default=SETTLE_SECONDS,
+                            help="only process an athlete's events once none has arrived for this many seconds")
+        parser.add_argument('--interval', type=int, default=0,
+                            help='keep running, checking for events every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            for result in process_strava_events(settle_seconds=options['settle']):
+                self.stdout.write(self.style.SUCCESS(
+                    f'Athlete {result["strava_id"]}: {result["events"]} events, fetched {result["fetched"]}, '
+                    f'created {result["created"]}, updated {result["updated"]}, deleted {result["deleted"]}'
+                ))
+            if not options['interval']:
+                break
+            # Don't hold a database connection while sleeping
+            connection.close()
+            time.sleep(options['interval'])
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from django_bpaml_strava.standings import rebuild_season_standings
+
+
+class Command(BaseCommand):
+    help = ('Recalculate every season standing from the saved activities, '
+            'eg after changing BPAML_SEASON_POINTS or editing activities outside the app')
+
+    def handle(self, *args, **options):
+        count = rebuild_season_standings()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {count} season standings'))
@@ -0,0 +1,48 @@
+import concurrent.futures
+import datetime
+from django.core.management.base import BaseCommand
+from django.db import connection
+from allauth.socialaccount.models import SocialToken
+
+from django_bpaml_strava.rate_limit import BULK, strava_priority
+from django_bpaml_strava.strava_token import fetch_strava_token
+
+
+def refresh_token(strava_id, horizon: datetime.timedelta):
+    """Refresh one athlete's token in a worker thread"""
+    try:
+        with strava_priority(BULK):
+            strava_token = fetch_strava_token(strava_id, min_valid=horizon)
+        return strava_token.expires_at
+    finally:
+        # Each worker thread has its own database connection
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Refresh every Strava token which expires within the horizon so user requests never wait for a refresh'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--horizon', type=int, default=60, help='refresh tokens expiring within this many minutes')
+        parser.add_argument('--workers', type=int, default=4, help='number of tokens refreshed concurrently')
+
+    def handle(self, *args, **options):
+        horizon = datetime.timedelta(minutes=options['horizon'])
+        expires_before = datetime.datetime.now(datetime.timezone.utc) + horizon
+        strava_ids = list(SocialToken.objects
+                          .filter(account__provider='strava', expires_at__lte=expires_before)
+                          .values_list('account__uid', flat=True))
+        self.stdout.write(f'{len(strava_ids)} tokens expire before {expires_before:%d-%b-%Y %H:%M %Z}')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {executor.submit(refresh_token, strava_id, horizon): strava_id for strava_id in strava_ids}
+            for future in concurrent.futures.as_completed(futures):
+                strava_id = futures[future]
+                try:
+                    expires_at = future.result()
+                except Exception as e:
+                    self.stdout.write(self.style.ERROR(f'Athlete {strava_id}: {e}'))
+                    continue
+                if expires_at <= expires_before:
+                    self.stdout.write(self.style.ERROR(f'Athlete {strava_id}: token not refreshed'))
+                else:
+                    self.stdout.write(self.style.SUCCESS(f'Athlete {strava_id}: token expires {expires_at:%d-%b-%Y %H:%M %Z}'))
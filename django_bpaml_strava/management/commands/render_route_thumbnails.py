@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from django_bpaml_strava.models import Activity
+from django_bpaml_strava.thumbnails import THUMBNAIL_DIR, render_missing_thumbnails
+
+
+class Command(BaseCommand):
+    help = ('Render the route thumbnails of saved activities which don\'t have one yet, '
+            'so pages showing them never wait for one to be drawn')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--athlete', action='append', dest='strava_ids', metavar='STRAVA_ID',
+                            help='only render thumbnails of this athlete (may be repeated)')
+        parser.add_argument('--batch-size', type=int, default=2000, help='activities read per query')
+
+    def handle(self, *args, **options):
+        activities = Activity.objects.all()
+        if options['strava_ids']:
+            activities = activities.filter(athlete__socialaccount__provider='strava',
+                                           athlete__socialaccount__uid__in=options['strava_ids'])
+        result = render_missing_thumbnails(activities, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Rendered {result["rendered"]} thumbnails of {result["routes"]} routes in {result["activities"]} '
+            f'activities into {THUMBNAIL_DIR} in {result["seconds"]:.2f}s'
+        ))
@@ -0,0 +1,51 @@
+import concurrent.futures
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from django_bpaml_strava.rate_limit import BULK, strava_priority
+from django_bpaml_strava.sync import strava_accounts_with_sync_cursor, sync_athlete
+
+
+def sync_in_thread(social_account):
+    """Sync one athlete in a worker thread"""
+    try:
+        # Leave rate limit headroom for interactive requests
+        with strava_priority(BULK):
+            return sync_athlete(social_account)
+    finally:
+        # Each worker thread has its own database connection
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Fetch new activities from Strava for every athlete and save the Saturday parkruns'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='number of athletes synced concurrently')
+        parser.add_argument('--athlete', action='append', dest='strava_ids', metavar='STRAVA_ID',
+                            help='only sync this athlete (may be repeated)')
+
+    def handle(self, *args, **options):
+        t_start = time.perf_counter()
+        social_accounts = strava_accounts_with_sync_cursor()
+        if options['strava_ids']:
+            social_accounts = social_accounts.filter(uid__in=options['strava_ids'])
+        social_accounts = list(social_accounts)
+        total_saved = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {executor.submit(sync_in_thread, sa): sa for sa in social_accounts}
+            for future in concurrent.futures.as_completed(futures):
+                social_account = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    self.stdout.write(self.style.ERROR(f'Athlete {social_account.uid}: {e}'))
+                    continue
+                total_saved += result['saved']
+                self.stdout.write(self.style.SUCCESS(
+                    f'Athlete {result["strava_id"]}: fetched {result["fetched"]} after {result["after"]:%d-%b-%Y %H:%M}, '
+                    f'saved {result["saved"]} (fetch {result["fetch_seconds"]:.2f}s, save {result["save_seconds"]:.2f}s)'
+                ))
+        self.stdout.write(f'Synced {len(social_accounts)} athletes, saved {total_saved} activities '
+                          f'in {time.perf_counter() - t_start:.2f}s')
@@ -0,0 +1,202 @@
+"""
+In-process counters and histograms exposed in Prometheus text format by the metrics view.
+Recording is a dict update under a lock so it can stay on in production. When several worker processes serve
+the site, set BPAML_METRICS_DIR to a directory they share: each process writes its totals to its own file there
+at most once every BPAML_METRICS_FLUSH_SECONDS and the metrics view adds up every file. Clear the directory
+when deploying, as totals of processes which have exited are kept so counters never go backwards.
+Only scrapers from BPAML_METRICS_ALLOWED_IPS, or sending BPAML_METRICS_TOKEN as a bearer token, see the metrics.
+"""
+# Standard libraries
+import atexit
+import bisect
+import hmac
+import ipaddress
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+# Third-party libraries
+from django.conf import settings
+
+# Upper bounds in seconds of the latency histogram buckets. The last bucket is +Inf
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the SQL query count histogram buckets
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+# Type, help and buckets of every metric
+METRICS = {
+    'bpaml_view_seconds': ('histogram', 'Time to respond, by url name', LATENCY_BUCKETS),
+    'bpaml_view_responses_total': ('counter', 'Responses by url name and status code', None),
+    'bpaml_view_sql_queries': ('histogram', 'SQL queries run by each request, by url name', QUERY_COUNT_BUCKETS),
+    'bpaml_view_sql_seconds': ('histogram', 'Time spent in SQL by each request, by url name', LATENCY_BUCKETS),
+    'bpaml_strava_seconds': ('histogram', 'Strava api call latency, by endpoint', LATENCY_BUCKETS),
+    'bpaml_strava_responses_total': ('counter', 'Strava api responses by endpoint and status code', None),
+    'bpaml_strava_token_refreshes_total': ('counter', 'Strava access token refreshes by outcome', None),
+}
+
+METRICS_DIR = getattr(settings, 'BPAML_METRICS_DIR', None)
+FLUSH_SECONDS = getattr(settings, 'BPAML_METRICS_FLUSH_SECONDS', 5)
+# Addresses or networks, eg '10.0.0.0/8', allowed to scrape the metrics, and a token which is allowed from anywhere.
+# Nobody is allowed by default
+ALLOWED_IPS = [ipaddress.ip_network(network) for network in getattr(settings, 'BPAML_METRICS_ALLOWED_IPS', [])]
+TOKEN = getattr(settings, 'BPAML_METRICS_TOKEN', None)
+
+# Strava ids and activity ids in api paths, which would make a label value for every athlete and activity
+_ID_IN_PATH = re.compile(r'/\d+(?=/|$)')
+
+
+def scrape_allowed(request) -> bool:
+    """True if the request sent the metrics token or came from an allowed address"""
+    if TOKEN:
+        authorization = request.headers.get('Authorization', '')
+        if hmac.compare_digest(authorization.encode(), f'Bearer {TOKEN}'.encode()):
+            return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in network for network in ALLOWED_IPS)
+
+
+def strava_endpoint(url: str) -> str:
+    """Label for a Strava api url, eg '/activities/{id}'"""
+    path = str(url).split('?', 1)[0].split('/api/v3', 1)[-1]
+    return _ID_IN_PATH.sub('/{id}', path)
+
+
+class Metrics:
+    """The counters and histograms of this process"""
+
+    def __init__(self, directory=None, flush_seconds=FLUSH_SECONDS):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._counters: dict[tuple, float] = {}
+        # Per bucket counts followed by the sum and count of the observations
+        self._histograms: dict[tuple, list] = {}
+        self._path = Path(directory) / f'{os.getpid()}-{uuid.uuid4().hex}.json' if directory else None
+        self._flush_seconds = flush_seconds
+        self._flushed_at = time.monotonic()
+
+    def inc(self, name, labels: tuple = (), value=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name, value, labels: tuple = ()):
+        buckets = METRICS[name][2]
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(buckets) + 3)
+            histogram[bisect.bisect_left(buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+        self._maybe_flush()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, list(labels), list(values)] for (name, labels), values in self._histograms.items()],
+            }
+
+    def _maybe_flush(self):
+        if self._path is not None and time.monotonic() - self._flushed_at >= self._flush_seconds:
+            self.flush()
+
+    def flush(self):
+        """Write this process's totals to its file in the shared directory"""
+        # Another thread flushing now is writing the same totals
+        if self._path is None or not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            self._flushed_at = time.monotonic()
+            tmp_path = self._path.with_suffix('.tmp')
+            tmp_path.write_text(json.dumps(self.snapshot()))
+            # Atomic so the metrics view never reads a partly written file
+            os.replace(tmp_path, self._path)
+        finally:
+            self._flush_lock.release()
+
+    def snapshots(self) -> list[dict]:
+        """This process's totals and the last totals written by every other process"""
+        snapshots = [self.snapshot()]
+        if self._path is not None:
+            for path in self._path.parent.glob('*.json'):
+                if path != self._path:
+                    try:
+                        snapshots.append(json.loads(path.read_text()))
+                    except (OSError, ValueError):
+                        # Removed or replaced while we were reading it
+                        continue
+        return snapshots
+
+
+metrics = Metrics(METRICS_DIR)
+if METRICS_DIR:
+    Path(METRICS_DIR).mkdir(parents=True, exist_ok=True)
+    atexit.register(metrics.flush)
+
+
+def record_strava_call(method, url, status_code, seconds):
+    """Record one Strava api call. status_code is 'error' if there was no response"""
+    endpoint = (('method', method), ('endpoint', strava_endpoint(url)))
+    metrics.observe('bpaml_strava_seconds', seconds, endpoint)
+    metrics.inc('bpaml_strava_responses_total', endpoint + (('status', str(status_code)),))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def render_metrics(gauges: dict[str, tuple[str, list[tuple[tuple, float]]]] = None) -> str:
+    """
+    Prometheus text exposition of the totals of every process. gauges are current values read at scrape time,
+    given as {name: (help, [(labels, value), ...])}.
+    """
+    counters = {}
+    histograms = {}
+    for snapshot in metrics.snapshots():
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snapshot['histograms']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            total = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+    lines = []
+    for name, (metric_type, help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        if metric_type == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'{name}{_label_text(labels)} {value}')
+            continue
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip([*buckets, '+Inf'], values):
+                cumulative += count
+                lines.append(f'{name}_bucket{_label_text(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{_label_text(labels)} {values[-2]}')
+            lines.append(f'{name}_count{_label_text(labels)} {values[-1]}')
+    for name, (help_text, samples) in (gauges or {}).items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} gauge')
+        for labels, value in samples:
+            lines.append(f'{name}{_label_text(labels)} {value}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,45 @@
+import time
+from django.db import connection
+from django.shortcuts import render
+from django.utils.deprecation import MiddlewareMixin
+
+from django_bpaml_strava.metrics import metrics
+from django_bpaml_strava.query_budget import QueryRecorder
+from django_bpaml_strava.rate_limit import StravaRateLimited
+
+
+class MetricsMiddleware:
+    """
+    Record the latency, status code and SQL queries of every request by url name for the metrics view.
+    Put it first in MIDDLEWARE so the time includes the other middleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        t_start = time.perf_counter()
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+        seconds = time.perf_counter() - t_start
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        labels = (('view', view),)
+        metrics.observe('bpaml_view_seconds', seconds, labels)
+        metrics.inc('bpaml_view_responses_total', labels + (('status', str(response.status_code)),))
+        metrics.observe('bpaml_view_sql_queries', recorder.count, labels)
+        metrics.observe('bpaml_view_sql_seconds', recorder.seconds, labels)
+        return response
+
+
+class StravaRateLimitMiddleware(MiddlewareMixin):
+    """Show a 'try again' page when a view can't call Strava because of the rate limit"""
+
+    def process_exception(self, request, exception):
+        if not isinstance(exception, StravaRateLimited):
+            return None
+        context = {'retry_after': exception.retry_after}
+        response = render(request, 'django_bpaml_strava/rate_limited.html', context, status=429)
+        response['Retry-After'] = str(exception.retry_after)
+        return response
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.6 on 2026-10-17 18:55
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def delete_duplicate_activities(apps, schema_editor):
+    """Keep only the first saved copy of each strava activity so the unique constraint can be added"""
+    Activity = apps.get_model('django_bpaml_strava', 'Activity')
+    keep_ids = (Activity.objects.filter(activity_id__isnull=False)
+                .values('athlete', 'activity_id')
+                .annotate(keep_id=Min('id'))
+                .values('keep_id'))
+    Activity.objects.filter(activity_id__isnull=False).exclude(id__in=keep_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_bpaml_strava', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['athlete', 'start_time'], name='activity_athlete_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['athlete', 'date'], name='activity_athlete_date_idx'),
+        ),
+        migrations.RunPython(delete_duplicate_activities, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='activity',
+            constraint=models.UniqueConstraint(fields=('athlete', 'activity_id'), name='unique_athlete_activity'),
+        ),
+    ]
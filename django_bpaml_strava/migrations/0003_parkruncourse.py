@@ -0,0 +1,21 @@
+# Generated by Django 5.2.6 on 2026-10-17 19:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_bpaml_strava', '0002_activity_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ParkrunCourse',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, unique=True)),
+                ('polyline', models.CharField(max_length=4000)),
+            ],
+        ),
+    ]
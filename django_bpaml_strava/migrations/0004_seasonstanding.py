@@ -0,0 +1,56 @@
+# Generated by Django 5.2.6 on 2026-10-17 19:11
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Avg, Count, Max, Min, Q
+from django.db.models.functions import Coalesce, ExtractYear
+
+
+def fill_season_standings(apps, schema_editor):
+    """
+    Standings for activities already saved, counting those at a parkrun location or with an official result and
+    those within the parkrun distance band as standings.counted_activities does.
+    Points are left for the rebuild_season_standings command
+    """
+    Activity = apps.get_model('django_bpaml_strava', 'Activity')
+    SeasonStanding = apps.get_model('django_bpaml_strava', 'SeasonStanding')
+    rules = getattr(settings, 'BPAML_PARKRUN_RULES', {})
+    duration = Coalesce('parkrun_duration', 'strava_duration')
+    rows = (Activity.objects
+            .filter(~Q(location='') | Q(parkrun_duration__isnull=False)
+                    | Q(distance__gt=rules.get('min_distance', 4700), distance__lt=rules.get('max_distance', 5300)))
+            .annotate(season=ExtractYear('date'))
+            .order_by()
+            .values('athlete_id', 'season')
+            .annotate(run_count=Count('id'), best_duration=Min(duration), average_duration=Avg(duration),
+                      last_date=Max('date')))
+    SeasonStanding.objects.bulk_create([SeasonStanding(**row) for row in rows], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_bpaml_strava', '0003_parkruncourse'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SeasonStanding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('season', models.IntegerField()),
+                ('run_count', models.IntegerField(default=0)),
+                ('best_duration', models.DurationField(blank=True, default=None, null=True)),
+                ('average_duration', models.DurationField(blank=True, default=None, null=True)),
+                ('last_date', models.DateField(blank=True, default=None, null=True)),
+                ('points', models.FloatField(blank=True, default=None, null=True)),
+                ('athlete', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['season', 'best_duration'], name='standing_season_best_idx')],
+                'constraints': [models.UniqueConstraint(fields=('athlete', 'season'), name='unique_athlete_season')],
+            },
+        ),
+        migrations.RunPython(fill_season_standings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.6 on 2026-10-17 19:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_bpaml_strava', '0004_seasonstanding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StravaEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('aspect_type', models.CharField(max_length=20)),
+                ('object_type', models.CharField(max_length=20)),
+                ('object_id', models.BigIntegerField()),
+                ('owner_id', models.CharField(max_length=191)),
+                ('event_time', models.DateTimeField()),
+                ('updates', models.JSONField(blank=True, default=dict)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, default=None, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.CharField(blank=True, max_length=200)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('processed_at__isnull', True)), fields=['owner_id', 'id'], name='strava_event_pending_idx')],
+            },
+        ),
+    ]
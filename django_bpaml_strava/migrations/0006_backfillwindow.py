@@ -0,0 +1,30 @@
+# Generated by Django 5.2.6 on 2026-10-17 19:26
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_bpaml_strava', '0005_stravaevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackfillWindow',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('after', models.DateTimeField()),
+                ('before', models.DateTimeField()),
+                ('fetched', models.IntegerField(default=0)),
+                ('saved', models.IntegerField(default=0)),
+                ('completed_at', models.DateTimeField(auto_now_add=True)),
+                ('athlete', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('athlete', 'after', 'before'), name='unique_athlete_backfill_window')],
+            },
+        ),
+    ]
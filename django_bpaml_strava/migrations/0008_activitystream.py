@@ -0,0 +1,41 @@
+# Generated by Django 5.2.6 on 2026-10-17 19:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_bpaml_strava', '0007_activity_date_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityStream',
+            fields=[
+                ('activity', models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, serialize=False, to='django_bpaml_strava.activity')),
+                ('point_count', models.IntegerField()),
+                ('time', models.BinaryField()),
+                ('distance', models.BinaryField()),
+                ('latlng', models.BinaryField(null=True)),
+                ('heartrate', models.BinaryField(null=True)),
+                ('fetched_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='fastest_5k_duration',
+            field=models.DurationField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='split_seconds',
+            field=models.JSONField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='trimmed_duration',
+            field=models.DurationField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.6 on 2026-10-17 20:01
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def fill_route_hashes(apps, schema_editor):
+    """Hash the polylines of activities already saved, a batch at a time in pk order"""
+    Activity = apps.get_model('django_bpaml_strava', 'Activity')
+    last_pk = 0
+    while batch := list(Activity.objects.filter(pk__gt=last_pk).order_by('pk').only('polyline')[:2000]):
+        last_pk = batch[-1].pk
+        for activity in batch:
+            # As polyline.route_hash
+            activity.route_hash = hashlib.sha256(activity.polyline.encode()).hexdigest()
+        Activity.objects.bulk_update(batch, ['route_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_bpaml_strava', '0008_activitystream'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='route_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.RunPython(fill_route_hashes, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['route_hash'], name='activity_route_hash_idx'),
+        ),
+    ]
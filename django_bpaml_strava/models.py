@@ -1,3 +1,5 @@
+import datetime
+
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 
@@ -29,6 +31,131 @@ class Activity(models.Model):
     strava_duration = models.DurationField(default=None, null=True, blank=True)
     distance = models.FloatField(default=0)  # metres
     polyline = models.CharField(max_length=4000)
+    route_hash = models.CharField(max_length=64, blank=True)  # polyline.route_hash of polyline, for its thumbnail
+    # Worked out from the activity's streams, if they have been fetched, so lists never decode streams. See streams.py
+    split_seconds = models.JSONField(default=None, null=True, blank=True)  # seconds for each whole km
+    fastest_5k_duration = models.DurationField(default=None, null=True, blank=True)
+    trimmed_duration = models.DurationField(default=None, null=True, blank=True)  # just the parkrun distance
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["athlete", "start_time"], name="activity_athlete_start_idx"),
+            models.Index(fields=["athlete", "date"], name="activity_athlete_date_idx"),
+            # For the admin's date hierarchy and ordering across every athlete
+            models.Index(fields=["date"], name="activity_date_idx"),
+            # To draw a route's thumbnail the first time it is requested
+            models.Index(fields=["route_hash"], name="activity_route_hash_idx"),
+        ]
+        constraints = [
+            # An activity from Strava can only be saved once for each athlete
+            models.UniqueConstraint(fields=["athlete", "activity_id"], name="unique_athlete_activity"),
+        ]
 
     def __str__(self):
         return self.title
+
+    def splits(self) -> list[datetime.timedelta]:
+        return [datetime.timedelta(seconds=seconds) for seconds in self.split_seconds or []]
+
+
+class ActivityStream(models.Model):
+    """
+    An activity's Strava streams, kept in a side table so activity queries never read them.
+    Each stream is a zlib compressed blob of little endian int32 deltas, see streams.py.
+    There is no database constraint so deleting activities stays a single query. Streams of deleted
+    activities are removed by the fetch_activity_streams command.
+    """
+    activity = models.OneToOneField(Activity, on_delete=models.DO_NOTHING, primary_key=True, db_constraint=False)
+    point_count = models.IntegerField()
+    time = models.BinaryField()  # seconds since the start
+    distance = models.BinaryField()  # centimetres
+    latlng = models.BinaryField(null=True)  # millionths of a degree, latitude and longitude interleaved
+    heartrate = models.BinaryField(null=True)  # beats per minute
+    fetched_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Streams of {self.activity_id}"
+
+
+class ParkrunCourse(models.Model):
+    """
+    A known parkrun course. Saved activities whose route matches the course's route get its name as location.
+    """
+    name = models.CharField(max_length=200, unique=True)
+    polyline = models.CharField(max_length=4000)  # encoded like Strava's summary_polyline
+
+    def __str__(self):
+        return self.name
+
+
+class SeasonStanding(models.Model):
+    """
+    One athlete's results for one season (calendar year of the activity date), kept up to date
+    from their activities so league standings are a single indexed read. See standings.py
+    """
+    athlete = models.ForeignKey(User, on_delete=models.CASCADE)
+    season = models.IntegerField()
+    run_count = models.IntegerField(default=0)
+    best_duration = models.DurationField(default=None, null=True, blank=True)
+    average_duration = models.DurationField(default=None, null=True, blank=True)
+    last_date = models.DateField(default=None, null=True, blank=True)
+    points = models.FloatField(default=None, null=True, blank=True)  # if settings.BPAML_SEASON_POINTS is set
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["season", "best_duration"], name="standing_season_best_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["athlete", "season"], name="unique_athlete_season"),
+        ]
+
+    def __str__(self):
+        return f"{self.athlete} {self.season}"
+
+
+class StravaEvent(models.Model):
+    """
+    An event pushed to our webhook by Strava, queued here until the process_strava_events command applies it.
+    See webhook.py
+    """
+    aspect_type = models.CharField(max_length=20)  # create, update or delete
+    object_type = models.CharField(max_length=20)  # activity or athlete
+    object_id = models.BigIntegerField()  # activity id, or athlete id for athlete events
+    owner_id = models.CharField(max_length=191)  # athlete's strava id as in SocialAccount.uid
+    event_time = models.DateTimeField()
+    updates = models.JSONField(default=dict, blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(default=None, null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    error = models.CharField(max_length=200, blank=True)
+
+    class Meta:
+        indexes = [
+            # Only the unprocessed events are indexed so the index stays small as the table grows
+            models.Index(fields=["owner_id", "id"], name="strava_event_pending_idx",
+                         condition=models.Q(processed_at__isnull=True)),
+        ]
+
+    def __str__(self):
+        return f"{self.object_type} {self.object_id} {self.aspect_type}"
+
+
+class BackfillWindow(models.Model):
+    """
+    A time window of an athlete's Strava history which has been fetched and saved by a backfill,
+    so an interrupted backfill resumes with the windows not yet done. See backfill.py
+    """
+    athlete = models.ForeignKey(User, on_delete=models.CASCADE)
+    after = models.DateTimeField()
+    before = models.DateTimeField()
+    fetched = models.IntegerField(default=0)
+    saved = models.IntegerField(default=0)
+    completed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["athlete", "after", "before"], name="unique_athlete_backfill_window"),
+        ]
+
+    def __str__(self):
+        return f"{self.athlete} {self.after:%d-%b-%Y} to {self.before:%d-%b-%Y}"
@@ -0,0 +1,82 @@
+# Standard libraries
+import functools
+import uuid
+from typing import Iterable
+# Third-party libraries
+from allauth.socialaccount.models import SocialAccount
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import Http404
+
+# Seconds a rendered fragment is kept. Only used to evict old versions; pages are correct whatever it is.
+PAGE_CACHE_TIMEOUT = getattr(settings, 'BPAML_PAGE_CACHE_TIMEOUT', 24 * 60 * 60)
+
+INDEX_VERSION_KEY = 'page-version:index'
+
+
+def _athlete_version_key(user_id):
+    return f'page-version:athlete:{user_id}'
+
+
+def _strava_user_key(strava_id):
+    return f'strava-user:{strava_id}'
+
+
+def _new_version() -> str:
+    return uuid.uuid4().hex
+
+
+def _version(key) -> str:
+    """The current version stored at key, creating one if there isn't one yet"""
+    version = cache.get(key)
+    if version is None:
+        version = _new_version()
+        if not cache.add(key, version, timeout=None):
+            # Another request created it first
+            version = cache.get(key, version)
+    return version
+
+
+def index_page_version() -> str:
+    """Version of pages showing every athlete. Changes whenever any athlete's activities or details change"""
+    return _version(INDEX_VERSION_KEY)
+
+
+def athlete_page_version(user_id) -> str:
+    """Version of pages showing one athlete's details and saved activities"""
+    return _version(_athlete_version_key(user_id))
+
+
+def _bump(user_ids):
+    version = _new_version()
+    cache.set_many({INDEX_VERSION_KEY: version, **{_athlete_version_key(user_id): version for user_id in user_ids}},
+                   timeout=None)
+
+
+def bump_page_versions(user_ids: Iterable[int]):
+    """
+    Pages showing these athletes, and the index which shows them all, are rendered afresh next time.
+    Done when the transaction commits so a page rendered before then can't be cached under the new version.
+    """
+    user_ids = set(user_ids)
+    if user_ids:
+        transaction.on_commit(functools.partial(_bump, user_ids))
+
+
+def strava_user_id(strava_id) -> int:
+    """The user id of the strava athlete, cached so pages can be served from the cache without any queries"""
+    key = _strava_user_key(strava_id)
+    user_id = cache.get(key)
+    if user_id is None:
+        user_id = (SocialAccount.objects.filter(provider='strava', uid=strava_id)
+                   .values_list('user_id', flat=True).first())
+        if user_id is None:
+            raise Http404(f"No strava athlete {strava_id}")
+        cache.set(key, user_id, timeout=None)
+    return user_id
+
+
+def forget_strava_user(strava_id):
+    """The social account has changed so look up its user again next time"""
+    cache.delete(_strava_user_key(strava_id))
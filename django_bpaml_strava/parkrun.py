@@ -0,0 +1,191 @@
+# Standard libraries
+import datetime
+import functools
+from typing import Iterable, Sequence
+# Third-party libraries
+import numpy as np
+from allauth.socialaccount.models import SocialAccount
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+# Local libraries
+from django_bpaml_strava.ingest import bulk_save_activities, decode_activities, get_timezone
+from django_bpaml_strava.listing_cache import get_cached_listing
+from django_bpaml_strava.models import Activity, User
+
+# Rules used unless settings.BPAML_PARKRUN_RULES overrides some of them. Times are local to the activity.
+DEFAULT_PARKRUN_RULES = {
+    # (weekday, earliest start, latest start) with Monday 0. The latest start is exclusive.
+    'weekly_events': [(5, '00:00', '07:10')],
+    # ('MM-DD', earliest start, latest start) for parkruns held on that date whatever the weekday.
+    # None by default. Opt in with eg [('12-25', '00:00', '09:10'), ('01-01', '00:00', '09:10')]
+    # for Christmas and New Year's Day parkruns
+    'special_events': [],
+    # Distance in metres must be strictly between these
+    'min_distance': 4700,
+    'max_distance': 5300,
+    # Which activity to keep when several on the same date qualify. One of TIE_BREAKS
+    'tie_break': 'first',
+}
+# first: first in the order given (Strava's order when fetching), earliest: earliest start,
+# closest: distance closest to the middle of the distance band, fastest: shortest elapsed time
+TIE_BREAKS = ('first', 'earliest', 'closest', 'fastest')
+
+
+def _seconds(value: str) -> int:
+    """'07:10' to seconds since midnight"""
+    t = datetime.time.fromisoformat(value)
+    return t.hour * 3600 + t.minute * 60 + t.second
+
+
+def _month_day(value: str) -> int:
+    """'12-25' to 1225"""
+    month, day = value.split('-')
+    return int(month) * 100 + int(day)
+
+
+def _local_seconds(start_time: datetime.datetime, timezone: str) -> float:
+    """Seconds since 1 Jan 1970 of the wall clock time when start_time is seen in timezone"""
+    local = start_time.astimezone(get_timezone(timezone))
+    return local.timestamp() + local.utcoffset().total_seconds()
+
+
+def activity_columns(athlete_ids: Sequence[int], start_times: Sequence[datetime.datetime],
+                     timezones: Sequence[str], distances: Sequence[float],
+                     durations: Sequence[datetime.timedelta | None]) -> dict[str, np.ndarray]:
+    """
+    Columnar arrays describing candidate activities, so rules can be evaluated over all of them at once.
+    start_times are aware and are converted to local wall clock time in each activity's timezone.
+    """
+    count = len(start_times)
+    local = np.fromiter((_local_seconds(t, tz) for t, tz in zip(start_times, timezones)),
+                        dtype=np.float64, count=count).astype(np.int64)
+    days = local // 86400
+    months = days.astype('datetime64[D]').astype('datetime64[M]')
+    day_of_month = days - months.astype('datetime64[D]').astype(np.int64) + 1
+    return {
+        'athlete': np.fromiter(athlete_ids, dtype=np.int64, count=count),
+        'date': days,
+        # 1 Jan 1970 was a Thursday
+        'weekday': (days + 3) % 7,
+        'month_day': (months.astype(np.int64) % 12 + 1) * 100 + day_of_month,
+        'seconds': local % 86400,
+        'distance': np.fromiter(distances, dtype=np.float64, count=count),
+        'duration': np.fromiter((np.inf if d is None else d.total_seconds() for d in durations),
+                                dtype=np.float64, count=count),
+    }
+
+
+def columns_from_activities(activities: Sequence[Activity]) -> dict[str, np.ndarray]:
+    """activity_columns for saved or unsaved Activity objects"""
+    return activity_columns([a.athlete_id or 0 for a in activities], [a.start_time for a in activities],
+                            [a.timezone for a in activities], [a.distance for a in activities],
+                            [a.strava_duration for a in activities])
+
+
+class ParkrunRules:
+    """Rules deciding which activities are parkruns. See DEFAULT_PARKRUN_RULES for the meaning of each argument"""
+
+    def __init__(self, weekly_events, special_events, min_distance, max_distance, tie_break):
+        if tie_break not in TIE_BREAKS:
+            raise ImproperlyConfigured(f"parkrun tie_break must be one of {TIE_BREAKS}, not {tie_break!r}")
+        self.weekly_events = [(weekday, _seconds(earliest), _seconds(latest))
+                              for weekday, earliest, latest in weekly_events]
+        self.special_events = [(_month_day(month_day), _seconds(earliest), _seconds(latest))
+                               for month_day, earliest, latest in special_events]
+        self.min_distance = min_distance
+        self.max_distance = max_distance
+        self.tie_break = tie_break
+
+    def evaluate(self, columns: dict[str, np.ndarray]) -> np.ndarray:
+        """Boolean array of which activities are at a parkrun time over a parkrun distance"""
+        seconds = columns['seconds']
+        in_window = np.zeros(len(seconds), dtype=bool)
+        for weekday, earliest, latest in self.weekly_events:
+            in_window |= (columns['weekday'] == weekday) & (earliest <= seconds) & (seconds < latest)
+        for month_day, earliest, latest in self.special_events:
+            in_window |= (columns['month_day'] == month_day) & (earliest <= seconds) & (seconds < latest)
+        distance = columns['distance']
+        return in_window & (self.min_distance < distance) & (distance < self.max_distance)
+
+    def _tie_break_key(self, columns: dict[str, np.ndarray]) -> np.ndarray:
+        if self.tie_break == 'earliest':
+            return columns['seconds']
+        if self.tie_break == 'closest':
+            return np.abs(columns['distance'] - (self.min_distance + self.max_distance) / 2)
+        if self.tie_break == 'fastest':
+            return columns['duration']
+        return np.zeros(len(columns['seconds']))
+
+    def select(self, columns: dict[str, np.ndarray]) -> np.ndarray:
+        """Indexes, in the order given, of the parkruns keeping one for each athlete and date by the tie break"""
+        candidates = np.flatnonzero(self.evaluate(columns))
+        athlete, date = columns['athlete'][candidates], columns['date'][candidates]
+        # Sort by athlete, date, tie break key and finally original order, then keep the first of each athlete and date
+        order = np.lexsort((candidates, self._tie_break_key(columns)[candidates], date, athlete))
+        athlete, date = athlete[order], date[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (athlete[1:] != athlete[:-1]) | (date[1:] != date[:-1])
+        return np.sort(candidates[order][first])
+
+    def is_parkrun(self, activity: Activity) -> bool:
+        """Does this one activity satisfy the rules, ignoring other activities on the same date"""
+        return bool(self.evaluate(columns_from_activities([activity]))[0])
+
+
+@functools.lru_cache(maxsize=None)
+def get_parkrun_rules() -> ParkrunRules:
+    """The rules from DEFAULT_PARKRUN_RULES updated with settings.BPAML_PARKRUN_RULES"""
+    return ParkrunRules(**{**DEFAULT_PARKRUN_RULES, **getattr(settings, 'BPAML_PARKRUN_RULES', {})})
+
+
+def new_parkrun_activities(user: User, activities: Iterable[Activity], rules: ParkrunRules = None) -> list[Activity]:
+    """
+    Filter unsaved activities down to parkruns, keeping only one for each date
+    and skipping dates which already have a saved activity.
+    """
+    rules = rules or get_parkrun_rules()
+    activities = list(activities)
+    candidates = [activities[i] for i in rules.select(columns_from_activities(activities))]
+    # Check the saved dates using the (athlete, date) index
+    saved_dates = set(Activity.objects
+                      .filter(athlete=user, date__in=[a.date for a in candidates])
+                      .values_list('date', flat=True))
+    return [a for a in candidates if a.date not in saved_dates]
+
+
+def reclassify_saved_activities(queryset=None, rules: ParkrunRules = None) -> tuple[list[int], list[int]]:
+    """
+    Apply the rules to activities already saved, without calling Strava.
+    Returns the pks of activities which are still parkruns and of those which no longer are,
+    including any which lose a tie break to another activity on the same date.
+    """
+    rules = rules or get_parkrun_rules()
+    if queryset is None:
+        queryset = Activity.objects.all()
+    rows = list(queryset.order_by('athlete_id', 'start_time')
+                .values_list('pk', 'athlete_id', 'start_time', 'timezone', 'distance', 'strava_duration'))
+    if not rows:
+        return [], []
+    pks, athlete_ids, start_times, timezones, distances, durations = zip(*rows)
+    keep = np.zeros(len(rows), dtype=bool)
+    keep[rules.select(activity_columns(athlete_ids, start_times, timezones, distances, durations))] = True
+    pks = np.array(pks)
+    return pks[keep].tolist(), pks[~keep].tolist()
+
+
+def reclassify_cached_listings(social_accounts=None, rules: ParkrunRules = None) -> dict[str, int]:
+    """
+    Apply the rules to the athletes' cached Strava listings, without calling Strava, and save any new parkruns.
+    Athletes without a cached listing are skipped. Returns the number saved for each athlete with a listing.
+    """
+    rules = rules or get_parkrun_rules()
+    if social_accounts is None:
+        social_accounts = SocialAccount.objects.filter(provider='strava').select_related('user')
+    saved = {}
+    for social_account in social_accounts:
+        listing = get_cached_listing(social_account.uid)
+        if listing is not None:
+            user = social_account.user
+            saved[social_account.uid] = bulk_save_activities(
+                new_parkrun_activities(user, decode_activities(user, listing), rules))
+    return saved
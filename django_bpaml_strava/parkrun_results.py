@@ -0,0 +1,103 @@
+"""
+Import official parkrun results into saved activities. A results file is CSV with the columns
+parkrun_id, date, event, time and an optional header row. Any further columns, eg the finish position in
+parkrun's own results, are ignored. Each result is matched to the activity of the athlete with that
+User.parkrun_id on that date, which gets the official time as parkrun_duration and the event as location.
+"""
+# Standard libraries
+import csv
+import dataclasses
+import datetime
+import logging
+import time
+from typing import Iterable, TextIO
+# Local libraries
+from django_bpaml_strava.database import serialized_writer
+from django_bpaml_strava.models import Activity
+from django_bpaml_strava.page_cache import bump_page_versions
+from django_bpaml_strava.standings import update_season_standings
+
+logger = logging.getLogger(__name__)
+
+RESULT_COLUMNS = ('parkrun_id', 'date', 'event', 'time')
+UPDATE_BATCH_SIZE = 500
+
+
+@dataclasses.dataclass(frozen=True)
+class ParkrunResult:
+    parkrun_id: int
+    date: datetime.date
+    event: str
+    duration: datetime.timedelta
+
+
+def parse_parkrun_id(value: str) -> int:
+    """parkrun ids are printed on barcodes with a leading A, eg A1234567"""
+    return int(value.strip().upper().removeprefix('A'))
+
+
+def parse_result_date(value: str) -> datetime.date:
+    """parkrun results show dates as dd/mm/yyyy. ISO dates are also accepted"""
+    value = value.strip()
+    if '/' in value:
+        return datetime.datetime.strptime(value, '%d/%m/%Y').date()
+    return datetime.date.fromisoformat(value)
+
+
+def parse_result_time(value: str) -> datetime.timedelta:
+    """Finish times are mm:ss, or h:mm:ss for an hour or more"""
+    seconds = 0
+    for part in value.strip().split(':'):
+        seconds = seconds * 60 + int(part)
+    return datetime.timedelta(seconds=seconds)
+
+
+def read_results(file: TextIO) -> tuple[list[ParkrunResult], list[str]]:
+    """Parse a results file. Returns the results and a message for each line which couldn't be parsed"""
+    results = []
+    errors = []
+    for line_number, row in enumerate(csv.reader(file), start=1):
+        if not row or (line_number == 1 and row[0].strip().lower() == RESULT_COLUMNS[0]):
+            continue
+        try:
+            parkrun_id, date, event, finish_time = row[:len(RESULT_COLUMNS)]
+            results.append(ParkrunResult(parse_parkrun_id(parkrun_id), parse_result_date(date), event.strip(),
+                                         parse_result_time(finish_time)))
+        except ValueError as e:
+            errors.append(f"line {line_number}: {e}")
+    return results, errors
+
+
+def import_results(results: Iterable[ParkrunResult], dry_run=False) -> dict:
+    """
+    Set parkrun_duration and location of the activities matching the results, using one query to read
+    every candidate activity and a hash join on (parkrun_id, date) in memory rather than a query per result.
+    Returns counts for reporting.
+    """
+    t_start = time.perf_counter()
+    results_by_key = {(r.parkrun_id, r.date): r for r in results}
+    dates = {date for _, date in results_by_key}
+    # Club members' activities on the results dates, with their parkrun ids from the joined user table
+    candidates = (Activity.objects
+                  .filter(date__in=dates, athlete__parkrun_id__isnull=False)
+                  .order_by('id')
+                  .values_list('id', 'athlete_id', 'athlete__parkrun_id', 'date', 'location'))
+    updates = {}
+    for pk, athlete_id, parkrun_id, date, location in candidates:
+        result = results_by_key.get((parkrun_id, date))
+        # Only the first activity of the day if there is more than one
+        if result is not None and (parkrun_id, date) not in updates:
+            updates[(parkrun_id, date)] = Activity(pk=pk, athlete_id=athlete_id, parkrun_duration=result.duration,
+                                                   location=result.event or location)
+    activities = list(updates.values())
+    if activities and not dry_run:
+        # Official times change season bests so the standings and pages are updated too
+        athlete_ids = {a.athlete_id for a in activities}
+        with serialized_writer():
+            Activity.objects.bulk_update(activities, ['parkrun_duration', 'location'], batch_size=UPDATE_BATCH_SIZE)
+            update_season_standings(athlete_ids)
+            bump_page_versions(athlete_ids)
+    summary = {'results': len(results_by_key), 'matched': len(activities),
+               'unmatched': len(results_by_key) - len(activities), 'seconds': time.perf_counter() - t_start}
+    logger.info("Imported parkrun results: %s", summary)
+    return summary
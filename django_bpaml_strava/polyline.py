@@ -0,0 +1,148 @@
+# Standard libraries
+import hashlib
+from typing import Sequence
+# Third-party libraries
+import numpy as np
+
+# Metres per degree of latitude
+METRES_PER_DEGREE = 111_320.0
+
+
+def route_hash(polyline: str) -> str:
+    """Content address of an encoded polyline, saved on each activity so its thumbnail is found without reading it"""
+    return hashlib.sha256(polyline.encode()).hexdigest()
+
+
+def decode_polylines(polylines: Sequence[str], precision: int = 5) -> list[np.ndarray]:
+    """
+    Decode a batch of Google encoded polylines (as used by Strava's summary_polyline) in one pass.
+    Returns one (n, 2) array of latitude, longitude per polyline. Empty or malformed polylines give empty arrays.
+
+    Every character carries 5 bits of a value and values end at a character below 0x20, so all the
+    characters of all the polylines can be decoded together with numpy rather than a python loop.
+    """
+    if not all(p.isascii() for p in polylines):
+        # Polylines are ASCII, so any other character, eg one typed in the admin, makes that polyline malformed
+        return decode_polylines([p if p.isascii() else '' for p in polylines], precision)
+    lengths = np.fromiter((len(p) for p in polylines), dtype=np.int64, count=len(polylines))
+    if lengths.sum() == 0:
+        return [np.empty((0, 2)) for _ in polylines]
+    chars = np.frombuffer(''.join(polylines).encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    # Each value ends at a chunk without the continuation bit
+    is_end = chars < 0x20
+    value_index = np.concatenate(([0], np.cumsum(is_end)[:-1]))
+    value_starts = np.flatnonzero(np.concatenate(([True], is_end[:-1])))
+    shift = 5 * (np.arange(len(chars)) - value_starts[value_index])
+    values = np.add.reduceat((chars & 0x1f) << shift, value_starts)
+    # Undo the zig-zag sign encoding
+    values = np.where(values & 1, ~(values >> 1), values >> 1)
+    # Split back into polylines by counting the values which end in each polyline's characters
+    values_ended = np.concatenate(([0], np.cumsum(is_end)))[np.cumsum(lengths)]
+    values_per_polyline = np.diff(np.concatenate(([0], values_ended)))
+    # Malformed polylines have characters out of range, end part way through a value or have half a point
+    bad = values_per_polyline % 2 == 1
+    bad[np.repeat(np.arange(len(polylines)), lengths)[(chars < 0) | (chars > 63)]] = True
+    non_empty = np.flatnonzero(lengths)
+    bad[non_empty[~is_end[np.cumsum(lengths)[non_empty] - 1]]] = True
+    if bad.any():
+        return decode_polylines(['' if b else p for p, b in zip(polylines, bad)], precision)
+    # Values are deltas from the previous point, alternating latitude and longitude
+    deltas = values.reshape(-1, 2).astype(np.float64) / 10 ** precision
+    point_ends = np.cumsum(values_per_polyline // 2)
+    return [np.cumsum(d, axis=0) for d in np.split(deltas, point_ends[:-1])]
+
+
+def decode_polyline(polyline: str, precision: int = 5) -> np.ndarray:
+    """Decode one Google encoded polyline into an (n, 2) array of latitude, longitude"""
+    return decode_polylines([polyline], precision)[0]
+
+
+def resample(routes: Sequence[np.ndarray], n: int) -> np.ndarray:
+    """
+    Resample each route (an (m, 2) array with at least 2 points) to n points spaced evenly by distance along it,
+    so routes recorded at different rates compare fairly. Returns an (len(routes), n, 2) array.
+    All routes are interpolated together by laying them end to end with a gap between each.
+    """
+    if not len(routes):
+        return np.empty((0, n, 2))
+    lengths = np.fromiter((len(r) for r in routes), dtype=np.int64, count=len(routes))
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    ends = starts + lengths - 1
+    points = np.concatenate(routes)
+    steps = np.hypot(*np.diff(points, axis=0).T)
+    # Separate consecutive routes so interpolation never mixes points from two routes
+    steps[starts[1:] - 1] = 1.0
+    distance = np.concatenate(([0], np.cumsum(steps)))
+    targets = distance[starts, None] + (distance[ends] - distance[starts])[:, None] * np.linspace(0, 1, n)
+    return np.stack((np.interp(targets, distance, points[:, 0]), np.interp(targets, distance, points[:, 1])), axis=-1)
+
+
+def bounding_boxes(routes: Sequence[np.ndarray]) -> np.ndarray:
+    """(len(routes), 4) array of min latitude, min longitude, max latitude, max longitude of non-empty routes"""
+    if not len(routes):
+        return np.empty((0, 4))
+    lengths = np.fromiter((len(r) for r in routes), dtype=np.int64, count=len(routes))
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    points = np.concatenate(routes)
+    return np.hstack((np.minimum.reduceat(points, starts, axis=0), np.maximum.reduceat(points, starts, axis=0)))
+
+
+def to_metres(points: np.ndarray, origin: np.ndarray) -> np.ndarray:
+    """
+    Project latitude, longitude to x, y metres from origin (a latitude, longitude).
+    Accurate enough over the size of a parkrun course.
+    """
+    scale = np.array([METRES_PER_DEGREE, METRES_PER_DEGREE * np.cos(np.radians(origin[0]))])
+    return (points - origin) * scale
+
+
+def hausdorff_distances(routes: np.ndarray, course: np.ndarray, chunk_size: int = 512) -> np.ndarray:
+    """
+    Symmetric Hausdorff distance from each of routes (m, n, 2) to course (k, 2), all in metres.
+    Returns an array of m distances computed by broadcasting over chunk_size routes at a time
+    rather than a loop per route. Chunks keep the (chunk_size, n, k) distance matrix small.
+    """
+    distances = np.empty(len(routes))
+    # Squared distances as |a|^2 + |b|^2 - 2a.b so the cross term is one matrix multiply
+    course_squared = (course ** 2).sum(axis=-1)
+    for start in range(0, len(routes), chunk_size):
+        chunk = routes[start:start + chunk_size]
+        pairwise = (chunk ** 2).sum(axis=-1)[:, :, None] + course_squared - 2 * (chunk @ course.T)
+        route_to_course = pairwise.min(axis=2).max(axis=1)
+        course_to_route = pairwise.min(axis=1).max(axis=1)
+        distances[start:start + chunk_size] = np.maximum(route_to_course, course_to_route)
+    return np.sqrt(np.maximum(distances, 0))
+
+
+def simplify(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Douglas-Peucker simplification of an (n, 2) array of x, y points: the fewest points such that no point
+    left out is further than tolerance from the simplified line. The distances of every point in a span
+    are measured in one numpy operation, so only the spans still being split are looped over.
+    """
+    if len(points) < 3:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    spans = [(0, len(points) - 1)]
+    while spans:
+        first, last = spans.pop()
+        if last - first < 2:
+            continue
+        inner = points[first + 1:last]
+        start, end = points[first], points[last]
+        direction = end - start
+        length = np.hypot(*direction)
+        if length > 0:
+            # Perpendicular distance from the line through start and end
+            offsets = inner - start
+            distances = np.abs(direction[0] * offsets[:, 1] - direction[1] * offsets[:, 0]) / length
+        else:
+            # A loop which ends where it started, so measure from the start
+            distances = np.hypot(*(inner - start).T)
+        furthest = int(np.argmax(distances))
+        if distances[furthest] > tolerance:
+            split = first + 1 + furthest
+            keep[split] = True
+            spans.extend(((first, split), (split, last)))
+    return points[keep]
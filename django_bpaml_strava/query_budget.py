@@ -0,0 +1,94 @@
+# Standard libraries
+import functools
+import inspect
+import logging
+import time
+# Third-party libraries
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised when a view runs more SQL queries, or spends longer in SQL, than its declared budget"""
+
+
+class QueryRecorder:
+    """Database execute wrapper which counts queries and the time spent running them"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        t_start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - t_start
+
+
+def _strict() -> bool:
+    # Read at request time so tests can use override_settings
+    return getattr(settings, 'BPAML_QUERY_BUDGET_STRICT', settings.DEBUG)
+
+
+def _check_budget(name, recorder: QueryRecorder, queries, seconds):
+    logger.debug("%s ran %s queries in %.3fs", name, recorder.count, recorder.seconds)
+    over = []
+    if queries is not None and recorder.count > queries:
+        over.append(f"{recorder.count} queries > {queries}")
+    if seconds is not None and recorder.seconds > seconds:
+        over.append(f"{recorder.seconds:.3f}s in SQL > {seconds}s")
+    if over:
+        message = f"{name} exceeded its query budget: {', '.join(over)}"
+        if _strict():
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+
+def _install(recorder):
+    connection.execute_wrappers.append(recorder)
+
+
+def _uninstall(recorder):
+    connection.execute_wrappers.remove(recorder)
+
+
+def query_budget(queries: int = None, seconds: float = None):
+    """
+    Decorator declaring the most SQL queries, and seconds spent in SQL, a view may use.
+    The view's queries are counted and timed on every request. Going over the budget raises
+    QueryBudgetExceeded when DEBUG or BPAML_QUERY_BUDGET_STRICT is set, and logs a warning otherwise.
+    Works for async views too, whose ORM calls run on the thread sensitive executor.
+    """
+    def decorator(view):
+        name = view.__name__
+        if inspect.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                recorder = QueryRecorder()
+                await sync_to_async(_install)(recorder)
+                try:
+                    response = await view(request, *args, **kwargs)
+                finally:
+                    await sync_to_async(_uninstall)(recorder)
+                _check_budget(name, recorder, queries, seconds)
+                return response
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            recorder = QueryRecorder()
+            with connection.execute_wrapper(recorder):
+                response = view(request, *args, **kwargs)
+                # Templates are rendered lazily for TemplateResponse so render while still counting
+                if hasattr(response, 'render') and callable(response.render):
+                    response.render()
+            _check_budget(name, recorder, queries, seconds)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,183 @@
+# Standard libraries
+import contextlib
+import contextvars
+import logging
+import os
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows, where only the threads of one process are serialized
+    fcntl = None
+# Third-party libraries
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+
+logger = logging.getLogger(__name__)
+
+# Priorities for Strava calls. Interactive calls are made while a user waits for a page.
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+# Strava's default application limits for each 15 minutes and each day until its headers tell us otherwise
+DEFAULT_LIMITS = (200, 2000)
+# Strava's 15 minute windows start on the quarter hour and daily windows at midnight UTC
+WINDOW_SECONDS = (15 * 60, 24 * 60 * 60)
+# Bulk calls may only use this share of each limit so interactive calls always have headroom
+BULK_SHARE = getattr(settings, 'BPAML_STRAVA_BULK_SHARE', 0.75)
+# Bulk calls wait up to this many seconds for the next window rather than failing
+BULK_MAX_WAIT = getattr(settings, 'BPAML_STRAVA_BULK_MAX_WAIT', 15 * 60)
+# Cache shared by every worker process
+RATE_LIMIT_CACHE = getattr(settings, 'BPAML_STRAVA_RATE_LIMIT_CACHE', 'default')
+# File flocked while a call is counted so processes can't both see room for the last call. Defaults to a file in
+# the cache directory for a file based cache. Other caches shared between processes, eg memcached or redis, have no
+# lock, so concurrent calls may overshoot the budgets by a few unless this names a file all processes can reach.
+RATE_LIMIT_LOCK_FILE = getattr(settings, 'BPAML_STRAVA_RATE_LIMIT_LOCK_FILE', None)
+
+LIMITS_KEY = 'strava-rate:limits'
+
+_priority = contextvars.ContextVar('strava_priority', default=INTERACTIVE)
+
+
+class StravaRateLimited(Exception):
+    """Raised instead of calling Strava when the call would exceed the rate limit"""
+
+    def __init__(self, retry_after):
+        self.retry_after = max(1, int(retry_after + 0.999))
+        super().__init__(f"Strava rate limit reached. Try again in {self.retry_after} s")
+
+
+@contextlib.contextmanager
+def strava_priority(priority):
+    """Strava calls made inside this context (in the current thread or task) use the given priority"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def _windows(now: float) -> list[tuple[str, float]]:
+    """Cache key and seconds remaining for the current 15 minute and daily windows"""
+    windows = []
+    for seconds in WINDOW_SECONDS:
+        start = int(now) - int(now) % seconds
+        windows.append((f'strava-rate:{seconds}:{start}', start + seconds - now))
+    return windows
+
+
+_reserve_lock = threading.Lock()
+
+
+def _lock_path(cache) -> str | None:
+    if fcntl is None:
+        return None
+    if RATE_LIMIT_LOCK_FILE:
+        return RATE_LIMIT_LOCK_FILE
+    if isinstance(cache, FileBasedCache):
+        os.makedirs(cache._dir, exist_ok=True)
+        return os.path.join(cache._dir, 'strava-rate.lock')
+    return None
+
+
+@contextlib.contextmanager
+def _reserving(cache):
+    """
+    Serializes reservations: a lock for the threads of this process and an flock for other processes,
+    as the file based cache's incr is a read and a write rather than atomic
+    """
+    with _reserve_lock:
+        path = _lock_path(cache)
+        if path is None:
+            yield
+            return
+        with open(path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _reserve(priority) -> float | None:
+    """Count one call against each window and return None, or return seconds until there is room for it"""
+    cache = caches[RATE_LIMIT_CACHE]
+    share = 1 if priority == INTERACTIVE else BULK_SHARE
+    with _reserving(cache):
+        windows = _windows(time.time())
+        limits = cache.get(LIMITS_KEY, DEFAULT_LIMITS)
+        usage = cache.get_many([key for key, _ in windows])
+        for (key, remaining), limit in zip(windows, limits):
+            if usage.get(key, 0) >= limit * share:
+                return remaining
+        for key, remaining in windows:
+            # Keep the count a little longer than the window in case clocks differ between workers
+            if not cache.add(key, 1, timeout=int(remaining) + 60):
+                try:
+                    cache.incr(key)
+                except ValueError:
+                    # Expired between add and incr
+                    cache.set(key, 1, timeout=int(remaining) + 60)
+    return None
+
+
+def acquire(priority=None):
+    """
+    Reserve one Strava call before making it.
+    Interactive calls raise StravaRateLimited if there is no room. Bulk calls wait for the next window
+    if it is within BULK_MAX_WAIT seconds.
+    """
+    priority = priority or _priority.get()
+    while True:
+        wait = _reserve(priority)
+        if wait is None:
+            return
+        if priority == BULK and wait <= BULK_MAX_WAIT:
+            logger.info("Strava rate limit reached for %s calls. Waiting %.0fs", priority, wait)
+            time.sleep(wait)
+            continue
+        logger.warning("Strava rate limit reached for %s calls. Rejecting for %.0fs", priority, wait)
+        raise StravaRateLimited(wait)
+
+
+def _parse_pair(value: str | None) -> tuple[int, ...] | None:
+    """Strava rate limit headers look like '200,2000' for the 15 minute and daily values"""
+    if not value:
+        return None
+    try:
+        return tuple(int(v) for v in value.split(','))[:2]
+    except ValueError:
+        return None
+
+
+def record_response(status_code: int, headers):
+    """
+    Update the shared usage from Strava's X-RateLimit-Limit and X-RateLimit-Usage response headers,
+    which are more accurate than our own count. Raises StravaRateLimited if Strava rejected the call.
+    """
+    cache = caches[RATE_LIMIT_CACHE]
+    windows = _windows(time.time())
+    limits = _parse_pair(headers.get('X-RateLimit-Limit'))
+    usage = _parse_pair(headers.get('X-RateLimit-Usage'))
+    if limits and usage:
+        cache.set(LIMITS_KEY, limits, timeout=None)
+        for (key, remaining), used in zip(windows, usage):
+            cache.set(key, used, timeout=int(remaining) + 60)
+    if status_code == 429:
+        limits = limits or cache.get(LIMITS_KEY, DEFAULT_LIMITS)
+        usage = usage or (0, 0)
+        # Wait for the daily window if that is the one used up, otherwise the 15 minute window
+        key, remaining = windows[1] if usage[1] >= limits[1] else windows[0]
+        cache.set(key, max(limits), timeout=int(remaining) + 60)
+        raise StravaRateLimited(remaining)
+
+
+def headroom() -> tuple[int, int]:
+    """Calls remaining in the current 15 minute and daily windows"""
+    cache = caches[RATE_LIMIT_CACHE]
+    windows = _windows(time.time())
+    limits = cache.get(LIMITS_KEY, DEFAULT_LIMITS)
+    usage = cache.get_many([key for key, _ in windows])
+    return tuple(max(0, limit - usage.get(key, 0)) for (key, _), limit in zip(windows, limits))
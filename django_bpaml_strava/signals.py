@@ -0,0 +1,62 @@
+# Third-party libraries
+from allauth.socialaccount.models import SocialAccount, SocialToken, SocialApp
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+# Local libraries
+from django_bpaml_strava.course_matching import clear_course_index
+from django_bpaml_strava.database import tune_sqlite_connection
+from django_bpaml_strava.models import Activity, ParkrunCourse, User
+from django_bpaml_strava.page_cache import bump_page_versions, forget_strava_user
+from django_bpaml_strava.standings import update_season_standing
+from django_bpaml_strava.strava_token import clear_strava_token_cache, invalidate_strava_token
+
+
+@receiver(connection_created)
+def database_connected(sender, connection, **kwargs):
+    """Apply the production SQLite pragmas, which only last as long as the connection"""
+    tune_sqlite_connection(connection)
+
+
+@receiver([post_save, post_delete], sender=SocialToken)
+def social_token_changed(sender, instance, **kwargs):
+    """Drop the cached token so the next Strava call sees the saved one"""
+    invalidate_strava_token(instance.account_id)
+
+
+@receiver([post_save, post_delete], sender=SocialApp)
+def social_app_changed(sender, instance, **kwargs):
+    """Cached tokens hold a copy of the app's client id and secret"""
+    clear_strava_token_cache()
+
+
+@receiver([post_save, post_delete], sender=ParkrunCourse)
+def parkrun_course_changed(sender, instance, **kwargs):
+    """Rebuild the course index so new activities are matched against the saved courses"""
+    clear_course_index()
+
+
+@receiver(post_save, sender=Activity)
+def activity_saved(sender, instance, **kwargs):
+    """
+    Keep the athlete's standing for the activity's season up to date. There is deliberately no post_delete
+    receiver because it would stop Django deleting activities with a single query. Code which deletes activities
+    calls update_season_standings and bump_page_versions itself, as does bulk_save_activities which doesn't
+    send post_save. Cached pages showing the athlete are rendered afresh.
+    """
+    update_season_standing(instance.athlete_id, instance.date.year)
+    bump_page_versions([instance.athlete_id])
+
+
+@receiver([post_save, post_delete], sender=User)
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    """Athlete details are shown on the cached pages. Logging in only changes last_login which isn't shown"""
+    if update_fields is None or set(update_fields) != {'last_login'}:
+        bump_page_versions([instance.pk])
+
+
+@receiver([post_save, post_delete], sender=SocialAccount)
+def social_account_changed(sender, instance, **kwargs):
+    """The cached pages show the strava id and find the athlete by it"""
+    forget_strava_user(instance.uid)
+    bump_page_versions([instance.user_id])
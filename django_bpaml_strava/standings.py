@@ -0,0 +1,117 @@
+# Standard libraries
+import datetime
+import functools
+import logging
+import time
+from typing import Iterable
+# Third-party libraries
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Avg, Count, Exists, Max, Min, OuterRef, Q, QuerySet
+from django.db.models.functions import Coalesce, ExtractYear
+from django.utils.module_loading import import_string
+# Local libraries
+from django_bpaml_strava.models import Activity, SeasonStanding
+
+logger = logging.getLogger(__name__)
+
+# Fields of a standing worked out from the athlete's activities
+STANDING_FIELDS = ('run_count', 'best_duration', 'average_duration', 'last_date', 'points')
+
+
+@functools.lru_cache(maxsize=None)
+def get_points_function():
+    """
+    The function named by settings.BPAML_SEASON_POINTS, eg 'myclub.league.points', or None.
+    It is given an unsaved SeasonStanding and returns its points, eg from an age grade or the run count.
+    """
+    path = getattr(settings, 'BPAML_SEASON_POINTS', None)
+    return import_string(path) if path else None
+
+
+def counted_activities(activities):
+    """
+    The activities which count towards standings: those at a parkrun location or with an official result, and
+    those whose distance is within the parkrun rules' distance band. Anything else saved by hand, eg a short jog,
+    would otherwise become the athlete's season best.
+    """
+    # Imported here as parkrun imports ingest, which imports this module
+    from django_bpaml_strava.parkrun import get_parkrun_rules
+    rules = get_parkrun_rules()
+    return activities.filter(~Q(location='') | Q(parkrun_duration__isnull=False)
+                             | Q(distance__gt=rules.min_distance, distance__lt=rules.max_distance))
+
+
+def aggregate_standings(activities) -> list[SeasonStanding]:
+    """Unsaved standings for every athlete and season in the activities queryset which count, using one query"""
+    # The official time, else the time for just the parkrun distance from the streams, else Strava's elapsed time
+    duration = Coalesce('parkrun_duration', 'trimmed_duration', 'strava_duration')
+    rows = (counted_activities(activities)
+            .annotate(season=ExtractYear('date'))
+            .order_by()
+            .values('athlete_id', 'season')
+            .annotate(run_count=Count('id'), best_duration=Min(duration), average_duration=Avg(duration),
+                      last_date=Max('date')))
+    points = get_points_function()
+    standings = []
+    for row in rows:
+        standing = SeasonStanding(**row)
+        if points is not None:
+            standing.points = points(standing)
+        standings.append(standing)
+    return standings
+
+
+def _in_seasons(seasons: set[int]) -> Q:
+    """Activities dated in any of the seasons, as date ranges which can use the (athlete, date) index"""
+    q = Q(pk__in=[])
+    for season in seasons:
+        q |= Q(date__gte=datetime.date(season, 1, 1), date__lt=datetime.date(season + 1, 1, 1))
+    return q
+
+
+def update_season_standing(athlete_id, season: int):
+    """Recalculate one athlete's standing for one season after an activity in it was saved or deleted"""
+    standings = aggregate_standings(Activity.objects.filter(_in_seasons({season}), athlete_id=athlete_id))
+    if not standings:
+        SeasonStanding.objects.filter(athlete_id=athlete_id, season=season).delete()
+        return
+    SeasonStanding.objects.update_or_create(athlete_id=athlete_id, season=season,
+                                            defaults={field: getattr(standings[0], field) for field in STANDING_FIELDS})
+
+
+def update_season_standings(athlete_ids: Iterable[int] | QuerySet, seasons: Iterable[int] = None):
+    """
+    Recalculate the standings of just these athletes, in just these seasons if given, after their activities
+    were saved or deleted. Only their activities are read, using the (athlete, date) index. Standings are
+    updated in place, and those whose season no longer has any counted activities are deleted.
+    athlete_ids may be a values_list queryset, which is used as a subquery rather than run separately.
+    """
+    if not isinstance(athlete_ids, QuerySet):
+        athlete_ids = set(athlete_ids)
+        if not athlete_ids:
+            return
+    activities = Activity.objects.filter(athlete_id__in=athlete_ids)
+    standings = SeasonStanding.objects.filter(athlete_id__in=athlete_ids)
+    if seasons is not None:
+        seasons = set(seasons)
+        activities = activities.filter(_in_seasons(seasons))
+        standings = standings.filter(season__in=seasons)
+    aggregated = aggregate_standings(activities)
+    # No savepoint when called inside the ingest or delete transactions
+    with transaction.atomic(savepoint=False):
+        standings.exclude(Exists(counted_activities(Activity.objects.filter(
+            athlete_id=OuterRef('athlete_id'), date__year=OuterRef('season'))))).delete()
+        SeasonStanding.objects.bulk_create(aggregated, batch_size=500, update_conflicts=True,
+                                           unique_fields=['athlete', 'season'], update_fields=STANDING_FIELDS)
+
+
+def rebuild_season_standings() -> int:
+    """Recalculate every standing from all activities. Returns the number of standings"""
+    t_start = time.perf_counter()
+    standings = aggregate_standings(Activity.objects.all())
+    with transaction.atomic():
+        SeasonStanding.objects.all().delete()
+        SeasonStanding.objects.bulk_create(standings, batch_size=500)
+    logger.info("Rebuilt %s season standings in %.3fs", len(standings), time.perf_counter() - t_start)
+    return len(standings)
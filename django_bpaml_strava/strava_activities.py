@@ -0,0 +1,145 @@
+# Standard libraries
+import datetime
+import logging
+import zoneinfo
+# Local libraries
+from django_bpaml_strava.strava_client import STRAVA_API_URL, STRAVA_PAGE_SIZE, StravaError
+from django_bpaml_strava.strava_client import get_async_client, get_session
+from django_bpaml_strava.strava_token import afetch_strava_token, fetch_strava_token
+
+logger = logging.getLogger(__name__)
+BASE_TZ = zoneinfo.ZoneInfo("Australia/Brisbane")
+
+
+def first_quarter_window(year=None) -> tuple[datetime.datetime, datetime.datetime]:
+    """Start and end of the first three months of the year (default current year) in Brisbane time"""
+    if year is None:
+        year = datetime.datetime.now(BASE_TZ).year
+    return datetime.datetime(year, 1, 1, 0, 0, tzinfo=BASE_TZ), datetime.datetime(year, 4, 1, 0, 0, tzinfo=BASE_TZ)
+
+
+def listing_params(page, after: datetime.datetime = None, before: datetime.datetime = None) -> dict:
+    """Parameters to request one page of an athlete's activities"""
+    params = {
+        'page': page,
+        'per_page': STRAVA_PAGE_SIZE,
+    }
+    if before is not None:
+        params['before'] = int(before.timestamp())
+    if after is not None:
+        params['after'] = int(after.timestamp())
+    return params
+
+
+def fetch_activities_from_strava(strava_id, after: datetime.datetime = None, before: datetime.datetime = None):
+    """Fetch the strava activities for a user between after and before without saving them
+
+    If neither after nor before is given, fetch the first three months of current year.
+    This is a generator which yields one activity at a time and only requests the next page from Strava
+    once the previous page has been consumed. Raises StravaError if Strava rejects a request.
+    """
+    social_token = fetch_strava_token(strava_id)
+
+    if after is None and before is None:
+        after, before = first_quarter_window()
+
+    # Define the endpoint and headers
+    url = f'{STRAVA_API_URL}/athlete/activities'
+    headers = {'Authorization': f'Bearer {social_token.token}'}
+
+    page = 1
+    while True:
+        # Make the GET request with parameters
+        response = get_session().get(url, headers=headers, params=listing_params(page, after, before))
+        # Check if the request was successful
+        if not response.ok:
+            logger.warning("Error requesting activities from strava %s: %s", response.status_code, response.text)
+            raise StravaError(response)
+        activity_data = response.json()
+        logger.debug("Athlete activities for authorized user page %s: %s", page, len(activity_data))
+        yield from activity_data
+        # A short page is the last page
+        if len(activity_data) < STRAVA_PAGE_SIZE:
+            break
+        page += 1
+
+
+async def afetch_activities_from_strava(strava_id, after: datetime.datetime = None, before: datetime.datetime = None):
+    """Async generator version of fetch_activities_from_strava using the pooled httpx client"""
+    social_token = await afetch_strava_token(strava_id)
+
+    if after is None and before is None:
+        after, before = first_quarter_window()
+
+    url = f'{STRAVA_API_URL}/athlete/activities'
+    headers = {'Authorization': f'Bearer {social_token.token}'}
+
+    page = 1
+    while True:
+        response = await get_async_client().get(url, headers=headers, params=listing_params(page, after, before))
+        if not response.is_success:
+            logger.warning("Error requesting activities from strava %s: %s", response.status_code, response.text)
+            raise StravaError(response)
+        activity_data = response.json()
+        logger.debug("Athlete activities for authorized user page %s: %s", page, len(activity_data))
+        for dct_activity in activity_data:
+            yield dct_activity
+        # A short page is the last page
+        if len(activity_data) < STRAVA_PAGE_SIZE:
+            break
+        page += 1
+
+
+def fetch_activity_from_strava(strava_id, activity_id) -> dict:
+    """Fetch a single activity. Raises StravaError if Strava rejects the request"""
+    social_token = fetch_strava_token(strava_id)
+    # Define the endpoint and headers to fetch a single activity
+    url = f'{STRAVA_API_URL}/activities/{activity_id}'
+    headers = {'Authorization': f'Bearer {social_token.token}'}
+
+    # Define parameters for the request. We don't need all efforts for this activity
+    params = {
+        'include_all_efforts': False,
+    }
+
+    # Make the GET request with parameters for single activity
+    response = get_session().get(url, headers=headers, params=params)
+
+    # Check if the request was successful
+    if not response.ok:
+        logger.warning("Error requesting activity from strava %s: %s", response.status_code, response.text)
+        raise StravaError(response)
+    return response.json()
+
+
+async def afetch_activity_from_strava(strava_id, activity_id) -> dict:
+    """Async version of fetch_activity_from_strava"""
+    social_token = await afetch_strava_token(strava_id)
+    url = f'{STRAVA_API_URL}/activities/{activity_id}'
+    headers = {'Authorization': f'Bearer {social_token.token}'}
+    # We don't need all efforts for this activity
+    response = await get_async_client().get(url, headers=headers, params={'include_all_efforts': False})
+    if not response.is_success:
+        logger.warning("Error requesting activity from strava %s: %s", response.status_code, response.text)
+        raise StravaError(response)
+    return response.json()
+
+
+def fetch_activity_streams_from_strava(strava_id, activity_id,
+                                      keys=('time', 'distance', 'latlng', 'heartrate')) -> dict:
+    """
+    Fetch an activity's streams as {key: {'data': [...], ...}}. Strava leaves out streams the activity
+    doesn't have, eg heartrate without a monitor. Raises StravaError if Strava rejects the request
+    """
+    social_token = fetch_strava_token(strava_id)
+    url = f'{STRAVA_API_URL}/activities/{activity_id}/streams'
+    headers = {'Authorization': f'Bearer {social_token.token}'}
+    params = {
+        'keys': ','.join(keys),
+        'key_by_type': True,
+    }
+    response = get_session().get(url, headers=headers, params=params)
+    if not response.ok:
+        logger.warning("Error requesting activity streams from strava %s: %s", response.status_code, response.text)
+        raise StravaError(response)
+    return response.json()
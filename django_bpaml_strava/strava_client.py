@@ -0,0 +1,136 @@
+# Standard libraries
+import asyncio
+import logging
+import threading
+import time
+import weakref
+# Third-party libraries
+from asgiref.sync import sync_to_async
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+# Local libraries
+from django_bpaml_strava import rate_limit
+from django_bpaml_strava.metrics import record_strava_call
+
+logger = logging.getLogger(__name__)
+
+# Can be overridden in settings to point at a stub of the Strava api for offline testing
+STRAVA_API_URL = getattr(settings, 'BPAML_STRAVA_API_URL', 'https://www.strava.com/api/v3')
+STRAVA_TOKEN_URL = f'{STRAVA_API_URL}/oauth/token'
+# Maximum page size allowed by the Strava api for activity listings
+STRAVA_PAGE_SIZE = 200
+# Seconds to connect and to wait for each read, so a stalled Strava can't hold a worker indefinitely
+STRAVA_TIMEOUT = getattr(settings, 'BPAML_STRAVA_TIMEOUT', (5, 30))
+
+_session = None
+_session_lock = threading.Lock()
+# httpx async clients can only be used on the event loop which created them
+_async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+class StravaError(Exception):
+    """Raised when Strava rejects a request so views can decide how to recover"""
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        super().__init__(f"Strava returned {response.status_code}: {response.text}")
+
+
+class StravaSession(requests.Session):
+    """Session which passes every request through the Strava rate governor, with STRAVA_TIMEOUT unless given"""
+
+    def request(self, method, url, *args, **kwargs):
+        # requests has no session wide timeout and waits for ever without one
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = STRAVA_TIMEOUT
+        rate_limit.acquire()
+        t_start = time.perf_counter()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.RequestException:
+            record_strava_call(method, url, 'error', time.perf_counter() - t_start)
+            raise
+        record_strava_call(method, url, response.status_code, time.perf_counter() - t_start)
+        rate_limit.record_response(response.status_code, response.headers)
+        return response
+
+
+class GovernedRetry(Retry):
+    """Retry which reserves another call from the rate governor before each retry, as each uses Strava quota"""
+
+    def increment(self, *args, **kwargs):
+        retry = super().increment(*args, **kwargs)
+        rate_limit.acquire()
+        return retry
+
+
+async def _acquire_rate_limit(request: httpx.Request):
+    # Bulk callers may sleep waiting for the next window so don't block the event loop
+    await sync_to_async(rate_limit.acquire, thread_sensitive=False)()
+
+
+async def _record_rate_limit(response: httpx.Response):
+    await sync_to_async(rate_limit.record_response, thread_sensitive=False)(response.status_code, response.headers)
+
+
+async def _start_timer(request: httpx.Request):
+    request.extensions['bpaml_started'] = time.perf_counter()
+
+
+async def _record_metrics(response: httpx.Response):
+    request = response.request
+    record_strava_call(request.method, request.url, response.status_code,
+                       time.perf_counter() - request.extensions['bpaml_started'])
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the requests session shared by the whole process.
+    Connections to Strava are pooled and kept alive between calls, and idempotent requests
+    are retried with exponential backoff when Strava has a transient failure.
+    Every request goes through the rate governor.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                retry = GovernedRetry(
+                    total=3,
+                    backoff_factor=0.5,
+                    status_forcelist=(500, 502, 503, 504),
+                    respect_retry_after_header=True,
+                    # Return the last response once retries run out so callers raise StravaError as usual
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+                session = StravaSession()
+                session.mount('https://', adapter)
+                # For a stub of the Strava api on plain http, see BPAML_STRAVA_API_URL
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Returns the httpx client shared by all coroutines on the running event loop.
+    Connections to Strava are pooled and kept alive, and failed connections are retried.
+    Every request goes through the rate governor.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        transport = httpx.AsyncHTTPTransport(
+            retries=3,
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
+        )
+        client = _async_clients[loop] = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(STRAVA_TIMEOUT[1], connect=STRAVA_TIMEOUT[0]),
+            event_hooks={'request': [_acquire_rate_limit, _start_timer],
+                         'response': [_record_metrics, _record_rate_limit]},
+        )
+    return client
@@ -1,43 +1,110 @@
 # Standard libraries
 import datetime
 import logging
+import threading
 # Third-party libraries
-from allauth.socialaccount.models import SocialToken, SocialAccount, SocialApp
-import requests
+from allauth.socialaccount.models import SocialToken, SocialApp
+from asgiref.sync import sync_to_async
+# Local libraries
+from django_bpaml_strava.metrics import metrics
+from django_bpaml_strava.strava_client import STRAVA_TOKEN_URL, get_session
 
 logger = logging.getLogger(__name__)
 
+# Tokens which expire within this margin are refreshed so they don't expire part way through a request
+TOKEN_EXPIRY_MARGIN = datetime.timedelta(seconds=60)
 
-def fetch_strava_token(strava_id):
-    """Retrieves token from database and, if expired, refreshes using Strava api"""
-    social_account = SocialAccount.objects.get(uid=strava_id, provider='strava')
-    logger.info(f"Found athlete {social_account.uid}")
-    # Check if user has any social tokens
-    social_tokens = SocialToken.objects.filter(account=social_account)
-    logger.info(f"Found {len(social_tokens)} social tokens")
-    # Get the stored access token for this athlete. social_tokens should actually only be one token
-    strava_token = social_tokens.first()
-    if strava_token.expires_at <= datetime.datetime.now(datetime.timezone.utc):
-        logger.info(f"token expired at {strava_token.expires_at} - refreshing")
-        # https://developers.strava.com/docs/authentication/ "Refreshing Expired Access Tokens"
-        token_url = 'https://www.strava.com/api/v3/oauth/token'
-        strava_app = SocialApp.objects.get(provider='strava')
-        payload = {
-            'client_id': strava_app.client_id,
-            'client_secret': strava_app.secret,
-            'grant_type': 'refresh_token',
-            'refresh_token': strava_token.token_secret
-        }
-        response = requests.post(token_url, data=payload)
-        if response.ok:
-            new_tokens = response.json()
-            # Update the api_key dictionary with the new access and refresh tokens and expiry time
-            strava_token.token = new_tokens['access_token']
-            strava_token.token_secret = new_tokens['refresh_token']
-            strava_token.expires_at = datetime.datetime.fromtimestamp(new_tokens['expires_at'], datetime.timezone.utc)
-            logger.info("Token refreshed successfully.")
-            # Save the refreshed key for a later session
-            strava_token.save()
-        else:
-            logger.info(f"Error refreshing token: {response.status_code} - {response.text}")
+# Tokens cached in this process keyed by strava id. Entries are removed when a token is saved or deleted.
+_token_cache: dict[str, SocialToken] = {}
+# One lock per athlete so only one thread refreshes a given athlete's token at a time
+_refresh_locks: dict[str, threading.Lock] = {}
+_refresh_locks_lock = threading.Lock()
+
+
+def invalidate_strava_token(account_id):
+    """Remove the token for a SocialAccount from the cache so the next fetch reads it from the database"""
+    for strava_id, strava_token in list(_token_cache.items()):
+        if strava_token.account_id == account_id:
+            _token_cache.pop(strava_id, None)
+
+
+def clear_strava_token_cache():
+    """Remove every cached token, eg when the strava SocialApp changes"""
+    _token_cache.clear()
+
+
+def _refresh_lock(strava_id: str) -> threading.Lock:
+    with _refresh_locks_lock:
+        return _refresh_locks.setdefault(strava_id, threading.Lock())
+
+
+def _load_strava_token(strava_id: str) -> SocialToken:
+    """Read the athlete's token, its account and app in one query"""
+    # An athlete should actually only have one token
+    strava_token = (SocialToken.objects
+                    .filter(account__uid=strava_id, account__provider='strava')
+                    .select_related('account', 'app')
+                    .first())
+    if strava_token is None:
+        raise SocialToken.DoesNotExist(f"No strava token for athlete {strava_id}")
+    logger.debug("Found token for athlete %s", strava_id)
     return strava_token
+
+
+def _expires_within(strava_token: SocialToken, margin: datetime.timedelta) -> bool:
+    return strava_token.expires_at <= datetime.datetime.now(datetime.timezone.utc) + margin
+
+
+def _refresh_strava_token(strava_token: SocialToken):
+    """Exchange the refresh token for a new access token and save it"""
+    logger.info("token expires at %s - refreshing", strava_token.expires_at)
+    # https://developers.strava.com/docs/authentication/ "Refreshing Expired Access Tokens"
+    strava_app = strava_token.app or SocialApp.objects.get(provider='strava')
+    payload = {
+        'client_id': strava_app.client_id,
+        'client_secret': strava_app.secret,
+        'grant_type': 'refresh_token',
+        'refresh_token': strava_token.token_secret
+    }
+    response = get_session().post(STRAVA_TOKEN_URL, data=payload)
+    metrics.inc('bpaml_strava_token_refreshes_total', (('outcome', 'success' if response.ok else 'failure'),))
+    if response.ok:
+        new_tokens = response.json()
+        # Update the api_key dictionary with the new access and refresh tokens and expiry time
+        strava_token.token = new_tokens['access_token']
+        strava_token.token_secret = new_tokens['refresh_token']
+        strava_token.expires_at = datetime.datetime.fromtimestamp(new_tokens['expires_at'], datetime.timezone.utc)
+        logger.info("Token refreshed successfully.")
+        # Save the refreshed key for a later session
+        strava_token.save()
+    else:
+        logger.info("Error refreshing token: %s - %s", response.status_code, response.text)
+
+
+def fetch_strava_token(strava_id, min_valid: datetime.timedelta = TOKEN_EXPIRY_MARGIN):
+    """
+    Retrieves token from cache or database and, if it expires within min_valid, refreshes using Strava api.
+    Concurrent requests for the same athlete wait for a single refresh rather than each calling Strava.
+    """
+    strava_id = str(strava_id)
+    strava_token = _token_cache.get(strava_id)
+    if strava_token is None:
+        strava_token = _token_cache[strava_id] = _load_strava_token(strava_id)
+    if not _expires_within(strava_token, min_valid):
+        return strava_token
+    with _refresh_lock(strava_id):
+        # Another thread or process may have refreshed the token while we were waiting so reread it
+        strava_token = _load_strava_token(strava_id)
+        if _expires_within(strava_token, min_valid):
+            _refresh_strava_token(strava_token)
+        # Cache after saving because saving invalidates the cache entry
+        _token_cache[strava_id] = strava_token
+    return strava_token
+
+
+async def afetch_strava_token(strava_id, min_valid: datetime.timedelta = TOKEN_EXPIRY_MARGIN):
+    """Async version of fetch_strava_token which returns a valid cached token without leaving the event loop"""
+    strava_token = _token_cache.get(str(strava_id))
+    if strava_token is not None and not _expires_within(strava_token, min_valid):
+        return strava_token
+    return await sync_to_async(fetch_strava_token)(strava_id, min_valid)
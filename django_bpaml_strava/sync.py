@@ -0,0 +1,47 @@
+# Standard libraries
+import datetime
+import logging
+import time
+# Third-party libraries
+from allauth.socialaccount.models import SocialAccount
+from django.db.models import Max
+# Local libraries
+from django_bpaml_strava.ingest import bulk_save_activities, decode_activities
+from django_bpaml_strava.parkrun import new_parkrun_activities
+from django_bpaml_strava.strava_activities import first_quarter_window, fetch_activities_from_strava
+
+logger = logging.getLogger(__name__)
+
+
+def strava_accounts_with_sync_cursor():
+    """All strava athletes annotated with sync_cursor, the start time of their latest saved activity"""
+    return (SocialAccount.objects.filter(provider='strava')
+            .select_related('user')
+            .annotate(sync_cursor=Max('user__activity__start_time')))
+
+
+def sync_athlete(social_account: SocialAccount, after: datetime.datetime = None) -> dict:
+    """
+    Fetch the athlete's activities which started after the given time and save the Saturday parkruns.
+    If after is not given, it is the athlete's sync cursor, or the start of the year if nothing is saved yet.
+    Returns counts and timings for reporting.
+    """
+    t_start = time.perf_counter()
+    if after is None:
+        after = getattr(social_account, 'sync_cursor', None) or first_quarter_window()[0]
+    user = social_account.user
+    activities = list(decode_activities(user, fetch_activities_from_strava(social_account.uid, after=after)))
+    t_fetched = time.perf_counter()
+    new_activities = new_parkrun_activities(user, activities)
+    saved = bulk_save_activities(new_activities)
+    t_saved = time.perf_counter()
+    result = {
+        'strava_id': social_account.uid,
+        'after': after,
+        'fetched': len(activities),
+        'saved': saved,
+        'fetch_seconds': t_fetched - t_start,
+        'save_seconds': t_saved - t_fetched,
+    }
+    logger.info("Synced athlete %s: %s", social_account.uid, result)
+    return result
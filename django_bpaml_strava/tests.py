@@ -1,3 +1,932 @@
-from django.test import TestCase
+# Standard libraries
+import csv
+import datetime
+import io
+import ipaddress
+import json
+import logging
+import tempfile
+import zoneinfo
+from pathlib import Path
+from unittest import mock
+# Third-party libraries
+from asgiref.sync import async_to_sync
+from allauth.socialaccount.models import SocialAccount, SocialApp, SocialToken
+from django.contrib.auth.models import Permission
+from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db.models import Sum
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+# Local libraries
+from django_bpaml_strava import metrics, rate_limit, webhook
+from django_bpaml_strava.activity_pages import ActivityPage
+from django_bpaml_strava.admin import CachedCountPaginator
+from django_bpaml_strava.async_views import asave_activity
+from django_bpaml_strava.backfill import backfill_athlete, backfill_windows
+from django_bpaml_strava.benchmark import use_fake_strava
+from django_bpaml_strava.course_matching import rematch_locations
+from django_bpaml_strava.export import EXPORT_FIELDS
+from django_bpaml_strava.fake_strava import FAKE_POLYLINE, FakeStravaServer, access_token, refresh_token
+from django_bpaml_strava.fake_strava import strava_activity
+from django_bpaml_strava.ingest import bulk_save_activities, decode_activities
+from django_bpaml_strava.log import RateLimitFilter
+from django_bpaml_strava.models import (Activity, ActivityStream, BackfillWindow, ParkrunCourse, SeasonStanding,
+                                       StravaEvent, User)
+from django_bpaml_strava.parkrun import DEFAULT_PARKRUN_RULES, ParkrunRules, activity_columns
+from django_bpaml_strava.parkrun_results import ParkrunResult, import_results, read_results
+from django_bpaml_strava.polyline import route_hash
+from django_bpaml_strava.query_budget import QueryBudgetExceeded, query_budget
+from django_bpaml_strava.rate_limit import BULK, INTERACTIVE, StravaRateLimited
+from django_bpaml_strava.standings import rebuild_season_standings, update_season_standings
+from django_bpaml_strava.streams import fetch_athlete_streams
+from django_bpaml_strava.strava_activities import fetch_activities_from_strava
+from django_bpaml_strava.strava_client import STRAVA_TIMEOUT, GovernedRetry, get_session
+from django_bpaml_strava.thumbnails import THUMBNAIL_KEY, render_missing_thumbnails, thumbnail_path
 
-# Create your tests here.
+STRAVA_ID = '4242'
+# Tests which touch the cache use this so they never write to the developer's cache from settings,
+# eg fake Strava rate limits which the real rate limiter would then go on using
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def saturday_parkrun(activity_id, weeks_ago, name=None) -> dict:
+    """A Strava activity starting 7am Brisbane time on a Saturday weeks_ago weeks before 4 Jan 2025"""
+    start_time = datetime.datetime(2025, 1, 3, 21, 0, tzinfo=datetime.timezone.utc)
+    return strava_activity(activity_id, start_time - datetime.timedelta(weeks=weeks_ago), name=name)
+
+
+def event_payload(aspect_type, object_id, object_type='activity', updates=None) -> dict:
+    """Body of an event as Strava posts it to the webhook"""
+    return {'aspect_type': aspect_type, 'object_type': object_type, 'object_id': object_id,
+            'owner_id': int(STRAVA_ID), 'event_time': 1735938000, 'subscription_id': 1, 'updates': updates or {}}
+
+
+def strava_athlete() -> SocialAccount:
+    """An athlete with a token the fake Strava server accepts"""
+    app = SocialApp.objects.create(provider='strava', name='Strava', client_id='test', secret='test')
+    user = User.objects.create(username='athlete', first_name='Test', last_name='Athlete')
+    account = SocialAccount.objects.create(user=user, provider='strava', uid=STRAVA_ID)
+    expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=6)
+    SocialToken.objects.create(account=account, app=app, token=access_token(STRAVA_ID),
+                               token_secret=refresh_token(STRAVA_ID), expires_at=expires_at)
+    return account
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StravaWebhookTests(TestCase):
+    """The webhook view queues events and process_strava_events applies them using the fake Strava server"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = cls.enterClassContext(FakeStravaServer(listing_size=0))
+        cls.enterClassContext(use_fake_strava(cls.server))
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = strava_athlete().user
+
+    def setUp(self):
+        cache.clear()
+        self.strava_activities = self.server.activities(STRAVA_ID)
+        self.strava_activities.clear()
+        self.url = reverse('strava-webhook')
+
+    def post_event(self, client, payload):
+        return client.post(self.url, json.dumps(payload), content_type='application/json')
+
+    def test_subscription_handshake(self):
+        params = {'hub.mode': 'subscribe', 'hub.verify_token': 'verify-me', 'hub.challenge': 'challenge-1'}
+        with mock.patch.object(webhook, 'VERIFY_TOKEN', 'verify-me'):
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), {'hub.challenge': 'challenge-1'})
+            response = self.client.get(self.url, {**params, 'hub.verify_token': 'wrong'})
+            self.assertEqual(response.status_code, 403)
+
+    def test_event_post_is_csrf_exempt(self):
+        response = self.post_event(Client(enforce_csrf_checks=True), event_payload('create', 1))
+        self.assertEqual(response.status_code, 200)
+        event = StravaEvent.objects.get()
+        self.assertEqual((event.aspect_type, event.object_id, event.owner_id), ('create', 1, STRAVA_ID))
+        self.assertIsNone(event.processed_at)
+
+    def test_bad_payload_rejected(self):
+        for body in ('not json', json.dumps({'aspect_type': 'create'}),
+                     json.dumps(event_payload('rename', 1)), json.dumps(event_payload('create', 1, 'club'))):
+            with self.subTest(body=body):
+                response = self.client.post(self.url, body, content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+        self.assertFalse(StravaEvent.objects.exists())
+
+    def test_create_update_delete(self):
+        updated, deleted = Activity.objects.bulk_create(decode_activities(self.user, [
+            saturday_parkrun(101, weeks_ago=2), saturday_parkrun(102, weeks_ago=1)]))
+        # Named from an official result, which an update must keep
+        Activity.objects.filter(pk=updated.pk).update(location='Official parkrun')
+        self.strava_activities[101] = saturday_parkrun(101, weeks_ago=2, name='Renamed parkrun')
+        self.strava_activities[103] = saturday_parkrun(103, weeks_ago=0, name='New parkrun')
+        for payload in (event_payload('create', 103), event_payload('update', 101, updates={'title': 'Renamed'}),
+                        event_payload('delete', 102)):
+            self.assertEqual(self.post_event(self.client, payload).status_code, 200)
+
+        stdout = io.StringIO()
+        call_command('process_strava_events', settle=0, stdout=stdout)
+
+        self.assertIn('created 1, updated 1, deleted 1', stdout.getvalue())
+        self.assertEqual(Activity.objects.get(activity_id=103).title, 'New parkrun')
+        updated.refresh_from_db()
+        self.assertEqual((updated.title, updated.location), ('Renamed parkrun', 'Official parkrun'))
+        self.assertFalse(Activity.objects.filter(activity_id=102).exists())
+        self.assertFalse(StravaEvent.objects.filter(processed_at__isnull=True).exists())
+
+    def test_activity_gone_from_strava_is_deleted(self):
+        Activity.objects.bulk_create(decode_activities(self.user, [saturday_parkrun(101, weeks_ago=1)]))
+        self.post_event(self.client, event_payload('update', 101))
+        results = webhook.process_strava_events(settle_seconds=0)
+        self.assertEqual([(r['fetched'], r['deleted']) for r in results], [(0, 1)])
+        self.assertFalse(Activity.objects.exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FetchAthleteStreamsTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = cls.enterClassContext(FakeStravaServer(listing_size=0))
+        cls.enterClassContext(use_fake_strava(cls.server))
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.social_account = strava_athlete()
+
+    def setUp(self):
+        cache.clear()
+
+    def test_fetch_and_save(self):
+        strava_activities = self.server.activities(STRAVA_ID)
+        strava_activities.clear()
+        for activity_id in range(101, 104):
+            strava_activities[activity_id] = saturday_parkrun(activity_id, weeks_ago=activity_id - 100)
+        # 104 has been deleted from Strava
+        Activity.objects.bulk_create(decode_activities(self.social_account.user, [
+            *strava_activities.values(), saturday_parkrun(104, weeks_ago=4)]))
+        with mock.patch('django_bpaml_strava.streams.STREAMS_BATCH_SIZE', 2):
+            result = fetch_athlete_streams(self.social_account)
+        self.assertEqual((result['fetched'], result['missing']), (3, 1))
+        self.assertEqual(ActivityStream.objects.count(), 3)
+        # The fake run stands still for 10 of its 1500 seconds then runs 5 km at an even pace
+        activity = Activity.objects.get(activity_id=101)
+        self.assertEqual(activity.trimmed_duration, datetime.timedelta(seconds=1490))
+        self.assertEqual(len(activity.split_seconds), 5)
+        # Only activities without streams are fetched again
+        self.assertEqual(fetch_athlete_streams(self.social_account)['fetched'], 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BulkSaveActivitiesTests(TestCase):
+
+    def test_skips_saved_activities(self):
+        user = User.objects.create(username='athlete')
+        other_user = User.objects.create(username='other-athlete')
+        Activity.objects.bulk_create(decode_activities(user, [
+            saturday_parkrun(101, weeks_ago=1), saturday_parkrun(102, weeks_ago=2)]))
+        activities = [*decode_activities(user, [
+            saturday_parkrun(101, weeks_ago=1, name='Renamed'), saturday_parkrun(102, weeks_ago=2),
+            saturday_parkrun(103, weeks_ago=3), saturday_parkrun(104, weeks_ago=4)]),
+            # The same Strava activity id for another athlete is a different row
+            *decode_activities(other_user, [saturday_parkrun(101, weeks_ago=1)])]
+        # Small batches so saved and new activities are mixed within and across batches
+        self.assertEqual(bulk_save_activities(iter(activities), batch_size=2), 3)
+        self.assertEqual(sorted(Activity.objects.filter(athlete=user).values_list('activity_id', flat=True)),
+                         [101, 102, 103, 104])
+        self.assertEqual(Activity.objects.filter(athlete=other_user).count(), 1)
+        # Saved activities are left as they were
+        self.assertNotEqual(Activity.objects.get(athlete=user, activity_id=101).title, 'Renamed')
+        self.assertEqual(bulk_save_activities(activities), 0)
+        self.assertEqual(Activity.objects.count(), 5)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class AsyncSaveActivityTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = cls.enterClassContext(FakeStravaServer(listing_size=0))
+        cls.enterClassContext(use_fake_strava(cls.server))
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.social_account = strava_athlete()
+
+    def setUp(self):
+        cache.clear()
+        self.server.activities(STRAVA_ID)[101] = saturday_parkrun(101, weeks_ago=1)
+
+    def save(self):
+        request = RequestFactory().get('/')
+        request.user = self.social_account.user
+
+        async def auser():
+            return request.user
+
+        # As set by AuthenticationMiddleware, for login_required on async views
+        request.auser = auser
+        return async_to_sync(asave_activity)(request, STRAVA_ID, 101)
+
+    def test_only_unsaved_activities_are_fetched(self):
+        self.assertEqual(self.save().status_code, 302)
+        self.assertEqual(Activity.objects.filter(activity_id=101).count(), 1)
+        request_count = self.server.request_count
+        self.assertEqual(self.save().status_code, 302)
+        # Already saved, so Strava wasn't asked for it again
+        self.assertEqual(self.server.request_count, request_count)
+        self.assertEqual(Activity.objects.filter(activity_id=101).count(), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BackfillTests(TransactionTestCase):
+    """Windows are fetched in worker threads with their own connections, so the athlete has to be committed"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = cls.enterClassContext(FakeStravaServer(listing_size=0))
+        cls.enterClassContext(use_fake_strava(cls.server))
+
+    def setUp(self):
+        cache.clear()
+        self.social_account = strava_athlete()
+        strava_activities = self.server.activities(STRAVA_ID)
+        strava_activities.clear()
+        # Saturdays from 28 Dec 2024 back to 24 Aug 2024
+        for week in range(1, 20):
+            strava_activities[100 + week] = saturday_parkrun(100 + week, weeks_ago=week)
+        self.windows = backfill_windows(datetime.date(2024, 8, 1), datetime.date(2024, 12, 31), days=30)
+        self.fetched_windows = []
+
+    def backfill(self, fail_after=None) -> dict:
+        """Backfill one window at a time in order, with Strava refusing the window starting at fail_after"""
+        self.fetched_windows = []
+
+        def fetch_window_activities(strava_id, after, before):
+            self.fetched_windows.append(after)
+            if after == fail_after:
+                raise StravaRateLimited(60)
+            return fetch_activities_from_strava(strava_id, after=after, before=before)
+
+        with mock.patch('django_bpaml_strava.backfill.fetch_activities_from_strava', fetch_window_activities):
+            return backfill_athlete(self.social_account, datetime.date(2024, 8, 1), datetime.date(2024, 12, 31),
+                                    window_days=30, workers=1)
+
+    def test_resumes_from_saved_windows(self):
+        self.assertEqual(len(self.windows), 6)
+        with self.assertRaises(StravaRateLimited):
+            self.backfill(fail_after=self.windows[2][0])
+        # The windows before the failure are saved with their checkpoints
+        self.assertEqual(list(BackfillWindow.objects.order_by('after').values_list('after', 'before')),
+                         self.windows[:2])
+        self.assertEqual(Activity.objects.count(), BackfillWindow.objects.aggregate(Sum('saved'))['saved__sum'])
+
+        result = self.backfill()
+        self.assertEqual(self.fetched_windows, [after for after, _ in self.windows[2:]])
+        self.assertEqual((result['windows'], result['skipped']), (6, 2))
+        self.assertEqual(Activity.objects.count(), 19)
+        self.assertEqual(BackfillWindow.objects.count(), 6)
+
+        # Nothing is left to fetch
+        self.assertEqual(self.backfill()['skipped'], 6)
+        self.assertEqual(self.fetched_windows, [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RematchLocationsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='athlete')
+        ParkrunCourse.objects.create(name='Fake parkrun', polyline=FAKE_POLYLINE)
+        cls.official, cls.matched, cls.unmatched = Activity.objects.bulk_create(decode_activities(cls.user, [
+            saturday_parkrun(101, weeks_ago=2), saturday_parkrun(102, weeks_ago=1), saturday_parkrun(103, weeks_ago=3)]))
+        Activity.objects.filter(pk=cls.official.pk).update(location='Official parkrun',
+                                                          parkrun_duration=datetime.timedelta(minutes=25))
+        Activity.objects.filter(pk=cls.matched.pk).update(location='Somewhere else')
+        # A short run on another route, which only counted in the standings because of its location
+        Activity.objects.filter(pk=cls.unmatched.pk).update(location='Old course', distance=3000,
+                                                            polyline='??_ulLnnqC_mqNvxq`@')
+        rebuild_season_standings()
+
+    def setUp(self):
+        cache.clear()
+
+    def test_rematch_all_keeps_official_locations(self):
+        self.assertEqual(rematch_locations(rematch_all=True), 1)
+        self.assertEqual(dict(Activity.objects.values_list('activity_id', 'location')),
+                         {101: 'Official parkrun', 102: 'Fake parkrun', 103: ''})
+        self.assertEqual(SeasonStanding.objects.get(athlete=self.user, season=2024).run_count, 2)
+
+    def test_rematch_missing_keeps_locations(self):
+        self.assertEqual(rematch_locations(), 0)
+        self.assertEqual(dict(Activity.objects.values_list('activity_id', 'location')),
+                         {101: 'Official parkrun', 102: 'Somewhere else', 103: 'Old course'})
+        self.assertEqual(SeasonStanding.objects.get(athlete=self.user, season=2024).run_count, 3)
+
+
+class ParkrunRulesTests(SimpleTestCase):
+
+    def rules(self, **rules):
+        return ParkrunRules(**{**DEFAULT_PARKRUN_RULES, **rules})
+
+    def columns(self, *activities):
+        """Columns of (athlete, Brisbane start time, metres, seconds) activities"""
+        athletes, start_times, distances, seconds = zip(*activities)
+        brisbane = zoneinfo.ZoneInfo('Australia/Brisbane')
+        return activity_columns(athletes, [datetime.datetime.fromisoformat(t).replace(tzinfo=brisbane)
+                                           for t in start_times],
+                                ['Australia/Brisbane'] * len(activities), distances,
+                                [datetime.timedelta(seconds=s) for s in seconds])
+
+    def test_time_window(self):
+        # 4 Jan 2025 was a Saturday
+        columns = self.columns((1, '2025-01-04 00:00', 5000, 1500), (1, '2025-01-04 07:09:59', 5000, 1500),
+                               (1, '2025-01-04 07:10', 5000, 1500), (1, '2025-01-03 07:00', 5000, 1500),
+                               (1, '2025-01-05 07:00', 5000, 1500))
+        self.assertEqual(self.rules().evaluate(columns).tolist(), [True, True, False, False, False])
+        # Start times are compared in the activity's timezone
+        utc_columns = activity_columns([1], [datetime.datetime(2025, 1, 3, 21, 0, tzinfo=datetime.timezone.utc)],
+                                       ['Australia/Brisbane'], [5000], [None])
+        self.assertEqual(self.rules().evaluate(utc_columns).tolist(), [True])
+
+    def test_distance_band(self):
+        columns = self.columns(*[(1, '2025-01-04 07:00', distance, 1500) for distance in (4700, 4701, 5299, 5300)])
+        self.assertEqual(self.rules().evaluate(columns).tolist(), [False, True, True, False])
+        self.assertEqual(self.rules(min_distance=4000, max_distance=5000).evaluate(columns).tolist(),
+                         [True, True, False, False])
+
+    def test_special_events(self):
+        # Christmas Day 2024 was a Wednesday
+        columns = self.columns((1, '2024-12-25 08:00', 5000, 1500), (1, '2024-12-25 09:10', 5000, 1500),
+                               (1, '2024-12-26 08:00', 5000, 1500))
+        self.assertEqual(self.rules().evaluate(columns).tolist(), [False, False, False])
+        christmas = self.rules(special_events=[('12-25', '00:00', '09:10')])
+        self.assertEqual(christmas.evaluate(columns).tolist(), [True, False, False])
+
+    def test_tie_breaks(self):
+        columns = self.columns(
+            (1, '2025-01-04 06:50', 5250, 1500),
+            (1, '2025-01-04 06:00', 5100, 1800),
+            (1, '2025-01-04 06:30', 4990, 1700),
+            (1, '2025-01-04 06:40', 5200, 1400),
+            # Not a parkrun distance, so never chosen even though it's earliest, closest and fastest
+            (1, '2025-01-04 05:00', 3000, 900),
+            # Another athlete and another date are kept whatever the tie break
+            (2, '2025-01-04 06:00', 5000, 1500),
+            (1, '2024-12-28 07:00', 5000, 1500),
+        )
+        for tie_break, winner in (('first', 0), ('earliest', 1), ('closest', 2), ('fastest', 3)):
+            with self.subTest(tie_break):
+                self.assertEqual(self.rules(tie_break=tie_break).select(columns).tolist(), [winner, 5, 6])
+
+    def test_unknown_tie_break(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.rules(tie_break='latest')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StravaSessionTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    @mock.patch('requests.Session.request')
+    def test_default_timeout(self, request):
+        request.return_value = mock.Mock(status_code=200, headers={})
+        session = get_session()
+        session.get('https://www.strava.com/api/v3/athlete')
+        self.assertEqual(request.call_args.kwargs['timeout'], STRAVA_TIMEOUT)
+        session.get('https://www.strava.com/api/v3/athlete', timeout=1)
+        self.assertEqual(request.call_args.kwargs['timeout'], 1)
+
+    def test_retries_http_and_https(self):
+        for url in ('https://www.strava.com/api/v3', 'http://127.0.0.1:8001/api/v3'):
+            with self.subTest(url):
+                self.assertIsInstance(get_session().get_adapter(url).max_retries, GovernedRetry)
+
+
+class RateLimitFilterTests(SimpleTestCase):
+
+    def record(self, msg, *args):
+        return logging.LogRecord('bpaml', logging.INFO, __file__, 1, msg, args, None)
+
+    @mock.patch('django_bpaml_strava.log.time.monotonic')
+    def test_limits_each_template(self, monotonic):
+        monotonic.return_value = 0.0
+        rate_limit = RateLimitFilter(rate=2, per=60)
+        # Messages with different arguments count against the same template
+        self.assertEqual([rate_limit.filter(self.record('Synced athlete %s', i)) for i in range(4)],
+                         [True, True, False, False])
+        self.assertTrue(rate_limit.filter(self.record('Deleted %s activities', 1)))
+        self.assertTrue(rate_limit.filter(logging.LogRecord('bpaml', logging.WARNING, __file__, 1, 'Synced athlete %s',
+                                                            (5,), None)))
+        monotonic.return_value = 61.0
+        record = self.record('Synced athlete %s', 6)
+        self.assertTrue(rate_limit.filter(record))
+        self.assertEqual(record.getMessage(), 'Synced athlete 6 [2 similar messages dropped]')
+
+    @mock.patch('django_bpaml_strava.log.time.monotonic')
+    def test_forgets_expired_templates(self, monotonic):
+        monotonic.return_value = 0.0
+        rate_limit = RateLimitFilter(rate=1, per=60)
+        for i in range(100):
+            rate_limit.filter(self.record(f'Message {i}'))
+        rate_limit.filter(self.record('Repeated'))
+        rate_limit.filter(self.record('Repeated'))
+        monotonic.return_value = 61.0
+        rate_limit.filter(self.record('Latest'))
+        # The repeated message's counter is kept until it can report what was dropped
+        self.assertEqual(set(rate_limit._counts), {('bpaml', 'Repeated'), ('bpaml', 'Latest')})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StravaRateLimitTests(TestCase):
+    """Calls are counted in the cache, so these only assume a test doesn't straddle the start of a 15 minute window"""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_bulk_share(self):
+        # Strava's limits as its headers give them, with nothing used yet
+        rate_limit.record_response(200, {'X-RateLimit-Limit': '8,1000', 'X-RateLimit-Usage': '0,0'})
+        with mock.patch('django_bpaml_strava.rate_limit.BULK_MAX_WAIT', 0):
+            for _ in range(int(8 * rate_limit.BULK_SHARE)):
+                rate_limit.acquire(BULK)
+            with self.assertRaises(StravaRateLimited):
+                rate_limit.acquire(BULK)
+        # Interactive calls may still use the rest of the limit
+        rate_limit.acquire(INTERACTIVE)
+        rate_limit.acquire(INTERACTIVE)
+        self.assertEqual(rate_limit.headroom(), (0, 992))
+        with self.assertRaises(StravaRateLimited):
+            rate_limit.acquire(INTERACTIVE)
+
+    def test_limits_from_headers(self):
+        self.assertEqual(rate_limit.headroom(), rate_limit.DEFAULT_LIMITS)
+        rate_limit.record_response(200, {'X-RateLimit-Limit': '100,1000', 'X-RateLimit-Usage': '99,500'})
+        self.assertEqual(rate_limit.headroom(), (1, 500))
+        rate_limit.acquire(INTERACTIVE)
+        with self.assertRaises(StravaRateLimited):
+            rate_limit.acquire(INTERACTIVE)
+        # Malformed headers are ignored
+        rate_limit.record_response(200, {'X-RateLimit-Limit': 'lots', 'X-RateLimit-Usage': '1,1'})
+        self.assertEqual(rate_limit.headroom(), (0, 499))
+
+    def test_rejected_call_shows_retry_after(self):
+        social_account = strava_athlete()
+        self.client.force_login(social_account.user)
+        # Strava rejected a call as the 15 minute window is used up
+        with self.assertRaises(StravaRateLimited) as rejected:
+            rate_limit.record_response(429, {'X-RateLimit-Limit': '100,1000', 'X-RateLimit-Usage': '100,200'})
+        self.assertTrue(1 <= rejected.exception.retry_after <= 15 * 60)
+        self.assertEqual(rate_limit.headroom(), (0, 800))
+        # so a page which has to call Strava asks the user to come back rather than calling it
+        response = self.client.get(reverse('save-activity', args=[STRAVA_ID, 101]))
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(1 <= int(response['Retry-After']) <= 15 * 60)
+        self.assertContains(response, 'Strava is busy', status_code=429)
+        self.assertFalse(Activity.objects.exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RouteThumbnailTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.social_account = strava_athlete()
+        Activity.objects.bulk_create(decode_activities(cls.social_account.user, [
+            saturday_parkrun(101, weeks_ago=2), saturday_parkrun(102, weeks_ago=1)]))
+
+    def setUp(self):
+        self.tmp_dir = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(mock.patch('django_bpaml_strava.thumbnails.THUMBNAIL_DIR', Path(self.tmp_dir)))
+        self.client.force_login(self.social_account.user)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+    def test_athlete_page_links_thumbnail(self):
+        digest = route_hash(FAKE_POLYLINE)
+        self.assertEqual(set(Activity.objects.values_list('route_hash', flat=True)), {digest})
+        response = self.client.get(reverse('view-activities', args=[STRAVA_ID]))
+        url = reverse('route-thumbnail', args=[THUMBNAIL_KEY, digest])
+        # Both activities have the same route
+        self.assertContains(response, f'src="{url}"', count=2)
+        # The page doesn't read any polylines, so the thumbnail is rendered when it's first requested
+        self.assertFalse(thumbnail_path(digest).exists())
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertTrue(thumbnail_path(digest).exists())
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'<svg'))
+        # and then served from its file
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_unknown_thumbnail(self):
+        digest = route_hash(FAKE_POLYLINE)
+        self.assertEqual(self.client.get(reverse('route-thumbnail', args=[THUMBNAIL_KEY, '0' * 64])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('route-thumbnail', args=[THUMBNAIL_KEY, 'not-a-digest'])).status_code,
+                         404)
+        self.assertEqual(self.client.get(reverse('route-thumbnail', args=['v0-64', digest])).status_code, 404)
+
+    def test_render_missing_thumbnails(self):
+        self.assertEqual(render_missing_thumbnails()['rendered'], 1)
+        self.assertTrue(thumbnail_path(route_hash(FAKE_POLYLINE)).exists())
+        self.assertEqual(render_missing_thumbnails()['rendered'], 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PrometheusMetricsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.url = reverse('metrics')
+
+    @mock.patch.object(metrics, 'ALLOWED_IPS', [])
+    @mock.patch.object(metrics, 'TOKEN', None)
+    def test_denied_by_default(self):
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    @mock.patch.object(metrics, 'ALLOWED_IPS', [ipaddress.ip_network('10.0.0.0/8')])
+    @mock.patch.object(metrics, 'TOKEN', None)
+    def test_allowed_ips(self):
+        self.assertEqual(self.client.get(self.url, REMOTE_ADDR='10.1.2.3').status_code, 200)
+        self.assertEqual(self.client.get(self.url, REMOTE_ADDR='192.168.1.1').status_code, 403)
+
+    @mock.patch.object(metrics, 'ALLOWED_IPS', [])
+    @mock.patch.object(metrics, 'TOKEN', 'scrape-me')
+    def test_bearer_token(self):
+        response = self.client.get(self.url, headers={'Authorization': 'Bearer scrape-me'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'bpaml_strava_rate_limit_headroom', response.content)
+        response = self.client.get(self.url, headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(response.status_code, 403)
+
+
+@query_budget(queries=1)
+def two_query_view(request):
+    list(User.objects.all())
+    list(Activity.objects.all())
+    return HttpResponse()
+
+
+@query_budget(queries=1)
+async def async_two_query_view(request):
+    await User.objects.acount()
+    await Activity.objects.acount()
+    return HttpResponse()
+
+
+class QueryBudgetTests(TestCase):
+
+    def setUp(self):
+        self.request = RequestFactory().get('/')
+
+    @override_settings(BPAML_QUERY_BUDGET_STRICT=True)
+    def test_strict_raises(self):
+        with self.assertRaisesMessage(QueryBudgetExceeded, 'two_query_view exceeded its query budget: 2 queries > 1'):
+            two_query_view(self.request)
+        with self.assertRaises(QueryBudgetExceeded):
+            async_to_sync(async_two_query_view)(self.request)
+
+    @override_settings(BPAML_QUERY_BUDGET_STRICT=False)
+    def test_otherwise_logs(self):
+        with self.assertLogs('django_bpaml_strava.query_budget', 'WARNING') as logs:
+            self.assertEqual(two_query_view(self.request).status_code, 200)
+        self.assertIn('2 queries > 1', logs.output[0])
+
+
+@override_settings(BPAML_QUERY_BUDGET_STRICT=True, CACHES=LOCMEM_CACHES)
+class PageQueryTests(TestCase):
+    """The main pages run the same few queries however many athletes and activities there are"""
+
+    @classmethod
+    def setUpTestData(cls):
+        SocialApp.objects.create(provider='strava', name='Strava', client_id='test', secret='test')
+        for i in range(3):
+            user = User.objects.create(username=f'athlete-{i}', first_name='Test', last_name=f'Athlete {i}')
+            SocialAccount.objects.create(user=user, provider='strava', uid=str(1000 + i))
+            Activity.objects.bulk_create(decode_activities(user, [
+                saturday_parkrun(100 * i + week, weeks_ago=week) for week in range(20)]))
+        rebuild_season_standings()
+
+    def setUp(self):
+        cache.clear()
+        self.enterContext(mock.patch('django_bpaml_strava.thumbnails.THUMBNAIL_DIR',
+                                     Path(self.enterContext(tempfile.TemporaryDirectory()))))
+        # Signed in, so the session and user are read too
+        self.client.force_login(User.objects.get(username='athlete-0'))
+
+    def assertQueries(self, url, uncached, cached):
+        with self.assertNumQueries(uncached):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        # The second request is served from the cached page fragments
+        with self.assertNumQueries(cached):
+            self.client.get(url)
+
+    def test_index(self):
+        self.assertQueries(reverse('index'), uncached=3, cached=2)
+
+    def test_athlete(self):
+        self.assertQueries(reverse('athlete', args=['1000']), uncached=5, cached=2)
+
+    def test_leaderboard(self):
+        self.assertQueries(reverse('leaderboard-season', args=[2024]), uncached=3, cached=2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ActivityPaginationTests(TestCase):
+    """Pages of an athlete's activities are fetched by cursor, in (start_time, id) order"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.social_account = strava_athlete()
+        start_time = datetime.datetime(2025, 1, 3, 21, 0, tzinfo=datetime.timezone.utc)
+        Activity.objects.bulk_create(decode_activities(cls.social_account.user, [
+            *[saturday_parkrun(100 + week, weeks_ago=week) for week in range(1, 5)],
+            # Three activities starting at the same time, which only the id orders
+            *[strava_activity(activity_id, start_time) for activity_id in (203, 201, 202)]]))
+        cls.expected = list(Activity.objects.order_by('start_time', 'id').values_list('activity_id', flat=True))
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.social_account.user)
+
+    def test_pages(self):
+        user_id = self.social_account.user_id
+        activity_ids, cursors = [], []
+        cursor = None
+        while True:
+            page = ActivityPage(user_id, cursor, size=2)
+            activity_ids += [activity.activity_id for activity in page.activities]
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+            cursors.append(cursor)
+        # Every activity exactly once, including those with the same start time split across pages
+        self.assertEqual(activity_ids, self.expected)
+        self.assertEqual(len(cursors), 3)
+        # A cursor is a position rather than an offset, so an activity saved before it doesn't shift the page
+        page = [activity.activity_id for activity in ActivityPage(user_id, cursors[1], size=2).activities]
+        Activity.objects.bulk_create(decode_activities(self.social_account.user,
+                                                       [saturday_parkrun(110, weeks_ago=10)]))
+        self.assertEqual([activity.activity_id for activity in ActivityPage(user_id, cursors[1], size=2).activities],
+                         page)
+
+    def test_api(self):
+        url = reverse('api-activities', args=[STRAVA_ID])
+        activity_ids = []
+        params = {'limit': 3}
+        while True:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            activity_ids += [activity['activity_id'] for activity in data['activities']]
+            if data['next'] is None:
+                break
+            params['after'] = data['next']
+        self.assertEqual(activity_ids, self.expected)
+        self.assertEqual(data['activities'][-1]['strava_duration'], 1500)
+
+    def test_bad_cursor(self):
+        for url in (reverse('api-activities', args=[STRAVA_ID]), reverse('view-activities', args=[STRAVA_ID])):
+            with self.subTest(url):
+                self.assertEqual(self.client.get(url, {'after': 'not a cursor'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api-activities', args=[STRAVA_ID]), {'limit': 'all'}).status_code,
+                         400)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ExportActivitiesTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.social_account = strava_athlete()
+        Activity.objects.bulk_create(decode_activities(cls.social_account.user, [
+            saturday_parkrun(101, weeks_ago=0), saturday_parkrun(102, weeks_ago=1)]))
+        cls.other_user = User.objects.create(username='other-athlete', first_name='Other', last_name='Athlete')
+        SocialAccount.objects.create(user=cls.other_user, provider='strava', uid='1001')
+        Activity.objects.bulk_create(decode_activities(cls.other_user, [saturday_parkrun(201, weeks_ago=0)]))
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.social_account.user)
+
+    def export(self, export_format='ndjson', **params) -> str:
+        response = self.client.get(reverse('export-activities', args=[export_format]), params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def exported_ids(self, **params) -> list[int]:
+        return [json.loads(line)['activity_id'] for line in self.export(**params).splitlines()]
+
+    def test_csv(self):
+        rows = list(csv.DictReader(io.StringIO(self.export('csv'))))
+        self.assertEqual([row['activity_id'] for row in rows], ['101', '102'])
+        self.assertEqual(rows[0]['strava_id'], STRAVA_ID)
+        self.assertEqual(rows[0]['date'], '2025-01-04')
+        self.assertEqual(rows[0]['strava_duration'], '1500.0')
+        self.assertEqual(rows[0]['parkrun_duration'], '')
+
+    def test_ndjson(self):
+        row = json.loads(self.export().splitlines()[0])
+        self.assertEqual(list(row), list(EXPORT_FIELDS))
+        self.assertEqual((row['first_name'], row['strava_duration'], row['parkrun_duration']), ('Test', 1500, None))
+
+    def test_streamed(self):
+        response = self.client.get(reverse('export-activities', args=['ndjson']))
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertIn('attachment', response['Content-Disposition'])
+        with mock.patch('django_bpaml_strava.export.LINES_PER_CHUNK', 1):
+            # A chunk for each line, with the rows read as the response is written
+            response = self.client.get(reverse('export-activities', args=['ndjson']))
+            self.assertEqual(len(list(response.streaming_content)), 2)
+
+    def test_filters(self):
+        self.assertEqual(self.exported_ids(season=2025), [101])
+        self.assertEqual(self.exported_ids(season=2024), [102])
+        self.assertEqual(self.client.get(reverse('export-activities', args=['ndjson']), {'season': 'this'}).status_code,
+                         400)
+        self.assertEqual(self.client.get(reverse('export-activities', args=['xml'])).status_code, 400)
+
+    def test_own_activities(self):
+        self.assertEqual(self.exported_ids(), [101, 102])
+        self.assertEqual(self.exported_ids(athlete='1001'), [])
+
+    def test_whole_club(self):
+        user = self.social_account.user
+        user.user_permissions.add(Permission.objects.get(codename='view_activity'))
+        self.assertEqual(self.exported_ids(), [101, 102, 201])
+        self.assertEqual(self.exported_ids(athlete='1001'), [201])
+        self.client.force_login(User.objects.create(username='staff', is_staff=True))
+        self.assertEqual(self.exported_ids(), [101, 102, 201])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ParkrunResultsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='athlete', parkrun_id=1234)
+        start_time = datetime.datetime(2025, 1, 3, 21, 0, tzinfo=datetime.timezone.utc)
+        Activity.objects.bulk_create(decode_activities(cls.user, [
+            saturday_parkrun(101, weeks_ago=0), strava_activity(102, start_time + datetime.timedelta(hours=1)),
+            saturday_parkrun(103, weeks_ago=1)]))
+        cls.other_user = User.objects.create(username='other-athlete', parkrun_id=5678)
+        cls.no_barcode_user = User.objects.create(username='no-barcode')
+        for user in (cls.other_user, cls.no_barcode_user):
+            Activity.objects.bulk_create(decode_activities(user, [saturday_parkrun(user.pk * 100, weeks_ago=0)]))
+        rebuild_season_standings()
+
+    def setUp(self):
+        cache.clear()
+
+    def test_import_results(self):
+        saturday = datetime.date(2025, 1, 4)
+        results = [
+            ParkrunResult(1234, saturday, 'New Farm', datetime.timedelta(minutes=21, seconds=30)),
+            # No event, so the activity keeps its location
+            ParkrunResult(5678, saturday, '', datetime.timedelta(minutes=25)),
+            # No activity on the date, and no club member with the id
+            ParkrunResult(5678, saturday - datetime.timedelta(weeks=1), 'Kedron', datetime.timedelta(minutes=25)),
+            ParkrunResult(9999, saturday, 'New Farm', datetime.timedelta(minutes=20)),
+        ]
+        with self.assertNumQueries(1):
+            summary = import_results(results, dry_run=True)
+        self.assertEqual((summary['results'], summary['matched'], summary['unmatched']), (4, 2, 2))
+        self.assertFalse(Activity.objects.filter(parkrun_duration__isnull=False).exists())
+
+        import_results(results)
+        updated = {(a.athlete_id, a.activity_id): (a.parkrun_duration, a.location)
+                   for a in Activity.objects.filter(parkrun_duration__isnull=False)}
+        other_activity = Activity.objects.get(athlete=self.other_user)
+        # Only the first of the athlete's two activities on the day
+        self.assertEqual(updated, {
+            (self.user.pk, 101): (datetime.timedelta(minutes=21, seconds=30), 'New Farm'),
+            (self.other_user.pk, other_activity.activity_id): (datetime.timedelta(minutes=25),
+                                                               other_activity.location)})
+        # Official times count in the season standings
+        self.assertEqual(SeasonStanding.objects.get(athlete=self.user, season=2025).best_duration,
+                         datetime.timedelta(minutes=21, seconds=30))
+
+    def test_read_results(self):
+        results, errors = read_results(io.StringIO(
+            'parkrun_id,date,event,time,position\n'
+            'A1234,04/01/2025,New Farm,21:30,12\n'
+            '5678,2024-12-28,Kedron,1:02:03\n'
+            'A1234,04/01/2025,New Farm\n'
+            'A1234,32/01/2025,New Farm,21:30\n'))
+        self.assertEqual(results, [
+            ParkrunResult(1234, datetime.date(2025, 1, 4), 'New Farm', datetime.timedelta(minutes=21, seconds=30)),
+            ParkrunResult(5678, datetime.date(2024, 12, 28), 'Kedron', datetime.timedelta(hours=1, seconds=123))])
+        self.assertEqual([error.split(':')[0] for error in errors], ['line 4', 'line 5'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SeasonStandingTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='athlete')
+
+    def save(self, activity_id, weeks_ago, distance=5000.0, elapsed_seconds=1500):
+        dct_activity = saturday_parkrun(activity_id, weeks_ago)
+        dct_activity.update(distance=distance, elapsed_time=elapsed_seconds)
+        activity, = decode_activities(self.user, [dct_activity])
+        activity.save()
+        return activity
+
+    def standings(self):
+        return {s.season: (s.run_count, s.best_duration) for s in SeasonStanding.objects.filter(athlete=self.user)}
+
+    def test_only_parkruns_count(self):
+        self.save(1, weeks_ago=1, elapsed_seconds=1500)
+        # A short jog, quicker than any parkrun, saved by hand
+        jog = self.save(2, weeks_ago=2, distance=2000.0, elapsed_seconds=600)
+        self.assertEqual(self.standings(), {2024: (1, datetime.timedelta(seconds=1500))})
+        # Unless it was at a parkrun
+        Activity.objects.filter(pk=jog.pk).update(location='Fake parkrun')
+        update_season_standings([self.user.pk])
+        self.assertEqual(self.standings(), {2024: (2, datetime.timedelta(seconds=600))})
+
+    def test_standing_updated_in_place(self):
+        self.save(1, weeks_ago=0, elapsed_seconds=1500)
+        self.save(2, weeks_ago=1, elapsed_seconds=1400)
+        standing_pks = dict(SeasonStanding.objects.values_list('season', 'pk'))
+        self.assertEqual(set(standing_pks), {2024, 2025})
+        # Saving into 2024 updates its standing in place
+        self.save(3, weeks_ago=2, elapsed_seconds=1300)
+        self.assertEqual(self.standings(), {2024: (2, datetime.timedelta(seconds=1300)),
+                                            2025: (1, datetime.timedelta(seconds=1500))})
+        self.assertEqual(dict(SeasonStanding.objects.values_list('season', 'pk')), standing_pks)
+
+    def test_delete_last_activity_of_a_season(self):
+        self.save(1, weeks_ago=0)
+        self.save(2, weeks_ago=1)
+        Activity.objects.filter(activity_id=1).delete()
+        update_season_standings([self.user.pk], seasons=[2025])
+        self.assertEqual(set(self.standings()), {2024})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class AdminTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        for i in range(3):
+            user = User.objects.create(username=f'athlete-{i}')
+            Activity.objects.bulk_create(decode_activities(user, [
+                saturday_parkrun(100 * i + week, weeks_ago=week, name=f'Run of athlete-{i}') for week in range(2)]))
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.admin_user)
+        self.url = reverse('admin:django_bpaml_strava_activity_changelist')
+
+    def test_athlete_filter(self):
+        response = self.client.get(self.url, {'athlete': 'athlete-1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 2)
+        self.assertContains(response, 'Run of athlete-1')
+        self.assertNotContains(response, 'Run of athlete-2')
+        # The sidebar has a box to type in rather than a link for every athlete
+        self.assertContains(response, 'name="athlete" value="athlete-1"')
+        self.assertNotContains(response, '?athlete=athlete-2')
+        # Other filters are kept when a username is typed
+        response = self.client.get(self.url, {'athlete': 'athlete-1', 'date__year': '2024'})
+        self.assertEqual(response.context['cl'].result_count, 1)
+        self.assertContains(response, '<input type="hidden" name="date__year" value="2024">')
+
+    def test_user_changelist(self):
+        response = self.client.get(reverse('admin:django_bpaml_strava_user_changelist'))
+        self.assertEqual(response.status_code, 200)
+        changelist = response.context['cl']
+        self.assertIsInstance(changelist.paginator, CachedCountPaginator)
+        self.assertFalse(changelist.show_full_result_count)
+        self.assertEqual([user.username for user in changelist.result_list],
+                         ['admin', 'athlete-0', 'athlete-1', 'athlete-2'])
+
+    def test_delete_seasons_needs_activity_delete_permission(self):
+        staff = User.objects.create(username='staff', is_staff=True)
+        staff.user_permissions.set(Permission.objects.filter(
+            codename__in=['view_seasonstanding', 'change_seasonstanding', 'delete_seasonstanding']))
+        self.client.force_login(staff)
+        url = reverse('admin:django_bpaml_strava_seasonstanding_changelist')
+        self.assertNotContains(self.client.get(url), 'value="delete_seasons"')
+        staff.user_permissions.add(Permission.objects.get(codename='delete_activity'))
+        self.assertContains(self.client.get(url), 'value="delete_seasons"')
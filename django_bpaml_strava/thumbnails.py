@@ -0,0 +1,121 @@
+"""
+Small SVG route maps of saved activities, rendered on the server so pages never ship polylines to the browser.
+Each thumbnail is saved in BPAML_THUMBNAIL_DIR under the route_hash of its polyline, which is worked out once at
+ingest and saved on the activity, so activities on the same route share one file, a changed route gets a new file
+and a saved file never has to be invalidated. Files are served at a URL containing THUMBNAIL_KEY and the hash which
+browsers may cache for a year, and pages build that URL from the saved hash without reading any polylines.
+Thumbnails are pre-generated in bulk by the render_route_thumbnails command and a missing one is rendered
+the first time it is requested.
+"""
+# Standard libraries
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Optional, Sequence
+# Third-party libraries
+import numpy as np
+from django.conf import settings
+# Local libraries
+from django_bpaml_strava.models import Activity
+from django_bpaml_strava.polyline import decode_polylines, route_hash, simplify, to_metres
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_DIR = Path(getattr(settings, 'BPAML_THUMBNAIL_DIR', Path(settings.BASE_DIR) / 'thumbnails'))
+# Width and height in pixels
+THUMBNAIL_SIZE = getattr(settings, 'BPAML_THUMBNAIL_SIZE', 64)
+# Pixels of margin inside the edges
+THUMBNAIL_PADDING = 3
+THUMBNAIL_STROKE = '#fc4c02'
+# Points further than this many pixels from the simplified route are kept
+SIMPLIFY_PIXELS = 0.5
+# Change when the drawing changes so thumbnails get new URLs rather than old drawings being served
+THUMBNAIL_VERSION = 1
+# Part of every thumbnail's URL and path, so drawings of another version or size are never mixed up
+THUMBNAIL_KEY = f'v{THUMBNAIL_VERSION}-{THUMBNAIL_SIZE}'
+
+
+def thumbnail_path(digest: str) -> Path:
+    # Spread over 256 directories so none gets too many files
+    return THUMBNAIL_DIR / THUMBNAIL_KEY / digest[:2] / f'{digest}.svg'
+
+
+def route_svg(route: np.ndarray, size: int = THUMBNAIL_SIZE) -> str:
+    """SVG drawing of a route of (n, 2) latitude, longitude points scaled to fit a size by size square"""
+    if len(route) < 2:
+        return f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}"/>'
+    # x east and y north in metres, then flipped as SVG y runs down the page
+    xy = to_metres(route, route.mean(axis=0))[:, ::-1] * [1, -1]
+    low, high = xy.min(axis=0), xy.max(axis=0)
+    scale = (size - 2 * THUMBNAIL_PADDING) / max((high - low).max(), 1.0)
+    # Centre the route in the square
+    xy = (xy - (low + high) / 2) * scale + size / 2
+    xy = simplify(xy, SIMPLIFY_PIXELS)
+    points = ' '.join(f'{x:.1f},{y:.1f}' for x, y in xy)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" viewBox="0 0 {size} {size}">'
+            f'<polyline points="{points}" fill="none" stroke="{THUMBNAIL_STROKE}" stroke-width="2" '
+            f'stroke-linejoin="round" stroke-linecap="round"/></svg>')
+
+
+def render_thumbnails(polylines: Sequence[str]) -> dict[str, bytes]:
+    """SVGs of the polylines keyed by route_hash, decoding them all together"""
+    return {route_hash(polyline): route_svg(route).encode()
+            for polyline, route in zip(polylines, decode_polylines(polylines))}
+
+
+def save_thumbnail(digest: str, svg: bytes):
+    path = thumbnail_path(digest)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'{digest}.{uuid.uuid4().hex}.tmp')
+    tmp_path.write_bytes(svg)
+    # Atomic so a request never reads a partly written file
+    os.replace(tmp_path, path)
+
+
+def get_thumbnail(digest: str) -> Optional[Path]:
+    """
+    Path of the thumbnail of the route with this route_hash, rendering and saving it first if it hasn't been
+    already. None if no saved activity has the route.
+    """
+    path = thumbnail_path(digest)
+    if path.exists():
+        return path
+    # route_hash is indexed, so only one row's polyline is read
+    polyline = Activity.objects.filter(route_hash=digest).values_list('polyline', flat=True).first()
+    if polyline is None:
+        return None
+    for svg in render_thumbnails([polyline]).values():
+        save_thumbnail(digest, svg)
+    return path
+
+
+def render_missing_thumbnails(queryset=None, batch_size=2000) -> dict:
+    """
+    Render the thumbnails of every saved activity's route which doesn't have one yet, a batch at a time in pk
+    order. Only the polylines of routes without a thumbnail are read. Returns counts for reporting.
+    """
+    t_start = time.perf_counter()
+    if queryset is None:
+        queryset = Activity.objects.all()
+    activities = rendered = 0
+    seen = set()
+    last_pk = 0
+    while batch := list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'route_hash')[:batch_size]):
+        last_pk = batch[-1][0]
+        activities += len(batch)
+        missing = {}
+        for pk, digest in batch:
+            if digest not in seen:
+                seen.add(digest)
+                if not thumbnail_path(digest).exists():
+                    missing[digest] = pk
+        polylines = Activity.objects.filter(pk__in=missing.values()).values_list('polyline', flat=True)
+        for digest, svg in render_thumbnails(list(polylines)).items():
+            save_thumbnail(digest, svg)
+        rendered += len(missing)
+    result = {'activities': activities, 'routes': len(seen), 'rendered': rendered,
+              'seconds': time.perf_counter() - t_start}
+    logger.info("Rendered route thumbnails: %s", result)
+    return result
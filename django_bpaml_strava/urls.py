@@ -1,17 +1,35 @@
+from django.conf import settings
 from django.urls import path
 from django_bpaml_strava.views import index_page, athlete_page, view_activities
 from django_bpaml_strava.views import fetch_and_view_activities, save_activity
 from django_bpaml_strava.views import delete_activity
 from django_bpaml_strava.views import fetch_and_save_activities
 from django_bpaml_strava.views import delete_activities
+from django_bpaml_strava.views import leaderboard_page
+from django_bpaml_strava.views import api_activities
+from django_bpaml_strava.views import strava_webhook
+from django_bpaml_strava.views import export_activities
+from django_bpaml_strava.views import route_thumbnail
+
+if getattr(settings, 'BPAML_ASYNC_VIEWS', False):
+    # Views which call Strava don't tie up a worker thread while waiting when deployed with asgi.py
+    from django_bpaml_strava.async_views import afetch_and_view_activities as fetch_and_view_activities
+    from django_bpaml_strava.async_views import asave_activity as save_activity
+    from django_bpaml_strava.async_views import afetch_and_save_activities as fetch_and_save_activities
 
 urlpatterns = [
   path('', index_page, name='index'),
   path('athlete/<str:strava_id>/', athlete_page, name='athlete'),
+  path('leaderboard/', leaderboard_page, name='leaderboard'),
+  path('leaderboard/<int:season>/', leaderboard_page, name='leaderboard-season'),
   path('view-activities/athlete/<int:strava_id>', view_activities, name='view-activities'),
   path('view-unsaved-activities-available-on-strava/athlete/<int:strava_id>', fetch_and_view_activities, name='view-unsaved-activities-available-on-strava'),
   path('save-activity/athlete/<int:strava_id>/activity/<int:activity_id>', save_activity, name='save-activity'),
   path('delete-activity/athlete/<int:strava_id>/activity/<int:activity_id>', delete_activity, name='delete-activity'),
   path('save-activities/athlete/<int:strava_id>', fetch_and_save_activities, name='save-activities'),
   path('delete-activities/athlete/<int:strava_id>', delete_activities, name='delete-activities'),
+  path('api/athlete/<int:strava_id>/activities', api_activities, name='api-activities'),
+  path('export/activities.<str:export_format>', export_activities, name='export-activities'),
+  path('thumbnail/<str:key>/<str:digest>.svg', route_thumbnail, name='route-thumbnail'),
+  path('strava/webhook', strava_webhook, name='strava-webhook'),
 ]
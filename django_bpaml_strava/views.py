@@ -1,105 +1,214 @@
 import datetime
+import json
 import logging
-import requests
-import zoneinfo
+import re
 from allauth.socialaccount.models import SocialAccount
 from django.shortcuts import render, get_object_or_404, redirect
-from django.db.models import Prefetch
+from django.db import transaction
+from django.core.exceptions import BadRequest
+from django.db.models import F, Max, Min, Q, Sum
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse
+from django.http import FileResponse, Http404, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+from django.db.models.functions import Coalesce
 from django.contrib.auth.decorators import login_required
-from django_bpaml_strava.models import Activity, User
-
-from django_bpaml_strava.strava_token import fetch_strava_token
+from django.utils.cache import patch_cache_control
+from django.utils.functional import SimpleLazyObject
+from django_bpaml_strava.models import Activity, SeasonStanding, User
+
+from django_bpaml_strava.activity_pages import ACTIVITY_PAGE_SIZE, MAX_API_PAGE_SIZE, ActivityPage
+from django_bpaml_strava.activity_pages import activities_after, encode_cursor
+from django_bpaml_strava.course_matching import assign_locations
+from django_bpaml_strava.export import EXPORT_FORMATS, export_chunks, export_rows
+from django_bpaml_strava.ingest import activity_from_strava, bulk_save_activities, decode_activities
+from django_bpaml_strava.listing_cache import cached_activity, fetch_listing, invalidate_listing
+from django_bpaml_strava.metrics import render_metrics, scrape_allowed
+from django_bpaml_strava.page_cache import PAGE_CACHE_TIMEOUT, athlete_page_version, bump_page_versions
+from django_bpaml_strava.page_cache import index_page_version, strava_user_id
+from django_bpaml_strava.parkrun import new_parkrun_activities
+from django_bpaml_strava.query_budget import query_budget
+from django_bpaml_strava.rate_limit import headroom
+from django_bpaml_strava.standings import get_points_function, update_season_standing, update_season_standings
+from django_bpaml_strava.strava_activities import BASE_TZ, fetch_activity_from_strava
+from django_bpaml_strava.strava_client import StravaError
+from django_bpaml_strava.thumbnails import THUMBNAIL_KEY, THUMBNAIL_SIZE, get_thumbnail
+from django_bpaml_strava.webhook import event_from_payload, verify_subscription
 
 logger = logging.getLogger(__name__)
-BASE_TZ = zoneinfo.ZoneInfo("Australia/Brisbane")
 
+THUMBNAIL_DIGEST = re.compile(r'[0-9a-f]{64}')
+
+@query_budget(queries=4)
 def index_page(request):
-    """Find all athletes """
-    list_social_accounts = SocialAccount.objects.filter(provider='strava').select_related('user')
-    context = {'athletes': list_social_accounts}
+    """
+    Find all athletes with their activity count, latest activity and best time this season in a single query.
+    These come from the few season standings of each athlete rather than all their activities.
+    """
+    season = datetime.datetime.now(BASE_TZ).year
+    list_social_accounts = (SocialAccount.objects.filter(provider='strava')
+                            .select_related('user')
+                            .annotate(
+                                activity_count=Coalesce(Sum('user__seasonstanding__run_count'), 0),
+                                last_activity_date=Max('user__seasonstanding__last_date'),
+                                season_best=Min(
+                                    'user__seasonstanding__best_duration',
+                                    filter=Q(user__seasonstanding__season=season),
+                                ),
+                            ))
+    # The queryset is lazy so isn't run when the table is already cached
+    context = {'athletes': list_social_accounts, 'season': season, 'page_version': index_page_version(),
+               'page_cache_timeout': PAGE_CACHE_TIMEOUT}
     return render(request, 'django_bpaml_strava/athletes.html', context)
 
 
+@query_budget(queries=3)
+def leaderboard_page(request, season=None):
+    """League standings for one season, read in a single query using the (season, best_duration) index"""
+    if season is None:
+        season = datetime.datetime.now(BASE_TZ).year
+    standings = (SeasonStanding.objects
+                 .filter(season=season, athlete__socialaccount__provider='strava')
+                 .select_related('athlete')
+                 .annotate(strava_id=F('athlete__socialaccount__uid')))
+    points = get_points_function() is not None
+    if points:
+        standings = standings.order_by(F('points').desc(nulls_last=True), F('best_duration').asc(nulls_last=True))
+    else:
+        standings = standings.order_by(F('best_duration').asc(nulls_last=True), '-run_count')
+    context = {'standings': standings, 'season': season, 'points': points, 'page_version': index_page_version(),
+               'page_cache_timeout': PAGE_CACHE_TIMEOUT}
+    return render(request, 'django_bpaml_strava/leaderboard.html', context)
+
+
+@query_budget(queries=5)
 def athlete_page(request, strava_id):
     """Find just the one athlete with the supplied strava id"""
-    a = get_object_or_404(SocialAccount, provider='strava', uid=strava_id)
-    context = {'athlete': a}
+    context = athlete_context(strava_id, cursor=request.GET.get('after'))
     return render(request, 'django_bpaml_strava/athlete.html', context)
 
 
-def social_account_with_sorted_activities(strava_id):
-    social_account = (SocialAccount.objects.filter(uid=strava_id, provider='strava')
-                      .select_related("user")
-                      .prefetch_related(
-                          Prefetch(
-                            "user__activity_set",
-                            queryset=Activity.objects.order_by("start_time")
-                          )
-                        )
-                      .first())
+def athlete_context(strava_id, social_account=None, cursor=None) -> dict:
+    """
+    Context for athlete.html whose athlete details and page of saved activities are cached until the athlete
+    changes. Without social_account, the athlete is only looked up if the cached fragments have to be rendered.
+    """
+    if social_account is None:
+        user_id = strava_user_id(strava_id)
+        social_account = SimpleLazyObject(lambda: strava_social_account(strava_id))
+    else:
+        user_id = social_account.user_id
+    return {'athlete': social_account, 'strava_id': strava_id, 'activity_page': ActivityPage(user_id, cursor),
+            'cursor': cursor or '', 'page_version': athlete_page_version(user_id),
+            'page_cache_timeout': PAGE_CACHE_TIMEOUT, 'thumbnail_key': THUMBNAIL_KEY, 'thumbnail_size': THUMBNAIL_SIZE}
+
+
+def strava_social_accounts(strava_id):
+    """Queryset for the athlete's social account with its user"""
+    return SocialAccount.objects.filter(uid=strava_id, provider='strava').select_related("user")
+
+
+def strava_social_account(strava_id):
+    social_account = strava_social_accounts(strava_id).first()
     return social_account
 
 
+@query_budget(queries=5)
 @login_required
 def view_activities(request, strava_id):
-    # Get the stored, and possibly refreshed, access token for this athlete
-    social_account = social_account_with_sorted_activities(strava_id)
-    context = {'athlete': social_account}
+    context = athlete_context(strava_id, cursor=request.GET.get('after'))
     return render(request, 'django_bpaml_strava/athlete.html', context)
 
 
-def fetch_activities_from_strava(strava_id):
-    """Fetch all the strava activities for a user in first three months of current year without saving them"""
-    social_token = fetch_strava_token(strava_id)
-
-    year = datetime.datetime.now(BASE_TZ).year
-    after = int(datetime.datetime(year, 1, 1, 0, 0, tzinfo=BASE_TZ).timestamp())
-    before = int(datetime.datetime(year, 4, 1, 0, 0, tzinfo=BASE_TZ).timestamp())
-
-    # Define the endpoint and headers
-    url = 'https://www.strava.com/api/v3/athlete/activities'
-    headers = {'Authorization': f'Bearer {social_token.token}'}
-
-    # Define parameters for the request
-    params = {
-        'before': before,
-        'after': after,
-        'page': 1,
-        'per_page': 200,
-    }
+@query_budget(queries=4)
+@login_required
+def api_activities(request, strava_id):
+    """
+    Read only JSON page of the athlete's saved activities in start time order, for dashboards.
+    Pass the returned next cursor as ?after= to get the following page. ?limit= sets the page size.
+    """
+    try:
+        limit = max(1, min(int(request.GET.get('limit', ACTIVITY_PAGE_SIZE)), MAX_API_PAGE_SIZE))
+    except ValueError:
+        raise BadRequest("limit must be a number")
+    user_id = strava_user_id(strava_id)
+    rows = list(activities_after(user_id, request.GET.get('after'))
+                .values('id', 'activity_id', 'date', 'start_time', 'start_time_local', 'timezone', 'title',
+                        'location', 'distance', 'strava_duration', 'parkrun_duration')[:limit + 1])
+    next_cursor = encode_cursor(rows[limit - 1]['start_time'], rows[limit - 1]['id']) if len(rows) > limit else None
+    activities = []
+    for row in rows[:limit]:
+        del row['id']
+        for key in ('strava_duration', 'parkrun_duration'):
+            row[key] = row[key] and row[key].total_seconds()
+        activities.append(row)
+    return JsonResponse({'activities': activities, 'next': next_cursor})
+
+
+# The export's own queries run while the response streams, after the view has returned
+@query_budget(queries=4)
+@login_required
+def export_activities(request, export_format):
+    """
+    Stream every saved activity as CSV or NDJSON, optionally filtered by ?season=, ?athlete= (Strava id)
+    and ?location=. Rows are fetched in chunks and written as they arrive so memory use stays constant.
+    Only staff and users who may view every activity get the whole club. Others get just their own activities.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise BadRequest(f"Unknown export format {export_format}")
+    try:
+        season = int(request.GET['season']) if request.GET.get('season') else None
+    except ValueError:
+        raise BadRequest("season must be a year")
+    if request.user.is_staff or request.user.has_perm('django_bpaml_strava.view_activity'):
+        user_id = None
+    else:
+        user_id = request.user.pk
+    rows = export_rows(season=season, strava_id=request.GET.get('athlete') or None,
+                       location=request.GET.get('location') or None, user_id=user_id)
+    response = StreamingHttpResponse(export_chunks(export_format, rows), content_type=EXPORT_FORMATS[export_format])
+    response['Content-Disposition'] = f'attachment; filename="activities.{export_format}"'
+    return response
 
-    # Make the GET request with parameters
-    response = requests.get(url, headers=headers, params=params)
 
-    # Check if the request was successful
-    if response.ok:
-        activity_data = response.json()
-        logger.info(f"Athlete activities for authorized user: {len(activity_data)}")
-        return activity_data
-    else:
-        logger.warning(f"Error requesting activities from strava {response.status_code}: {response.text}")
-        return None
+@query_budget(queries=1)
+def route_thumbnail(request, key, digest):
+    """
+    The thumbnail of a saved route, rendered if this is its first request.
+    Its URL changes whenever its content would, so it can be cached for ever
+    """
+    if key != THUMBNAIL_KEY or not THUMBNAIL_DIGEST.fullmatch(digest):
+        raise Http404("Not a thumbnail")
+    path = get_thumbnail(digest)
+    if path is None:
+        raise Http404("No such thumbnail")
+    response = FileResponse(path.open('rb'), content_type='image/svg+xml')
+    patch_cache_control(response, public=True, max_age=365 * 24 * 60 * 60, immutable=True)
+    return response
 
 
+@query_budget(queries=8)
 @login_required
 def fetch_and_view_activities(request, strava_id):
     """Fetch activities from strava, no filtering, and display asking user which ones should be saved
 
     Triggered by URL 'bpaml-strava/show-unsaved-activities-available-on-strava'
     """
-    list_strava_activities = fetch_activities_from_strava(strava_id)
-    if list_strava_activities is None:
+    if request.GET.get('refresh'):
+        invalidate_listing(strava_id)
+    try:
+        list_strava_activities = fetch_listing(strava_id)
+    except StravaError:
         return index_page(request)
-    social_account = social_account_with_sorted_activities(strava_id)
-    # omit the ones already saved
-    set_activity_id = set(a.activity_id for a in social_account.user.activity_set.all())
-    logger.info(f"{set_activity_id=}")
-    for i in range(len(list_strava_activities)-1, 0, -1):
-        if list_strava_activities[i]['id'] in set_activity_id:
-            del list_strava_activities[i]
+    social_account = strava_social_account(strava_id)
+    # omit the ones already saved, using the (athlete, activity_id) unique index
+    set_activity_id = set(Activity.objects
+                          .filter(athlete=social_account.user,
+                                  activity_id__in=[d['id'] for d in list_strava_activities])
+                          .values_list('activity_id', flat=True))
     list_new_strava_activities = [d for d in list_strava_activities if d['id'] not in set_activity_id]
     # display the results
-    context = {'athlete': social_account, 'list_strava_activities': list_new_strava_activities}
+    context = {**athlete_context(strava_id, social_account, request.GET.get('after')), 'list_strava_activities': list_new_strava_activities}
     return render(request, 'django_bpaml_strava/athlete.html', context)
 
 
@@ -108,95 +217,114 @@ def create_activity_from_strava(user: User, dct_activity):
     Given the json data for a single activity from Strava (already converted to a dict)
     create an Activity record linked to the correct User and save in the database.
     """
-    list_timezone = dct_activity['timezone'].split(' ')
-    timezone = list_timezone[1]
-    start_time = datetime.datetime.strptime(dct_activity["start_date"], "%Y-%m-%dT%H:%M:%SZ").astimezone(zoneinfo.ZoneInfo(timezone))
-    start_time_local = datetime.datetime.strptime(dct_activity["start_date_local"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=zoneinfo.ZoneInfo(timezone))
-    start_date = start_time.date()
-    logger.info(f'{start_time:%d-%b-%Y %H:%M} {start_time_local:%d-%b-%Y %H:%M %z} {dct_activity["distance"] / 1000:6.1f}km {dct_activity["name"]}')
-    activity = Activity.objects.create(
-        athlete=user,
-        activity_id=dct_activity["id"],
-        date=start_date,
-        start_time=start_time,
-        start_time_local=start_time_local.replace(tzinfo=None),
-        timezone=timezone,
-        distance=dct_activity["distance"],
-        title=dct_activity["name"],
-        strava_duration=datetime.timedelta(seconds=dct_activity["elapsed_time"]),
-        polyline=dct_activity["map"]["summary_polyline"],
-    )
+    activity = activity_from_strava(user, dct_activity)
+    assign_locations([activity])
+    # Lazy arguments so nothing is formatted unless DEBUG logging is on
+    logger.debug('%s %s %s %.1fkm %s', activity.start_time, activity.start_time_local, activity.timezone,
+                 activity.distance / 1000, activity.title)
     activity.save()
+    return activity
 
 
+@query_budget(queries=12)
 @login_required
 def save_activity(request, strava_id, activity_id):
-    social_account = social_account_with_sorted_activities(strava_id)
-    social_token = fetch_strava_token(strava_id)
-    # Define the endpoint and headers to fetch a single activity
-    url = f'https://www.strava.com/api/v3/activities/{activity_id}'
-    headers = {'Authorization': f'Bearer {social_token.token}'}
-
-    # Define parameters for the request. We don't need all efforts for this activity
-    params = {
-        'include_all_efforts': False,
-    }
-
-    # Make the GET request with parameters for single activity
-    response = requests.get(url, headers=headers, params=params)
-
-    # Check if the request was successful
-    if response.ok:
-        dct_activity = response.json()
-        logger.info(f"Activity for authorized user: {dct_activity}")
-        # add activity to user
-        create_activity_from_strava(social_account.user, dct_activity)
-    else:
-        logger.warning(f"Error requesting activities from strava {response.status_code}: {response.text}")
+    social_account = get_object_or_404(SocialAccount.objects.select_related('user'), provider='strava', uid=strava_id)
+    if Activity.objects.filter(athlete=social_account.user, activity_id=activity_id).exists():
+        logger.info("Activity %s already saved", activity_id)
+        return redirect("view-activities", strava_id=strava_id)
+    # The summary in the listing the user chose from has everything we save
+    dct_activity = cached_activity(strava_id, activity_id)
+    if dct_activity is None:
+        try:
+            dct_activity = fetch_activity_from_strava(strava_id, activity_id)
+        except StravaError:
+            return redirect("view-activities", strava_id=strava_id)
+    # add activity to user
+    create_activity_from_strava(social_account.user, dct_activity)
     # requery db to include new activity
     return redirect("view-activities", strava_id=strava_id)
 
 
+@query_budget(queries=8)
 @login_required
 def delete_activity(request, strava_id, activity_id):
-    social_account = social_account_with_sorted_activities(strava_id)
-    for a in social_account.user.activity_set.all():
-        if a.activity_id == activity_id:
-            a.delete()
-            logger.info(f"Deleted activity {a.activity_id}")
-            break
-        logger.info(f"activity {a.activity_id} != {activity_id}")
+    user_id = strava_user_id(strava_id)
+    activities = Activity.objects.filter(athlete_id=user_id, activity_id=activity_id)
+    with transaction.atomic():
+        # Only the standing for the deleted activity's season changes
+        dates = list(activities.values_list('date', flat=True))
+        deleted, _ = activities.delete()
+        for season in {date.year for date in dates}:
+            update_season_standing(user_id, season)
+        if deleted:
+            bump_page_versions([user_id])
+    if deleted:
+        logger.info("Deleted activity %s", activity_id)
     else:
-        logger.error("Activity not found")
+        logger.error("Activity %s not found", activity_id)
     return redirect('view-activities', strava_id=strava_id)
 
 
+@query_budget(queries=12)
 @login_required
 def fetch_and_save_activities(request, strava_id):
     """Fetch activities from strava, filter out non-parkrun events and save the rest if nothing else
     already saved for that date"""
-    lst_strava_activities = fetch_activities_from_strava(strava_id)
-    if lst_strava_activities is None:
+    social_account = get_object_or_404(SocialAccount.objects.select_related('user'), provider='strava', uid=strava_id)
+    user = social_account.user
+    try:
+        strava_activities = fetch_listing(strava_id)
+        new_activities = new_parkrun_activities(user, decode_activities(user, strava_activities))
+    except StravaError:
         return index_page(request)
-    social_account = social_account_with_sorted_activities(strava_id)
-    set_saturday = set(a.date for a in social_account.user.activity_set.all())
-    for dct_activity in lst_strava_activities:
-        # timezone looks like '(GMT+10:00) Australia/Brisbane'
-        list_timezone = dct_activity['timezone'].split(' ')
-        timezone = list_timezone[1]
-        start_time = datetime.datetime.strptime(dct_activity["start_date"], "%Y-%m-%dT%H:%M:%SZ").astimezone(
-            zoneinfo.ZoneInfo(timezone))
-        start_date = start_time.date()
-        latest_start_time = start_time.replace(hour=7, minute=10, second=0, microsecond=0)
-        # Find last start on each Saturday before 7:10am local time that is between 4.7km and 5.3km
-        if start_date not in set_saturday and start_time.weekday() == 5 and start_time < latest_start_time and 4700 < dct_activity["distance"] < 5300:
-            set_saturday.add(start_date)
-            create_activity_from_strava(social_account.user, dct_activity)
+    bulk_save_activities(new_activities)
     return redirect('view-activities', strava_id=strava_id)
 
 
+@query_budget(queries=8)
 @login_required
 def delete_activities(request, strava_id):
-    social_account = social_account_with_sorted_activities(strava_id)
-    social_account.user.activity_set.all().delete()
+    user_id = strava_user_id(strava_id)
+    with transaction.atomic():
+        deleted, _ = Activity.objects.filter(athlete_id=user_id).delete()
+        update_season_standings([user_id])
+        bump_page_versions([user_id])
+    logger.info("Deleted %s activities", deleted)
     return redirect('view-activities', strava_id=strava_id)
+
+
+@query_budget(queries=1)
+@csrf_exempt
+@require_http_methods(['GET', 'POST'])
+def strava_webhook(request):
+    """
+    Callback url of our Strava push subscription.
+    GET is Strava validating the subscription. POST is an event, which is only queued so we answer quickly.
+    """
+    if request.method == 'GET':
+        challenge = verify_subscription(request.GET.get('hub.mode'), request.GET.get('hub.verify_token'),
+                                        request.GET.get('hub.challenge'))
+        if challenge is None:
+            return HttpResponseForbidden()
+        return JsonResponse({'hub.challenge': challenge})
+    try:
+        event = event_from_payload(json.loads(request.body))
+    except ValueError as e:
+        logger.warning("Rejected Strava webhook event: %s", e)
+        return HttpResponseBadRequest()
+    event.save()
+    return HttpResponse()
+
+
+@query_budget(queries=0)
+def prometheus_metrics(request):
+    """Metrics of every worker process in Prometheus text format, for scraping by allowed clients"""
+    if not scrape_allowed(request):
+        return HttpResponseForbidden()
+    fifteen_minutes, daily = headroom()
+    gauges = {
+        'bpaml_strava_rate_limit_headroom': ('Strava calls remaining in the current rate limit window',
+                                             [((('window', '15min'),), fifteen_minutes), ((('window', 'daily'),), daily)]),
+    }
+    return HttpResponse(render_metrics(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
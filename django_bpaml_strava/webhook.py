@@ -0,0 +1,169 @@
+"""
+Strava webhook (push subscription) events. The webhook view only queues each event in StravaEvent so it can
+answer Strava within its 2 second limit. process_strava_events then applies them, fetching only the
+activities which changed instead of polling every athlete's listing.
+"""
+# Standard libraries
+import collections
+import datetime
+import logging
+# Third-party libraries
+from allauth.socialaccount.models import SocialAccount, SocialToken
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+# Local libraries
+from django_bpaml_strava.course_matching import assign_locations
+from django_bpaml_strava.database import serialized_writer
+from django_bpaml_strava.ingest import activity_from_strava, bulk_save_activities
+from django_bpaml_strava.listing_cache import invalidate_listing
+from django_bpaml_strava.models import Activity, StravaEvent
+from django_bpaml_strava.page_cache import bump_page_versions
+from django_bpaml_strava.parkrun import new_parkrun_activities
+from django_bpaml_strava.rate_limit import BULK, StravaRateLimited, strava_priority
+from django_bpaml_strava.standings import update_season_standings
+from django_bpaml_strava.strava_activities import fetch_activity_from_strava
+from django_bpaml_strava.strava_client import StravaError
+
+logger = logging.getLogger(__name__)
+
+# Token we gave Strava when creating the subscription. Strava sends it back when validating the callback url
+VERIFY_TOKEN = getattr(settings, 'BPAML_STRAVA_WEBHOOK_VERIFY_TOKEN', None)
+# If set, events for any other subscription are rejected
+SUBSCRIPTION_ID = getattr(settings, 'BPAML_STRAVA_WEBHOOK_SUBSCRIPTION_ID', None)
+# An athlete's events are only processed once none has arrived for this many seconds,
+# so a burst such as a create followed by several edits costs one fetch
+SETTLE_SECONDS = getattr(settings, 'BPAML_STRAVA_WEBHOOK_SETTLE', 30)
+# Events which fail this many times are left unprocessed for someone to look at
+MAX_ATTEMPTS = 5
+
+ASPECT_TYPES = ('create', 'update', 'delete')
+OBJECT_TYPES = ('activity', 'athlete')
+# Fields of a saved activity which are refreshed from Strava on an update event. location isn't as it may be
+# the event name from an official result, so only activities without one are matched to a course again
+UPDATED_FIELDS = ['date', 'start_time', 'start_time_local', 'timezone', 'title', 'distance', 'strava_duration',
+                  'polyline', 'route_hash']
+
+
+def verify_subscription(mode, verify_token, challenge) -> str | None:
+    """Challenge to echo back if this is Strava validating our subscription, otherwise None"""
+    if mode == 'subscribe' and VERIFY_TOKEN and verify_token == VERIFY_TOKEN and challenge:
+        return challenge
+    return None
+
+
+def event_from_payload(payload: dict) -> StravaEvent:
+    """Unsaved StravaEvent from the body Strava posted. Raises ValueError if it isn't a Strava event"""
+    try:
+        event = StravaEvent(
+            aspect_type=payload['aspect_type'],
+            object_type=payload['object_type'],
+            object_id=int(payload['object_id']),
+            owner_id=str(payload['owner_id']),
+            event_time=datetime.datetime.fromtimestamp(int(payload['event_time']), datetime.timezone.utc),
+            updates=payload.get('updates') or {},
+        )
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Invalid Strava event {payload}") from e
+    if event.aspect_type not in ASPECT_TYPES or event.object_type not in OBJECT_TYPES:
+        raise ValueError(f"Unknown Strava event {event.object_type} {event.aspect_type}")
+    if SUBSCRIPTION_ID is not None and payload.get('subscription_id') != SUBSCRIPTION_ID:
+        raise ValueError(f"Event for another subscription {payload.get('subscription_id')}")
+    return event
+
+
+def pending_events_by_athlete(settle_seconds=SETTLE_SECONDS) -> dict[str, list[StravaEvent]]:
+    """Unprocessed events in the order received for each athlete who hasn't had an event for settle_seconds"""
+    events_by_athlete = collections.defaultdict(list)
+    for event in (StravaEvent.objects
+                  .filter(processed_at__isnull=True, attempts__lt=MAX_ATTEMPTS)
+                  .order_by('owner_id', 'id')):
+        events_by_athlete[event.owner_id].append(event)
+    settled_before = timezone.now() - datetime.timedelta(seconds=settle_seconds)
+    return {owner_id: events for owner_id, events in events_by_athlete.items()
+            if events[-1].received_at <= settled_before}
+
+
+def coalesce_events(events: list[StravaEvent]) -> tuple[set[int], set[int]]:
+    """
+    Activity ids to fetch and save, and activity ids to delete. The last event for each activity wins
+    so any number of creates and updates become one fetch, and anything followed by a delete is just deleted.
+    """
+    last_aspect = {}
+    for event in events:
+        if event.object_type == 'activity':
+            last_aspect[event.object_id] = event.aspect_type
+    fetch_ids = {activity_id for activity_id, aspect in last_aspect.items() if aspect != 'delete'}
+    return fetch_ids, set(last_aspect) - fetch_ids
+
+
+def apply_athlete_events(social_account: SocialAccount, events: list[StravaEvent]) -> dict:
+    """
+    Apply one athlete's events and mark them processed. Raises StravaError, or StravaRateLimited,
+    without changing anything if an activity can't be fetched.
+    """
+    strava_id = social_account.uid
+    user = social_account.user
+    fetch_ids, delete_ids = coalesce_events(events)
+    if any(e.object_type == 'athlete' and e.updates.get('authorized') == 'false' for e in events):
+        # The athlete revoked our access so their tokens are useless and nothing more can be fetched
+        logger.info("Athlete %s deauthorized BPAML", strava_id)
+        SocialToken.objects.filter(account=social_account).delete()
+        fetch_ids = set()
+    dct_activities = []
+    for activity_id in sorted(fetch_ids):
+        try:
+            dct_activities.append(fetch_activity_from_strava(strava_id, activity_id))
+        except StravaError as e:
+            # Deleted, or made private, before we fetched it
+            if e.status_code != 404:
+                raise
+            delete_ids.add(activity_id)
+    activities = [activity_from_strava(user, dct_activity) for dct_activity in dct_activities]
+    with serialized_writer():
+        saved = {a.activity_id: a for a in Activity.objects.filter(athlete=user, activity_id__in=fetch_ids)}
+        updated = []
+        for activity in activities:
+            existing = saved.get(activity.activity_id)
+            if existing is not None:
+                for field in UPDATED_FIELDS:
+                    setattr(existing, field, getattr(activity, field))
+                updated.append(existing)
+        assign_locations([a for a in updated if not a.location])
+        Activity.objects.bulk_update(updated, UPDATED_FIELDS + ['location'])
+        # New activities go through the same parkrun rules and bulk ingest as a sync
+        created = bulk_save_activities(new_parkrun_activities(
+            user, [a for a in activities if a.activity_id not in saved]))
+        deleted, _ = Activity.objects.filter(athlete=user, activity_id__in=delete_ids).delete()
+        if updated or deleted:
+            update_season_standings([user.pk])
+            bump_page_versions([user.pk])
+        StravaEvent.objects.filter(pk__in=[e.pk for e in events]).update(processed_at=timezone.now())
+    # The cached listing no longer matches Strava
+    invalidate_listing(strava_id)
+    result = {'strava_id': strava_id, 'events': len(events), 'fetched': len(dct_activities),
+              'created': created, 'updated': len(updated), 'deleted': deleted}
+    logger.info("Applied Strava events: %s", result)
+    return result
+
+
+def process_strava_events(settle_seconds=SETTLE_SECONDS) -> list[dict]:
+    """Apply the pending events of every settled athlete. Returns the result for each athlete"""
+    events_by_athlete = pending_events_by_athlete(settle_seconds)
+    social_accounts = SocialAccount.objects.filter(provider='strava', uid__in=events_by_athlete).select_related('user')
+    social_accounts = {sa.uid: sa for sa in social_accounts}
+    results = []
+    for owner_id, events in events_by_athlete.items():
+        event_ids = [e.pk for e in events]
+        social_account = social_accounts.get(owner_id)
+        if social_account is None:
+            logger.info("Ignoring %s Strava events for unknown athlete %s", len(events), owner_id)
+            StravaEvent.objects.filter(pk__in=event_ids).update(processed_at=timezone.now(), error='unknown athlete')
+            continue
+        try:
+            with strava_priority(BULK):
+                results.append(apply_athlete_events(social_account, events))
+        except (StravaError, StravaRateLimited, SocialToken.DoesNotExist) as e:
+            logger.warning("Failed to apply Strava events for athlete %s: %s", owner_id, e)
+            StravaEvent.objects.filter(pk__in=event_ids).update(attempts=F('attempts') + 1, error=str(e)[:200])
+    return results
@@ -50,6 +50,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'django_bpaml_strava.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -58,6 +59,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'allauth.account.middleware.AccountMiddleware',
+    'django_bpaml_strava.middleware.StravaRateLimitMiddleware',
 ]
 
 ROOT_URLCONF = 'django_bpaml_strava_site.urls'
@@ -90,6 +92,33 @@ DATABASES = {
     }
 }
 
+# Production SQLite profile. Connections are kept between requests, write transactions take SQLite's write lock
+# when they begin so concurrent writers wait for it instead of failing with "database is locked", and
+# django_bpaml_strava.database applies WAL and cache pragmas (BPAML_SQLITE_PRAGMAS) to each new connection.
+BPAML_SQLITE_PRODUCTION = not DEBUG
+if BPAML_SQLITE_PRODUCTION:
+    DATABASES['default'].update({
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            # Seconds to wait for the write lock
+            'timeout': 20,
+        },
+    })
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# File based so every worker process shares the Strava rate limit usage
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'django_cache',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -144,13 +173,23 @@ SOCIALACCOUNT_STORE_TOKENS = True
 LOGIN_REDIRECT_URL = "/bpaml-strava/"
 LOGOUT_REDIRECT_URL = "/bpaml-strava/"
 
-# Extend Django default logging to also log to console at level INFO rather than WARNING
+# Extend Django default logging to also log to console at level INFO rather than WARNING.
+# Records are written by a background thread so requests never wait for the console, and repeated
+# DEBUG and INFO messages are limited to 10 a minute each so per activity messages can't flood the log.
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
+    "filters": {
+        "rate_limit": {
+            "()": "django_bpaml_strava.log.RateLimitFilter",
+            "rate": 10,
+            "per": 60,
+        },
+    },
     "handlers": {
         "console": {
-            "class": "logging.StreamHandler",
+            "()": "django_bpaml_strava.log.BackgroundHandler",
+            "filters": ["rate_limit"],
         },
     },
     "root": {
@@ -160,3 +199,18 @@ LOGGING = {
 }
 
 DATE_FORMAT = 'D d M Y'
+
+# Raise QueryBudgetExceeded when a view runs more SQL queries than its declared budget, rather than log a warning
+BPAML_QUERY_BUDGET_STRICT = DEBUG
+
+# Use the async versions of the views which call Strava. Set True when deployed with asgi.py
+BPAML_ASYNC_VIEWS = False
+
+# Directory shared by every worker process where each writes its metrics for /metrics to add up.
+# Leave as None when there is only one process. Clear it when deploying.
+BPAML_METRICS_DIR = None
+
+# Addresses or networks allowed to scrape /metrics, and a token Prometheus can send as a bearer token instead.
+# Behind a reverse proxy every request comes from the proxy's address, so use the token there.
+BPAML_METRICS_ALLOWED_IPS = ['127.0.0.1', '::1'] if DEBUG else []
+BPAML_METRICS_TOKEN = None
@@ -17,6 +17,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 from django.views.generic import TemplateView
+from django_bpaml_strava.views import prometheus_metrics
 
 
 urlpatterns = [
@@ -24,4 +25,5 @@ urlpatterns = [
     path('bpaml-strava/', include('django_bpaml_strava.urls')),
     path('', TemplateView.as_view(template_name="bpaml_home.html")),
     path('accounts/', include('allauth.urls')),
+    path('metrics', prometheus_metrics, name='metrics'),
 ]